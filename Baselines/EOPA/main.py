@@ -7,8 +7,16 @@ import random
 
 import torch
 from torch.utils.data import DataLoader
+import sys
+# the repository root, home of the shared package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from utils import read_dataset, Dataset, get_best_results
-from collate import seq_to_eop_multigraph, collate_fn_factory
+from shared.checkpoint import CheckpointManager
+from shared.async_eval import AsyncEvaluator
+from shared import runtime
+from shared.telemetry import Telemetry
+from shared.profiling import Profiler
+from collate import seqs_to_eop_multigraph, collate_fn_factory
 from model import *
 
 parser = argparse.ArgumentParser()
@@ -16,6 +24,7 @@ parser.add_argument('--dataset', default='yoochoose', type=str, help='dataset di
 parser.add_argument('--embed_dim', type=int, default=32, help='the embedding size')
 parser.add_argument('--n-layers', type=int, default=3, help='the number of layers')
 parser.add_argument('--feat-drop', type=float, default=0.2, help='the dropout ratio for features')
+parser.add_argument('--mailbox', default='bucket', choices=['bucket', 'packed'], help='how the EOPA layers run their GRU over the node mailboxes: once per in-degree bucket, or once over all of them packed')
 parser.add_argument('--lr', type=float, default=1e-3, help='the learning rate')
 parser.add_argument('--batch-size', type=int, default=128, help='the batch size for training')
 parser.add_argument('--epoch', type=int, default=30, help='the number of training epochs')
@@ -27,11 +36,33 @@ parser.add_argument('--valid-split', type=float, default=None, help='the fractio
 parser.add_argument('--save_model', default=False)
 parser.add_argument('--seed', type=int, default=220, help='seed for random behaviors, no seed if negtive')
 parser.add_argument('--gpu_num', type=int, default=0)
+parser.add_argument('--device', default='auto', help='device to train on: auto (cuda when available), cpu, cuda, cuda:N or mps')
+parser.add_argument('--threads', type=int, default=0, help='intra-op cpu threads, 0 for the torch default or one per pinned core')
+parser.add_argument('--interop_threads', type=int, default=0, help='inter-op cpu threads, 0 for the torch default')
+parser.add_argument('--cores', default=None, help='cpu cores to pin the process to, e.g. 0-7,16')
+parser.add_argument('--resume', default=None, help='path of a last.pt checkpoint to resume training from')
+parser.add_argument('--ckpt_metric', default='HR@20', help='metric ranking the kept checkpoints: HR/MRR/Cov@10/20')
+parser.add_argument('--ckpt_keep', type=int, default=3, help='the number of best checkpoints to keep, at least 1')
+parser.add_argument('--ckpt_half', action='store_true', help='store the kept checkpoints in fp16')
+parser.add_argument('--async_eval', action='store_true', help='evaluate every epoch in a separate process while the next one trains')
+parser.add_argument('--eval_lag', type=int, default=1, help='the number of epochs the evaluation may lag behind training')
+parser.add_argument('--eval_threads', type=int, default=0, help='cpu threads of the evaluation process, 0 for a quarter of the cores')
+parser.add_argument('--telemetry_dir', default='telemetry', help='directory of the stage timing records')
+parser.add_argument('--telemetry_every', type=int, default=100, help='write a timing record every this many steps, 0 for epoch records only')
+parser.add_argument('--telemetry_sync', action='store_true', help='synchronize cuda at stage boundaries for exact gpu stage times')
+parser.add_argument('--tracemalloc', action='store_true', help='trace the python allocations of get_slice, create_aug_sessions and get_metric_scores')
+parser.add_argument('--telemetry_tensors', action='store_true', help='list the largest live tensors at every new memory peak, walks all python objects')
+parser.add_argument('--profile', action='store_true', help='profile a window of training steps with torch.profiler')
+parser.add_argument('--profile_dir', default='profile', help='directory of the profiler runs')
+parser.add_argument('--profile_wait', type=int, default=5, help='the number of steps skipped before profiling')
+parser.add_argument('--profile_warmup', type=int, default=2, help='the number of profiler warmup steps')
+parser.add_argument('--profile_active', type=int, default=5, help='the number of profiled steps')
+parser.add_argument('--profile_repeat', type=int, default=1, help='the number of profiling windows, 0 for all of training')
+parser.add_argument('--profile_stack', action='store_true', help='record python stacks in the profile')
 opt = parser.parse_args()
 print(opt)
 
-torch.cuda.set_device(opt.gpu_num)
-device = torch.device(f'cuda' if torch.cuda.is_available() else 'cpu')
+device = runtime.setup(opt.device, opt.gpu_num, opt.threads, opt.interop_threads, opt.cores)
 if opt.save_model:
     os.makedirs(f'ckpt/{opt.dataset}', exist_ok=True)
 
@@ -47,7 +78,7 @@ def main():
     test_set = Dataset(test_sessions)
 
     print("loading Dataset")
-    collate_fn = collate_fn_factory(seq_to_eop_multigraph)
+    collate_fn = collate_fn_factory(seqs_to_eop_multigraph)
 
     train_loader = DataLoader(train_set,
                             batch_size=opt.batch_size,
@@ -71,29 +102,66 @@ def main():
     n_iters_per_epoch = len(train_set) // opt.batch_size 
     n_iters_all = n_iters_per_epoch * opt.epoch
     
-    model = trans_to_cuda(LESSR_part(num_items, opt.embed_dim, opt.n_layers, opt.feat_drop))
+    model = trans_to_cuda(LESSR_part(num_items, opt.embed_dim, opt.n_layers, opt.feat_drop, mailbox=opt.mailbox))
 
     start = time.time()
     best_results = [[0 for i in range(3)] for j in range(2)]
     best_epochs = [[0 for i in range(3)] for j in range(2)]
     bad_counter = 0
-    for epoch in range(opt.epoch):
+    ckpt = CheckpointManager(f'ckpt/{opt.dataset}', opt.ckpt_metric, opt.ckpt_keep, opt.ckpt_half)
+    start_epoch = 0
+    if opt.resume:
+        state = ckpt.resume(opt.resume, model)
+        start_epoch, bad_counter = state['epoch'] + 1, state['bad_counter']
+        best_results[:], best_epochs[:] = state['best_results'], state['best_epochs']
+    evaluator = None
+    if opt.async_eval:
+        evaluator = AsyncEvaluator(model, evaluate, test_loader, Ks, num_items, torch.device('cpu'),
+                                   max_lag=opt.eval_lag, threads=opt.eval_threads)
+    # hooked after the evaluator copied the model, so its process runs without them
+    telemetry = Telemetry(f'{opt.telemetry_dir}/{opt.dataset}', model, opt.telemetry_every, opt.telemetry_sync,
+                          opt.tracemalloc, opt.telemetry_tensors)
+    train_loader = telemetry.watch_loader(train_loader)
+    profiler = None
+    if opt.profile:
+        profiler = Profiler(f'{opt.profile_dir}/{opt.dataset}', model, opt.profile_wait, opt.profile_warmup,
+                            opt.profile_active, opt.profile_repeat, opt.profile_stack)
+        train_loader = profiler.watch_loader(train_loader)
+    for epoch in range(start_epoch, opt.epoch):
         print('-' * 100)
         print('Epoch: ', epoch)
-        loss, results = train_test(model, Ks, train_loader, test_loader, n_iters_all, num_items, device)
+        telemetry.start_epoch(epoch)
+        loss, results = train_test(model, Ks, train_loader, test_loader if evaluator is None else None, n_iters_all, num_items, device)
+        telemetry.end_epoch()
 
-        flag = get_best_results(results, epoch, best_results, best_epochs)
-
-        if flag > 0:
-            if opt.save_model == True:
-                model_save_path = f'ckpt/{opt.dataset}/{epoch}.pt'
-                torch.save(model.save_dict(), model_save_path)
-                print("Model Saving Done")
+        if evaluator is None:
+            finished = [(epoch, results, None)]
         else:
-            bad_counter += 1
-            if bad_counter >= opt.patience:
-                break
+            finished = evaluator.submit(epoch, ckpt.capture(epoch, model))
+
+        stop = False
+        for epoch_done, results, state in finished:
+            flag = get_best_results(results, epoch_done, best_results, best_epochs)
+            # patience counts the epochs without improvement, training stops after the one that reaches it
+            if flag <= 0 and not stop:
+                bad_counter += 1
+                stop = bad_counter >= opt.patience
+            if opt.save_model == True:
+                ckpt.save(epoch_done, results, model, bad_counter, best_results, best_epochs, state)
+        if stop:
+            break
+
+    if evaluator is not None:
+        # evaluations still running when training stops only update the best results
+        for epoch_done, results, state in evaluator.close():
+            get_best_results(results, epoch_done, best_results, best_epochs)
+            if opt.save_model == True:
+                ckpt.save(epoch_done, results, model, bad_counter, best_results, best_epochs, state)
 
+    if profiler is not None:
+        profiler.close()
+    telemetry.close()
+    ckpt.close()
     print('-' * 100)
     end = time.time()
     print("Run time: %f s" % (end - start))
@@ -1,12 +1,13 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
 
 import time
 import datetime
 import numpy as np
-from utils import get_metric_scores, metric_print
+from utils import get_metric_scores, metric_print, Sessions
+from shared import runtime
 import pdb
 # import metric
 
@@ -22,6 +23,9 @@ class NARM(nn.Module):
         n_layers(int): the number of gru layers
 
     """
+    # elements of the attention input forward_prefixes builds at once
+    PREFIX_CHUNK = 2 ** 24
+
     def __init__(self, n_items, opt):
         super(NARM, self).__init__()
         self.n_items = n_items
@@ -38,31 +42,39 @@ class NARM(nn.Module):
         self.v_t = nn.Linear(self.hidden_size, 1, bias=False)
         self.ct_dropout = nn.Dropout(0.5)
         self.b = nn.Linear(self.embedding_dim, 2 * self.hidden_size, bias=False)
+        # (weight versions, self.b of the item embeddings), see item_projection
+        self._item_projection = None
         #self.sf = nn.Softmax()
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = runtime.device()
 
         self.loss_function = nn.CrossEntropyLoss()
         self.optimizer = torch.optim.Adam(self.parameters(), lr=opt.lr)
         self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=opt.lr_dc_step, gamma=opt.lr_dc)
 
 
-    def forward(self, seq, lengths):
+    def forward(self, seq, prefixes=False):
+        """c_t of the sessions in seq, a PackedSequence of item ids, in the order of the batch.
+
+        With prefixes, c_t of every prefix of the sessions from the same single
+        GRU pass, as (batch, max_len, 2 * hidden_size): the GRU state after
+        position t is the last state of the prefix ending at t, and its local
+        attention covers the positions up to t only.
+        """
+        if prefixes:
+            return self.forward_prefixes(seq)
         # pdb.set_trace()
-        hidden = self.init_hidden(seq.size(1))
-        embs = self.emb_dropout(self.emb(seq))
-        embs = pack_padded_sequence(embs, lengths.tolist())
-        gru_out, hidden = self.gru(embs, hidden)
-        gru_out, lengths = pad_packed_sequence(gru_out)
+        hidden = self.init_hidden(seq.batch_sizes[0].item())
+        gru_out, hidden = self.gru(self.embed(seq), hidden)
+        gru_out, lengths = pad_packed_sequence(gru_out, batch_first=True)
 
         # fetch the last hidden state of last timestamp
         ht = hidden[-1]
-        gru_out = gru_out.permute(1, 0, 2)
 
         c_global = ht
         q1 = self.a_1(gru_out.contiguous().view(-1, self.hidden_size)).view(gru_out.size())  
         q2 = self.a_2(ht)
 
-        mask = torch.where(seq.permute(1, 0) > 0, torch.tensor([1.], device = self.device), torch.tensor([0.], device = self.device))
+        mask = (torch.arange(gru_out.size(1)) < lengths.unsqueeze(1)).float().to(self.device)
         q2_expand = q2.unsqueeze(1).expand_as(q1)
         q2_masked = mask.unsqueeze(2).expand_as(q1) * q2_expand
 
@@ -73,35 +85,88 @@ class NARM(nn.Module):
         c_t = self.ct_dropout(c_t)
 
         return c_t
-    
+
+    def forward_prefixes(self, seq):
+        hidden = self.init_hidden(seq.batch_sizes[0].item())
+        gru_out, hidden = self.gru(self.embed(seq), hidden)
+        gru_out, lengths = pad_packed_sequence(gru_out, batch_first=True)
+
+        # c_global of the prefix ending at t is the GRU state at t
+        c_global = gru_out
+        q1 = self.a_1(gru_out)
+        q2 = self.a_2(gru_out)
+
+        # alpha[b, t, j]: attention of the prefix ending at t on position j, zero for j > t. It is built for
+        # a chunk of prefixes at a time and over the positions up to the last of them, so the sigmoid input
+        # stays below PREFIX_CHUNK elements instead of being a (batch, max_len, max_len, hidden_size) cube
+        batch_size, max_len, hidden_size = gru_out.shape
+        mask = (torch.arange(max_len) < lengths.unsqueeze(1)).float().to(self.device)
+        chunk = max(1, self.PREFIX_CHUNK // (batch_size * max_len * hidden_size))
+        c_local = []
+        for start in range(0, max_len, chunk):
+            end = min(start + chunk, max_len)
+            q2_masked = mask[:, :end].unsqueeze(1).unsqueeze(3) * q2[:, start:end].unsqueeze(2)
+            alpha = self.v_t(torch.sigmoid(q1[:, :end].unsqueeze(1) + q2_masked))
+            alpha = alpha.squeeze(3) * torch.ones(end - start, end, device=self.device).tril(start)
+            c_local.append(torch.matmul(alpha, gru_out[:, :end]))
+        c_local = torch.cat(c_local, 1)
+
+        c_t = torch.cat([c_local, c_global], 2)
+        c_t = self.ct_dropout(c_t)
+
+        return c_t
+
+    def embed(self, seq):
+        # the embeddings of the packed item ids, packed like them
+        return PackedSequence(self.emb_dropout(self.emb(seq.data)), seq.batch_sizes, seq.sorted_indices,
+                              seq.unsorted_indices)
+
     def compute_scores(self, c_t):
-        item_embs = self.emb(torch.arange(self.n_items).to(self.device))
-        scores = torch.matmul(c_t, self.b(item_embs).permute(1, 0))
+        scores = torch.matmul(c_t, self.item_projection().permute(1, 0))
         # scores = self.sf(scores)
         return scores
 
+    def item_projection(self):
+        """self.b of the embeddings of all items, as (n_items, 2 * hidden_size).
+
+        Without autograd, in evaluation and when scoring with frozen weights,
+        it is computed once per version of emb and b and reused by every later
+        call. Optimizer steps and load_state_dict write the weights in place,
+        which bumps their version, so the next call recomputes it.
+        """
+        if torch.is_grad_enabled() and (self.emb.weight.requires_grad or self.b.weight.requires_grad):
+            return self.b(self.emb(torch.arange(self.n_items).to(self.device)))
+        key = tuple((w.data_ptr(), w._version, w.dtype) for w in (self.emb.weight, self.b.weight))
+        if self._item_projection is None or self._item_projection[0] != key:
+            self._item_projection = (key, self.b(self.emb.weight))
+        return self._item_projection[1]
+
     def init_hidden(self, batch_size):
         return torch.zeros((self.n_layers, batch_size, self.hidden_size), requires_grad=True).to(self.device)
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def forward(model, i, data):
-    inputs, targets, inputs_len = data.get_slice(i)
+    inputs, targets = data.get_slice(i)
+    inputs = trans_to_cuda(inputs)
+    feats = model(inputs)
+    scores = model.compute_scores(feats)
+    return targets, scores
+
+
+def forward_sessions(model, i, data):
+    # the predictions of all training examples of a batch of whole sessions, see Sessions in utils.py
+    inputs, targets, positions = data.get_slice(i)
     inputs = trans_to_cuda(inputs)
-    feats = model(inputs, inputs_len)
+    feats = model(inputs, prefixes=True)
+    feats = feats.reshape(-1, feats.size(2))[trans_to_cuda(positions)]
     scores = model.compute_scores(feats)
     return targets, scores
 
@@ -112,10 +177,11 @@ def train_test(model, train_data, test_data, n_items, Ks=[10, 20]):
 
     model.train()
     total_loss = 0.0
+    forward_batch = forward_sessions if isinstance(train_data, Sessions) else forward
     slices = train_data.generate_batch(model.batch_size)
     for i, j in zip(slices, np.arange(len(slices))):
         model.optimizer.zero_grad()
-        targets, scores = forward(model, i, train_data)
+        targets, scores = forward_batch(model, i, train_data)
         targets = trans_to_cuda(targets)
         loss = model.loss_function(scores, targets)
         loss.backward()
@@ -128,6 +194,13 @@ def train_test(model, train_data, test_data, n_items, Ks=[10, 20]):
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_items, Ks)
+
+
+def evaluate(model, test_data, n_items, Ks=[10, 20]):
     print('start predicting: ', datetime.datetime.now())
     epoch_start_eval = time.time()
     model.eval()
@@ -145,4 +218,4 @@ def train_test(model, train_data, test_data, n_items, Ks=[10, 20]):
 
     results = metric_print(eval10, eval20, n_items, t)                                                            
 
-    return loss, results
+    return results
@@ -8,10 +8,13 @@ Modified on January, 2022
 """
 
 import networkx as nx
+import itertools
 import numpy as np
 import random
 import pdb
 import torch
+from torch.nn.utils.rnn import pack_padded_sequence
+from shared.sessions import prefix_sessions
 
 
 def get_metric_scores(scores, targets, k, eval):
@@ -120,18 +123,46 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def ragged(sessions):
+    # sessions as one flat item array, the offset of every session in it and its length
+    lens = np.fromiter(map(len, sessions), dtype=np.int64, count=len(sessions))
+    items = np.fromiter(itertools.chain.from_iterable(sessions), dtype=np.int64, count=int(lens.sum()))
+    return items, np.cumsum(lens) - lens, lens
+
+
+def gather(items, offsets, lens):
+    # the sessions (offsets, lens) of the flat `items`, one after the other
+    return items[np.arange(lens.sum()) + np.repeat(offsets - (np.cumsum(lens) - lens), lens)]
+
+
+def pack_sessions(items, offsets, lens):
+    """The sessions (offsets, lens) of the flat `items` as a PackedSequence of item ids.
+
+    They are padded by one scatter and packed with enforce_sorted=False, so
+    they keep the order of the batch: packing sorts them by length itself and
+    the GRU returns its outputs in the order of the batch again.
+    """
+    positions = np.arange(lens.max()) < lens[:, None]
+    padded = np.zeros(positions.shape, dtype=np.int64)
+    padded[positions] = gather(items, offsets, lens)
+    return pack_padded_sequence(torch.from_numpy(padded), torch.from_numpy(lens), batch_first=True,
+                                enforce_sorted=False)
+
+
 class Data():
     def __init__(self, data, shuffle=False):
-        self.inputs = np.asarray(data[0], dtype=object)
+        # the sessions as one flat item array, with the offset and length of every session in it
+        self.items, self.offsets, self.lens = ragged(data[0])
         self.targets = np.asarray(data[1])
-        self.length = len(self.inputs)
+        self.length = len(self.lens)
         self.shuffle = shuffle
 
     def generate_batch(self, batch_size):
         if self.shuffle:
             shuffled_arg = np.arange(self.length)
             np.random.shuffle(shuffled_arg)
-            self.inputs = self.inputs[shuffled_arg]
+            self.offsets = self.offsets[shuffled_arg]
+            self.lens = self.lens[shuffled_arg]
             self.targets = self.targets[shuffled_arg]
         n_batch = int(self.length / batch_size)
         if self.length % batch_size != 0:
@@ -141,19 +172,35 @@ class Data():
         return slices
 
     def get_slice(self, i):
-        inputs, targets = self.inputs[i], self.targets[i]
-        inputs_len = np.array([len(input) for input in inputs])
-
-        sorted_idxs = np.argsort(inputs_len)[::-1]
-        inputs = inputs[sorted_idxs]
-        targets = targets[sorted_idxs]
-        inputs_len = inputs_len[sorted_idxs]
-
-        padded_sesss = torch.zeros(len(inputs), max(inputs_len)).long()
-        for i, input in enumerate(inputs):
-            padded_sesss[i,:inputs_len[i]] = torch.LongTensor(input)
-            
-        padded_sesss = padded_sesss.transpose(0, 1)
-        return padded_sesss, torch.LongTensor(targets), inputs_len
-        
-        
+        inputs, targets = pack_sessions(self.items, self.offsets[i], self.lens[i]), self.targets[i]
+        return inputs, torch.LongTensor(targets)
+
+
+class Sessions(Data):
+    """Training data of the prefix sharing mode, see NARM.forward.
+
+    Holds whole sessions instead of their prefixes, so batches are drawn and
+    shuffled by session: items, offsets and lens are those of the sessions
+    and targets the session ids, which index the positions of each session
+    that are training examples.
+    """
+    def __init__(self, data, shuffle=False):
+        sessions, positions = prefix_sessions(data[0], data[1])
+        self.items, self.offsets, self.lens = ragged(sessions)
+        self.positions, self.position_offsets, self.n_positions = ragged(positions)
+        self.targets = np.arange(len(sessions))
+        self.length = len(sessions)
+        self.n_examples = len(data[0])
+        self.shuffle = shuffle
+
+    def get_slice(self, i):
+        offsets, lens, sids = self.offsets[i], self.lens[i], self.targets[i]
+        # the last item of a session is only a target
+        inputs = pack_sessions(self.items, offsets, lens - 1)
+        n_positions = self.n_positions[sids]
+        positions = gather(self.positions, self.position_offsets[sids], n_positions)
+        rows = np.repeat(np.arange(len(sids)), n_positions)
+        targets = self.items[offsets[rows] + positions + 1]
+        flat_positions = rows * (lens.max() - 1) + positions
+
+        return inputs, torch.LongTensor(targets), torch.LongTensor(flat_positions)
@@ -110,6 +110,35 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def session_graphs(inputs):
+    # the graphs of the padded sessions of a batch: the alias of every position in the unique items, the
+    # normalized in|out adjacency and the unique items, padded to the largest graph of the batch
+    items, n_node, A, alias_inputs = [], [], [], []
+    for u_input in inputs:
+        n_node.append(len(np.unique(u_input)))
+    max_n_node = np.max(n_node)
+    for u_input in inputs:
+        node = np.unique(u_input)
+        items.append(node.tolist() + (max_n_node - len(node)) * [0])
+        u_A = np.zeros((max_n_node, max_n_node))
+        for i in np.arange(len(u_input) - 1):
+            if u_input[i + 1] == 0:
+                break
+            u = np.where(node == u_input[i])[0][0]
+            v = np.where(node == u_input[i + 1])[0][0]
+            u_A[u][v] = 1
+        u_sum_in = np.sum(u_A, 0)
+        u_sum_in[np.where(u_sum_in == 0)] = 1
+        u_A_in = np.divide(u_A, u_sum_in)
+        u_sum_out = np.sum(u_A, 1)
+        u_sum_out[np.where(u_sum_out == 0)] = 1
+        u_A_out = np.divide(u_A.transpose(), u_sum_out)
+        u_A = np.concatenate([u_A_in, u_A_out]).transpose()
+        A.append(u_A)
+        alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+    return alias_inputs, A, items
+
+
 class Data():
     def __init__(self, data, shuffle=False, graph=None):
         inputs = data[0]
@@ -138,27 +167,5 @@ class Data():
 
     def get_slice(self, i):
         inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+        alias_inputs, A, items = session_graphs(inputs)
         return alias_inputs, A, items, mask, targets
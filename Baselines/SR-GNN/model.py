@@ -15,7 +15,9 @@ from torch import nn
 from torch.nn import Module, Parameter
 import torch.nn.functional as F
 
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 
 
 
@@ -111,30 +113,25 @@ class SessionGraph(Module):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 def find_mixup_srcs(tail_idxs, overlap_A, batch_size):
     with torch.no_grad():
+        overlap_A = torch.as_tensor(overlap_A, dtype=torch.float)
     # construct tail mask
-        tail_masks = torch.zeros(batch_size)
+        tail_masks = torch.zeros(batch_size, device=overlap_A.device)
         tail_masks[tail_idxs] = 1
 
         # eliminate self loop
-        A_hat2 = torch.FloatTensor(overlap_A) - torch.eye(batch_size)
+        A_hat2 = overlap_A - torch.eye(batch_size, device=overlap_A.device)
         tails_overlap = tail_masks.view(-1, 1) * A_hat2
 
         # select nonzero max weight session
-        mixup_sess_idxs = torch.max(tails_overlap, axis=1)[1]
+        mixup_sess_idxs = torch.max(tails_overlap, axis=1)[1].cpu()
         srcs = torch.nonzero(mixup_sess_idxs)
         mixup_sess_srcs1 = torch.cat([srcs, mixup_sess_idxs[srcs]], axis=1)
 
@@ -155,10 +152,10 @@ def mixup_criterion(criterion, pred, y_a, y_b, lam):
 
 def forward(model, i, data, lam=0.5, train=True, mixup=False):
     alias_inputs, A, items, mask, targets, num_augs = data.get_slice(i,  mixup=True)
-    if mixup:
-        overlap_A, _ = data.get_overlap(items)
     alias_inputs = trans_to_cuda(torch.Tensor(np.array(alias_inputs)).long())
     items = trans_to_cuda(torch.Tensor(np.array(items)).long())
+    if mixup:
+        overlap_A, _ = data.get_overlap(items)
     A = trans_to_cuda(torch.Tensor(np.array(A)).float())
     mask = trans_to_cuda(torch.Tensor(mask).long())
 
@@ -237,25 +234,22 @@ def train_test(model, train_data, test_data, mixup, n_node,  lam, Ks=[10, 20]):
 
     print('\t\tTotal Loss: %.3f \tTotal # Augs : %d' % (total_loss, total_num_augs))
 
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, Ks)
+
 
+def evaluate(model, test_data, n_node, Ks=[10, 20]):
     print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-    slices = test_data.generate_batch(model.batch_size)
-    for i in slices:
+
+    def score(i):
         targets, scores,  num_augs = forward(model, i, test_data,  lam=None, train=False,
                                                                  mixup=False)
+        return targets, scores
 
-
-        eval10 = get_metric_scores(scores, targets, Ks[0],  eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1],   eval20)
-
-    t = time.time() - epoch_start_eval
-
-    results = metric_print(eval10, eval20, n_node, t)
-
-
-    return loss, results
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
 
 
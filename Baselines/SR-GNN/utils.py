@@ -9,6 +9,7 @@ Modified on January, 2022
 
 import networkx as nx
 import numpy as np
+import torch
 import random
 
 
@@ -162,6 +163,35 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def session_graphs(inputs):
+    # the graphs of the padded sessions of a batch: the alias of every position in the unique items, the
+    # normalized in|out adjacency and the unique items, padded to the largest graph of the batch
+    items, n_node, A, alias_inputs = [], [], [], []
+    for u_input in inputs:
+        n_node.append(len(np.unique(u_input)))
+    max_n_node = np.max(n_node)
+    for u_input in inputs:
+        node = np.unique(u_input)
+        items.append(node.tolist() + (max_n_node - len(node)) * [0])
+        u_A = np.zeros((max_n_node, max_n_node))
+        for i in np.arange(len(u_input) - 1):
+            if u_input[i + 1] == 0:
+                break
+            u = np.where(node == u_input[i])[0][0]
+            v = np.where(node == u_input[i + 1])[0][0]
+            u_A[u][v] = 1
+        u_sum_in = np.sum(u_A, 0)
+        u_sum_in[np.where(u_sum_in == 0)] = 1
+        u_A_in = np.divide(u_A, u_sum_in)
+        u_sum_out = np.sum(u_A, 1)
+        u_sum_out[np.where(u_sum_out == 0)] = 1
+        u_A_out = np.divide(u_A.transpose(), u_sum_out)
+        u_A = np.concatenate([u_A_in, u_A_out]).transpose()
+        A.append(u_A)
+        alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+    return alias_inputs, A, items
+
+
 class Data():
     def __init__(self, data, batch_aug, mixup, shuffle=False):
         inputs = data[0]
@@ -176,20 +206,27 @@ class Data():
         self.mixup = mixup
     
     def get_overlap(self, sessions):
-        matrix = np.zeros((len(sessions), len(sessions)))
-        for i in range(len(sessions)):
-            seq_a = set(sessions[i])
-            seq_a.discard(0)
-            for j in range(i+1, len(sessions)):
-                seq_b = set(sessions[j])
-                seq_b.discard(0)
-                overlap = seq_a.intersection(seq_b)
-                ab_set = seq_a | seq_b
-                matrix[i][j] = float(len(overlap))/float(len(ab_set))
-                matrix[j][i] = matrix[i][j]
-        matrix = matrix + np.diag([1.0]*len(sessions))
-        degree = np.sum(np.array(matrix), 1)
-        degree = np.diag(1.0/degree)
+        # jaccard overlap between the sessions of a batch, computed on the device of `sessions`
+        # intersection : S @ S^T of the (session x item) multi-hot matrix S
+        # union        : |a| + |b| - |a & b|
+        if not torch.is_tensor(sessions):
+            sessions = torch.as_tensor(np.asarray(sessions))
+        n_sess = sessions.shape[0]
+        rows, cols = torch.nonzero(sessions, as_tuple=True)
+        items, cols = torch.unique(sessions[rows, cols], return_inverse=True)
+        n_items = max(len(items), 1)
+        # an item repeated inside a session counts once
+        keys = torch.unique(rows * n_items + cols)
+        indices = torch.stack([keys // n_items, keys % n_items])
+        values = torch.ones(indices.shape[1], device=sessions.device)
+        multi_hot = torch.sparse_coo_tensor(indices, values, (n_sess, n_items))
+
+        overlap = torch.sparse.mm(multi_hot, multi_hot.t().to_dense())
+        sizes = torch.diagonal(overlap)
+        union = sizes.view(-1, 1) + sizes.view(1, -1) - overlap
+        matrix = torch.where(union > 0, overlap / union.clamp(min=1), torch.zeros_like(overlap))
+        matrix.fill_diagonal_(1.0)
+        degree = torch.diag(1.0 / torch.sum(matrix, 1))
         return matrix, degree
 
     def generate_batch(self, batch_size):
@@ -231,29 +268,7 @@ class Data():
                 targets = np.concatenate([targets, aug_targets], axis=0)
 
             # print(f"after augmentation # sessions : {len(targets)}")
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+        alias_inputs, A, items = session_graphs(inputs)
         
         
         return alias_inputs, A, items, mask, targets, num_augs
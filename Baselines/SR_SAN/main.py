@@ -1,7 +1,17 @@
 import argparse
 import pickle
 import time
+import os
+import sys
+# the repository root, home of the shared package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from utils import *
+from shared.checkpoint import CheckpointManager
+from shared.async_eval import AsyncEvaluator
+from shared import runtime
+from shared import evaluation
+from shared.telemetry import Telemetry
+from shared.profiling import Profiler
 from model import *
 
 parser = argparse.ArgumentParser()
@@ -17,17 +27,45 @@ parser.add_argument('--lr_dc', type=float, default=0.1, help='learning rate deca
 parser.add_argument('--lr_dc_step', type=int, default=3, help='the number of steps after which the learning rate decay')
 parser.add_argument('--l2', type=float, default=1e-5, help='l2 penalty')  # [0.001, 0.0005, 0.0001, 0.00005, 0.00001]
 parser.add_argument('--patience', type=int, default=10, help='the number of epoch to wait before early stop ')
+parser.add_argument('--causal', action='store_true', help='encode whole sessions once with a causal attention mask and read out every prefix, in training and evaluation; --batchSize counts sessions')
 parser.add_argument('--validation', action='store_true', help='validation')
 parser.add_argument('--valid_portion', type=float, default=0.1, help='split the portion of training set as validation set')
 parser.add_argument('--gpu_num', type = int, default = 0, help = 'cuda number')
+parser.add_argument('--device', default='auto', help='device to train on: auto (cuda when available), cpu, cuda, cuda:N or mps')
+parser.add_argument('--threads', type=int, default=0, help='intra-op cpu threads, 0 for the torch default or one per pinned core')
+parser.add_argument('--interop_threads', type=int, default=0, help='inter-op cpu threads, 0 for the torch default')
+parser.add_argument('--cores', default=None, help='cpu cores to pin the process to, e.g. 0-7,16')
 parser.add_argument('--mixup', type=bool, default=False, help='tail mixup')
 parser.add_argument('--lam', type=float, default=0.6, help='mixup ratio')
 parser.add_argument('--batch_aug', type=bool, default=False, help='batch graph augmentation')
 parser.add_argument('--save_model', type=bool, default=True)
+parser.add_argument('--resume', default=None, help='path of a last.pt checkpoint to resume training from')
+parser.add_argument('--ckpt_metric', default='HR@20', help='metric ranking the kept checkpoints: HR/MRR/Cov@10/20')
+parser.add_argument('--ckpt_keep', type=int, default=3, help='the number of best checkpoints to keep, at least 1')
+parser.add_argument('--ckpt_half', action='store_true', help='store the kept checkpoints in fp16')
+parser.add_argument('--async_eval', action='store_true', help='evaluate every epoch in a separate process while the next one trains')
+parser.add_argument('--eval_lag', type=int, default=1, help='the number of epochs the evaluation may lag behind training')
+parser.add_argument('--eval_threads', type=int, default=0, help='cpu threads of the evaluation process, 0 for a quarter of the cores')
+parser.add_argument('--eval_batch_size', type=int, default=0, help='batch size of the evaluation, 0 for the training batch size')
+parser.add_argument('--eval_cache', default='mmap', choices=['mmap', 'memory', 'off'], help='keep the test batches built at the first evaluation for the later ones, memory-mapped from a temporary file or in memory')
+parser.add_argument('--eval_ckpt', default=None, help='path of a saved checkpoint ({epoch}.pt or last.pt) to evaluate without training')
+parser.add_argument('--telemetry_dir', default='telemetry', help='directory of the stage timing records')
+parser.add_argument('--telemetry_every', type=int, default=100, help='write a timing record every this many steps, 0 for epoch records only')
+parser.add_argument('--telemetry_sync', action='store_true', help='synchronize cuda at stage boundaries for exact gpu stage times')
+parser.add_argument('--tracemalloc', action='store_true', help='trace the python allocations of get_slice, create_aug_sessions and get_metric_scores')
+parser.add_argument('--telemetry_tensors', action='store_true', help='list the largest live tensors at every new memory peak, walks all python objects')
+parser.add_argument('--profile', action='store_true', help='profile a window of training steps with torch.profiler')
+parser.add_argument('--profile_dir', default='profile', help='directory of the profiler runs')
+parser.add_argument('--profile_wait', type=int, default=5, help='the number of steps skipped before profiling')
+parser.add_argument('--profile_warmup', type=int, default=2, help='the number of profiler warmup steps')
+parser.add_argument('--profile_active', type=int, default=5, help='the number of profiled steps')
+parser.add_argument('--profile_repeat', type=int, default=1, help='the number of profiling windows, 0 for all of training')
+parser.add_argument('--profile_stack', action='store_true', help='record python stacks in the profile')
 opt = parser.parse_args()
 print(opt)
 
-torch.cuda.set_device(opt.gpu_num)
+runtime.setup(opt.device, opt.gpu_num, opt.threads, opt.interop_threads, opt.cores)
+evaluation.configure(opt.eval_batch_size, opt.eval_cache)
 if opt.save_model:
     os.makedirs(f'ckpt/{opt.dataset}', exist_ok=True)
 
@@ -38,8 +76,15 @@ def main():
 
     #ht_dict = pickle.load(open(f'../../Dataset/{opt.dataset}/ht_dict.pickle', 'rb'))
 
-    train_data = Data(train_data, opt.batch_aug, opt.mixup, shuffle=True)
-    test_data = Data(test_data, batch_aug=False, mixup=False, shuffle=False)
+    if opt.causal:
+        if opt.mixup or opt.batch_aug:
+            parser.error('--causal trains on whole sessions, without --mixup and --batch_aug')
+        train_data = Sessions(train_data, shuffle=True)
+        test_data = Sessions(test_data, shuffle=False)
+        print(f'Causal: {train_data.n_examples} training examples in {train_data.length} sessions')
+    else:
+        train_data = Data(train_data, opt.batch_aug, opt.mixup, shuffle=True)
+        test_data = Data(test_data, batch_aug=False, mixup=False, shuffle=False)
 
     if 'retailrocket' in opt.dataset:
         n_node = 27413
@@ -50,31 +95,75 @@ def main():
     elif 'yoochoose' in opt.dataset:
         n_node = 37484
     else:
-        print("no dataset")
+        # generated datasets store their item count, see benchmark/synthetic.py
+        n_node = pickle.load(open(f'../../Dataset/{opt.dataset}/n_node.txt', 'rb'))
 
 
     model = trans_to_cuda(SelfAttentionNetwork(opt, n_node))
+    if opt.eval_ckpt:
+        evaluation.load(opt.eval_ckpt, model)
+        evaluate(model, test_data, n_node)
+        return
 
     start = time.time()
     best_results = [[0 for i in range(8)] for j in range(2)]
     best_epochs = [[0 for i in range(8)] for j in range(2)]
     bad_counter = 0
-    for epoch in range(opt.epoch):
+    ckpt = CheckpointManager(f'ckpt/{opt.dataset}', opt.ckpt_metric, opt.ckpt_keep, opt.ckpt_half)
+    ckpt.track(train_data)
+    start_epoch = 0
+    if opt.resume:
+        state = ckpt.resume(opt.resume, model)
+        start_epoch, bad_counter = state['epoch'] + 1, state['bad_counter']
+        best_results[:], best_epochs[:] = state['best_results'], state['best_epochs']
+    evaluator = None
+    if opt.async_eval:
+        evaluator = AsyncEvaluator(model, evaluate, test_data, n_node,
+                                   max_lag=opt.eval_lag, threads=opt.eval_threads)
+    # hooked after the evaluator copied the model, so its process runs without them
+    telemetry = Telemetry(f'{opt.telemetry_dir}/{opt.dataset}', model, opt.telemetry_every, opt.telemetry_sync,
+                          opt.tracemalloc, opt.telemetry_tensors)
+    telemetry.watch(train_data, test_data)
+    profiler = None
+    if opt.profile:
+        profiler = Profiler(f'{opt.profile_dir}/{opt.dataset}', model, opt.profile_wait, opt.profile_warmup,
+                            opt.profile_active, opt.profile_repeat, opt.profile_stack)
+        profiler.watch(train_data, test_data)
+    for epoch in range(start_epoch, opt.epoch):
         print('-------------------------------------------------------')
         print('epoch: ', epoch)
-        loss, results = train_test(model, train_data, test_data, opt.mixup, n_node, opt.lam)
-        flag = get_best_result(results, epoch, best_results, best_epochs)
+        telemetry.start_epoch(epoch)
+        loss, results = train_test(model, train_data, test_data if evaluator is None else None, opt.mixup, n_node, opt.lam)
+        telemetry.end_epoch()
 
-        if flag > 0 :
-            if opt.save_model == True:
-                model_save_path = f'ckpt/{opt.dataset}/{epoch}.pt'
-                torch.save(model.state_dict(), model_save_path)
-                print("Model Saving Done")
+        if evaluator is None:
+            finished = [(epoch, results, None)]
         else:
-            bad_counter += 1
-            if bad_counter >= opt.patience:
-                break
+            finished = evaluator.submit(epoch, ckpt.capture(epoch, model))
+
+        stop = False
+        for epoch_done, results, state in finished:
+            flag = get_best_result(results, epoch_done, best_results, best_epochs)
+            # patience counts the epochs without improvement, training stops after the one that reaches it
+            if flag <= 0 and not stop:
+                bad_counter += 1
+                stop = bad_counter >= opt.patience
+            if opt.save_model == True:
+                ckpt.save(epoch_done, results, model, bad_counter, best_results, best_epochs, state)
+        if stop:
+            break
+
+    if evaluator is not None:
+        # evaluations still running when training stops only update the best results
+        for epoch_done, results, state in evaluator.close():
+            get_best_result(results, epoch_done, best_results, best_epochs)
+            if opt.save_model == True:
+                ckpt.save(epoch_done, results, model, bad_counter, best_results, best_epochs, state)
 
+    if profiler is not None:
+        profiler.close()
+    telemetry.close()
+    ckpt.close()
     print('-' * 100)
     end = time.time()
     print("Run time: %f s" % (end - start))
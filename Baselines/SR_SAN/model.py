@@ -9,6 +9,9 @@ from torch.nn import TransformerEncoder
 from torch.nn import TransformerEncoderLayer
 import time
 from utils import *
+from shared import runtime
+from shared import evaluation
+from shared.sessions import prefix_hidden
 
 class SelfAttentionNetwork(Module):
     def __init__(self, opt, n_node):
@@ -17,7 +20,8 @@ class SelfAttentionNetwork(Module):
         self.n_node = n_node
         self.batch_size = opt.batchSize
         self.embedding = nn.Embedding(self.n_node, self.hidden_size)
-        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward)
+        # batch first, so that evaluation takes the nested tensor fast path and skips the padded item slots
+        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward, batch_first=True)
         self.transformerEncoder = TransformerEncoder(self.transformerEncoderLayer, opt.layer)
 
         self.linear_one = nn.Linear(self.hidden_size, self.hidden_size, bias=True)
@@ -38,7 +42,9 @@ class SelfAttentionNetwork(Module):
     def session_encoding(self, hidden, alias_inputs, mask):
         get = lambda i: hidden[i][alias_inputs[i]]
         seq_hidden = torch.stack([get(i) for i in torch.arange(len(alias_inputs)).long()])
+        return self.readout(seq_hidden, mask)
 
+    def readout(self, seq_hidden, mask):
         ht = seq_hidden[torch.arange(mask.shape[0]).long(), torch.sum(mask, 1) - 1]  # batch_size x latent_size
         q1 = self.linear_one(ht).view(ht.shape[0], 1, ht.shape[1])  # batch_size x 1 x latent_size
         q2 = self.linear_two(seq_hidden)  # batch_size x seq_length x latent_size
@@ -54,39 +60,38 @@ class SelfAttentionNetwork(Module):
         scores = torch.matmul(a, b.transpose(1, 0))
         return scores
 
-    def forward(self, inputs, A):
+    def forward(self, inputs, key_padding_mask=None, causal=False):
         hidden = self.embedding(inputs)
-        hidden = hidden.transpose(0,1).contiguous()
-        hidden = self.transformerEncoder(hidden)
-        hidden = hidden.transpose(0,1).contiguous()
+        if causal:
+            # inputs are whole sessions, every position attends to itself and the positions before it
+            size = inputs.size(1)
+            causal_mask = torch.ones(size, size, dtype=torch.bool, device=inputs.device).triu(1)
+            hidden = self.transformerEncoder(hidden, mask=causal_mask)
+        else:
+            hidden = self.transformerEncoder(hidden, src_key_padding_mask=key_padding_mask)
         return hidden
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def find_mixup_srcs(tail_idxs, overlap_A, batch_size):
     with torch.no_grad():
+        overlap_A = torch.as_tensor(overlap_A, dtype=torch.float)
         # construct tail mask
-        tail_masks = torch.zeros(batch_size)
+        tail_masks = torch.zeros(batch_size, device=overlap_A.device)
         tail_masks[tail_idxs] = 1
 
         # eliminate self loop
-        A_hat2 = torch.FloatTensor(overlap_A) - torch.eye(batch_size)
+        A_hat2 = overlap_A - torch.eye(batch_size, device=overlap_A.device)
         tails_overlap = tail_masks.view(-1, 1) * A_hat2
 
         # select nonzero max weight session
-        mixup_sess_idxs = torch.max(tails_overlap, axis=1)[1]
+        mixup_sess_idxs = torch.max(tails_overlap, axis=1)[1].cpu()
         srcs = torch.nonzero(mixup_sess_idxs)
         mixup_sess_srcs1 = torch.cat([srcs, mixup_sess_idxs[srcs]], axis=1)
 
@@ -114,15 +119,14 @@ def mixup_criterion(criterion, pred, y_a, y_b, lam):
 
 
 def forward(model, i, data,   lam=0.6, train=True, mixup=True):
-    alias_inputs, A, items, mask, targets = data.get_slice(i,  mixup=True)
-    if mixup:
-        overlap_A, _ = data.get_overlap(items)
-
+    alias_inputs, items, key_padding_mask, mask, targets = data.get_slice(i,  mixup=True)
     alias_inputs = trans_to_cuda(torch.Tensor(alias_inputs).long())
     items = trans_to_cuda(torch.Tensor(items).long())
-    A = trans_to_cuda(torch.Tensor(A).float())
+    if mixup:
+        overlap_A, _ = data.get_overlap(items)
+    key_padding_mask = trans_to_cuda(torch.Tensor(key_padding_mask).bool())
     mask = trans_to_cuda(torch.Tensor(mask).long())
-    hidden = model(items, A)
+    hidden = model(items, key_padding_mask)
     feats = model.session_encoding(hidden, alias_inputs, mask)
 
     if not train:
@@ -144,6 +148,17 @@ def forward(model, i, data,   lam=0.6, train=True, mixup=True):
         scores = model.compute_scores(feats)
         return targets, scores
 
+
+def forward_sessions(model, i, data):
+    # the predictions of all examples of a batch of whole sessions, see Sessions in utils.py: the session
+    # is encoded once and the prefix ending at t is read out from the positions up to t
+    inputs, mask, positions, targets = data.get_slice(i)
+    inputs = trans_to_cuda(torch.Tensor(inputs).long())
+    positions = trans_to_cuda(torch.Tensor(positions).long())
+    hidden, prefix_mask = prefix_hidden(model(inputs, None, causal=True), positions)
+    return targets, model.compute_scores(model.readout(hidden, prefix_mask))
+
+
 def train_test(model, train_data, test_data, mixup, n_node,  lam, Ks = [10, 20]):
     epoch_start_train = time.time()
     print('start training: ', datetime.datetime.now())
@@ -166,6 +181,11 @@ def train_test(model, train_data, test_data, mixup, n_node,  lam, Ks = [10, 20])
             t_loss = mixup_criterion(model.loss_function, tail_logits, targets_a-1, targets_b-1, lam)
             loss = h_loss + t_loss
 
+        elif isinstance(train_data, Sessions):
+            targets, scores = forward_sessions(model, i, train_data)
+            targets = trans_to_cuda(torch.Tensor(targets).long())
+            loss = model.loss_function(scores, targets - 1)
+
         else:
             targets, scores= forward(model, i, train_data, lam=None, train=True, mixup=False)
             targets = trans_to_cuda(torch.Tensor(targets).long())
@@ -182,25 +202,21 @@ def train_test(model, train_data, test_data, mixup, n_node,  lam, Ks = [10, 20])
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, Ks)
 
 
-    slices = test_data.generate_batch(model.batch_size)
+def evaluate(model, test_data, n_node, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
-    for i in slices:
+    def score(i):
+        if isinstance(test_data, Sessions):
+            return forward_sessions(model, i, test_data)
         targets, logits = forward(model, i, test_data, lam=None, train=False, mixup=False)
-        #  scores, targets, test_data, k, pop_dict, ht_dict, test_label_dict, hit_label, mrr_label, eval
-
-        eval10 = get_metric_scores(logits, targets, Ks[0],   eval10)
-        eval20 = get_metric_scores(logits, targets, Ks[1],   eval20)
-        # eval10 = get_metric_scores(logits, targets, test_data, Ks[0], eval10)
-        # eval20 = get_metric_scores(logits, targets, test_data, Ks[1], eval20)
-
-    t = time.time() - epoch_start_eval
-
-    results = metric_print(eval10, eval20, n_node, t)
+        return targets, logits
 
-    return loss, results
\ No newline at end of file
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
@@ -1,9 +1,11 @@
 import numpy as np
+import torch
 import os
 import pickle
 from collections import Counter
 import networkx as nx
 import random
+from shared.sessions import PaddedSessions
 
 def get_metric_scores(scores, targets, k, eval):
     # eval : hit, mrr, cov, arp, tail, tailcov
@@ -181,6 +183,24 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def session_items(inputs):
+    # the unique items of the padded sessions of a batch, padded to the most of the batch, the alias of every
+    # position in them and the key padding mask of the padded item slots. SR_SAN attends over the items of a
+    # session, it needs no session graph
+    inputs = np.asarray(inputs)
+    base = inputs.max() + 1
+    # unique (row, item) pairs, sorted by row and then item like np.unique of every row
+    unique, inverse = np.unique(inputs + base * np.arange(len(inputs))[:, None], return_inverse=True)
+    rows = unique // base
+    n_node = np.bincount(rows, minlength=len(inputs))
+    starts = np.cumsum(n_node) - n_node
+    items = np.zeros((len(inputs), n_node.max()), dtype=inputs.dtype)
+    items[rows, np.arange(len(unique)) - starts[rows]] = unique % base
+    alias_inputs = inverse.reshape(inputs.shape) - starts[:, None]
+    key_padding_mask = np.arange(n_node.max()) >= n_node[:, None]
+    return alias_inputs, items, key_padding_mask
+
+
 class Data():
     def __init__(self, data, batch_aug, mixup, shuffle=False):
         inputs = data[0]
@@ -196,20 +216,27 @@ class Data():
 
 
     def get_overlap(self, sessions):
-        matrix = np.zeros((len(sessions), len(sessions)))
-        for i in range(len(sessions)):
-            seq_a = set(sessions[i])
-            seq_a.discard(0)
-            for j in range(i+1, len(sessions)):
-                seq_b = set(sessions[j])
-                seq_b.discard(0)
-                overlap = seq_a.intersection(seq_b)
-                ab_set = seq_a | seq_b
-                matrix[i][j] = float(len(overlap))/float(len(ab_set))
-                matrix[j][i] = matrix[i][j]
-        matrix = matrix + np.diag([1.0]*len(sessions))
-        degree = np.sum(np.array(matrix), 1)
-        degree = np.diag(1.0/degree)
+        # jaccard overlap between the sessions of a batch, computed on the device of `sessions`
+        # intersection : S @ S^T of the (session x item) multi-hot matrix S
+        # union        : |a| + |b| - |a & b|
+        if not torch.is_tensor(sessions):
+            sessions = torch.as_tensor(np.asarray(sessions))
+        n_sess = sessions.shape[0]
+        rows, cols = torch.nonzero(sessions, as_tuple=True)
+        items, cols = torch.unique(sessions[rows, cols], return_inverse=True)
+        n_items = max(len(items), 1)
+        # an item repeated inside a session counts once
+        keys = torch.unique(rows * n_items + cols)
+        indices = torch.stack([keys // n_items, keys % n_items])
+        values = torch.ones(indices.shape[1], device=sessions.device)
+        multi_hot = torch.sparse_coo_tensor(indices, values, (n_sess, n_items))
+
+        overlap = torch.sparse.mm(multi_hot, multi_hot.t().to_dense())
+        sizes = torch.diagonal(overlap)
+        union = sizes.view(-1, 1) + sizes.view(1, -1) - overlap
+        matrix = torch.where(union > 0, overlap / union.clamp(min=1), torch.zeros_like(overlap))
+        matrix.fill_diagonal_(1.0)
+        degree = torch.diag(1.0 / torch.sum(matrix, 1))
         return matrix, degree
 
 
@@ -248,28 +275,10 @@ class Data():
                 targets = np.concatenate([targets, aug_targets], axis=0)
 
             # print(f"after augmentation # sessions : {len(targets)}")
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
-
-        return alias_inputs, A, items, mask, targets
\ No newline at end of file
+        alias_inputs, items, key_padding_mask = session_items(inputs)
+
+        return alias_inputs, items, key_padding_mask, mask, targets
+
+
+class Sessions(PaddedSessions, Data):
+    """Data of the causal mode, see SelfAttentionNetwork.forward and PaddedSessions."""
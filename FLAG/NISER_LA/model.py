@@ -16,7 +16,9 @@ from torch.nn import Module, Parameter
 import torch.nn.functional as F
 from tqdm import tqdm
 import time
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 
 
 class GNN(Module):
@@ -129,17 +131,11 @@ class SessionGraph(Module):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def logit_avg(score, targets, top_labels_sidx):
@@ -222,18 +218,19 @@ def train_test(model, train_data, test_data, n_node, top_labels, step_size=8e-3,
     
     print('\t Total Loss:\t%.3f' % total_loss)
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-    slices = test_data.generate_batch(model.batch_size)
-    for i in slices:
-        targets, scores = forward(model, i, test_data, top_labels, step_size, train=False)
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, top_labels, step_size, Ks)
 
-        eval10 = get_metric_scores(scores, targets, Ks[0], eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1], eval20)
 
-    t = time.time() - epoch_start_eval
-    results = metric_print(eval10, eval20, n_node, t)
+def evaluate(model, test_data, n_node, top_labels, step_size=8e-3, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
+
+    def score(i):
+        targets, scores = forward(model, i, test_data, top_labels, step_size, train=False)
+        return targets, scores
 
-    return loss, results
\ No newline at end of file
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
@@ -15,7 +15,9 @@ from torch import nn
 from torch.nn import Module, Parameter
 import torch.nn.functional as F
 
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 import copy
 
 
@@ -115,17 +117,11 @@ class SessionGraph(Module):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def logit_avg(score, targets, top_labels_sidx):
@@ -218,24 +214,21 @@ def train_test(model, train_data, test_data, n_node, top_labels, step_size = 8e-
 
     print('\t\tTotal Loss: %.3f \tTotal # Augs : %d' % (total_loss, total_num_augs))
 
-
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-    slices = test_data.generate_batch(model.batch_size)
-    for i in slices:
-        targets, _ ,_,scores= forward(model, i, test_data, top_labels, step_size, train = False)
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, top_labels, step_size, Ks)
 
 
-        eval10 = get_metric_scores(scores, targets, Ks[0],  eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1],   eval20)
-
-    t = time.time() - epoch_start_eval
-
-    results = metric_print(eval10, eval20, n_node, t)
+def evaluate(model, test_data, n_node, top_labels, step_size=8e-3, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
+    def score(i):
+        targets, _ ,_,scores= forward(model, i, test_data, top_labels, step_size, train = False)
+        return targets, scores
 
-    return loss, results
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
 
 
@@ -9,6 +9,8 @@ from torch.nn import TransformerEncoder
 from torch.nn import TransformerEncoderLayer
 import time
 from utils import *
+from shared import runtime
+from shared import evaluation
 
 class SelfAttentionNetwork(Module):
     def __init__(self, opt, n_node):
@@ -17,7 +19,8 @@ class SelfAttentionNetwork(Module):
         self.n_node = n_node
         self.batch_size = opt.batchSize
         self.embedding = nn.Embedding(self.n_node, self.hidden_size)
-        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward)
+        # batch first, so that evaluation takes the nested tensor fast path and skips the padded item slots
+        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward, batch_first=True)
         self.transformerEncoder = TransformerEncoder(self.transformerEncoderLayer, opt.layer)
 
         self.linear_one = nn.Linear(self.hidden_size, self.hidden_size, bias=True)
@@ -54,25 +57,17 @@ class SelfAttentionNetwork(Module):
         scores = torch.matmul(a, b.transpose(1, 0))
         return scores
 
-    def forward(self, inputs, A):
+    def forward(self, inputs, key_padding_mask=None):
         hidden = self.embedding(inputs)
-        hidden = hidden.transpose(0,1).contiguous()
-        hidden = self.transformerEncoder(hidden)
-        hidden = hidden.transpose(0,1).contiguous()
+        hidden = self.transformerEncoder(hidden, src_key_padding_mask=key_padding_mask)
         return hidden
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 def flag(model_forward, feats, targets, step_size, m=3):
     model, forward = model_forward
@@ -99,12 +94,12 @@ def flag(model_forward, feats, targets, step_size, m=3):
 
 
 def forward(model, i, data,step_size, train):
-    alias_inputs, A, items, mask, targets = data.get_slice(i)
+    alias_inputs, items, key_padding_mask, mask, targets = data.get_slice(i)
     alias_inputs = trans_to_cuda(torch.Tensor(alias_inputs).long())
     items = trans_to_cuda(torch.Tensor(items).long())
-    A = trans_to_cuda(torch.Tensor(A).float())
+    key_padding_mask = trans_to_cuda(torch.Tensor(key_padding_mask).bool())
     mask = trans_to_cuda(torch.Tensor(mask).long())
-    hidden = model(items, A)
+    hidden = model(items, key_padding_mask)
 
     feats = model.session_encoding(hidden, alias_inputs, mask)
     if not train:
@@ -136,25 +131,19 @@ def train_test(model, train_data, test_data, n_node, step_size = 8e-3,  lam=1, K
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, step_size, Ks)
 
 
-    slices = test_data.generate_batch(model.batch_size)
+def evaluate(model, test_data, n_node, step_size=8e-3, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
-    for i in slices:
+    def score(i):
         targets,_, scores = forward(model, i, test_data, step_size, train=False)
-        #  scores, targets, test_data, k, pop_dict, ht_dict, test_label_dict, hit_label, mrr_label, eval
-
-        eval10 = get_metric_scores(scores, targets, Ks[0],   eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1],   eval20)
-        # eval10 = get_metric_scores(logits, targets, test_data, Ks[0], eval10)
-        # eval20 = get_metric_scores(logits, targets, test_data, Ks[1], eval20)
-
-    t = time.time() - epoch_start_eval
-
-    results = metric_print(eval10, eval20, n_node, t)
+        return targets, scores
 
-    return loss, results
\ No newline at end of file
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
@@ -8,7 +8,9 @@ from torch import nn
 from torch.nn import Module, Parameter
 import torch.nn.functional as F
 import time
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 from agc import AGC
 
 class Attention_GNN(Module):
@@ -68,7 +70,7 @@ class Attention_SessionGraph(Module):
 
         self.layer_norm1 = nn.LayerNorm(self.hidden_size)
         self.attn = nn.MultiheadAttention(
-            embed_dim=self.hidden_size, num_heads=2, dropout=0.1)
+            embed_dim=self.hidden_size, num_heads=2, dropout=0.1, batch_first=True)
 
         self.linear_one = nn.Linear(
             self.hidden_size, self.hidden_size, bias=True)
@@ -127,20 +129,25 @@ class Attention_SessionGraph(Module):
         scores = torch.sum(a * b, -1)  # batch_size x n_nodes
         return scores
 
-    def forward(self, inputs, A):
+    def forward(self, inputs, A, key_padding_mask=None):
         hidden = self.embedding(inputs)
         hidden = self.tagnn(A, hidden)
-        hidden = hidden.permute(1, 0, 2)
 
         skip = self.layer_norm1(hidden)
-        hidden, attn_w = self.attn(
-            hidden, hidden, hidden, attn_mask=get_mask(hidden.shape[0]))
+        # batch first, without the attention weights, takes the fused attention kernel at evaluation
+        hidden, _ = self.attn(
+            hidden, hidden, hidden, attn_mask=get_mask(hidden.shape[1]), key_padding_mask=key_padding_mask,
+            need_weights=False)
         hidden = hidden+skip
-        hidden = hidden.permute(1, 0, 2)
         return hidden
 
 def get_mask(seq_len):
-    return torch.from_numpy(np.triu(np.ones((seq_len, seq_len)), k=1).astype('bool')).to('cuda')
+    return torch.from_numpy(np.triu(np.ones((seq_len, seq_len)), k=1).astype('bool')).to(runtime.device())
+
+
+def item_padding_mask(alias_inputs, n_slots):
+    # the padded slots of the unique items of a batch, the ones past the largest alias of their session
+    return torch.arange(n_slots, device=alias_inputs.device) > alias_inputs.max(1, keepdim=True)[0]
 
 def flag(model_forward, feats, b, targets, step_size, m=3):
     model, forward = model_forward
@@ -171,7 +178,7 @@ def forward(model, i, data, step_size, train):
     A = trans_to_cuda(torch.Tensor(np.array(A)).float())
     mask = trans_to_cuda(torch.Tensor(mask).long())
 
-    hidden = model(items, A)
+    hidden = model(items, A, item_padding_mask(alias_inputs, items.size(1)))
     feats, b = model.session_encoding(hidden, alias_inputs,mask)
     if not train:
         targets = trans_to_cuda(torch.Tensor(targets).long())
@@ -188,17 +195,11 @@ def forward(model, i, data, step_size, train):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 
@@ -221,23 +222,19 @@ def train_test(model, train_data, test_data, n_node, step_size = 8e-3, lam=1, Ks
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, step_size, Ks)
 
-    slices = test_data.generate_batch(model.batch_size)
 
-    for i in slices:
-        targets, _, scores = forward(model, i, test_data,step_size, train=False)
-        #  scores, targets, test_data, k, pop_dict, ht_dict, test_label_dict, hit_label, mrr_label, eval
-
-        eval10 = get_metric_scores(scores, targets, Ks[0], eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1], eval20)
-
-
-    t = time.time() - epoch_start_eval
+def evaluate(model, test_data, n_node, step_size=8e-3, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
-    results = metric_print(eval10, eval20, n_node, t)
+    def score(i):
+        targets, _, scores = forward(model, i, test_data,step_size, train=False)
+        return targets, scores
 
-    return loss, results
\ No newline at end of file
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
@@ -2,17 +2,36 @@ import time
 import datetime
 import numpy as np
 
-import dgl
 import torch
 from torch import nn
+from torch.nn.utils.rnn import PackedSequence
 import torch.nn.functional as F
 from transformers import MobileBertForNextSentencePrediction
 
 from utils import AverageMeter, WarmupCosineLrScheduler, fix_weight_decay, get_metric_scores, metric_print
+from shared import runtime
+
+
+def segment_sum(x, segment, n_segments):
+    # sum of the rows of x per segment
+    return x.new_zeros((n_segments,) + x.shape[1:]).index_add(0, segment, x)
+
+
+def segment_softmax(x, segment, n_segments):
+    # softmax of x over the rows of each segment
+    index = segment.view((-1,) + (1,) * (x.dim() - 1)).expand_as(x)
+    top = x.new_zeros((n_segments,) + x.shape[1:]).scatter_reduce(0, index, x.detach(), 'amax', include_self=False)
+    e = torch.exp(x - top[segment])
+    return e / segment_sum(e, segment, n_segments)[segment]
+
 
 class EOPA(nn.Module):
-    def __init__(self, input_dim, output_dim, batch_norm=True, feat_drop=0.0, activation=None):
+    def __init__(self, input_dim, output_dim, batch_norm=True, feat_drop=0.0, activation=None, mailbox='bucket'):
         super().__init__()
+        if mailbox not in ('bucket', 'packed'):
+            raise ValueError(f'unknown mailbox {mailbox}, select bucket or packed')
+        # bucket runs the GRU once per in-degree like DGL's degree bucketing, packed once over all mailboxes
+        self.mailbox = mailbox
         self.batch_norm = nn.BatchNorm1d(input_dim) if batch_norm else None
         self.feat_drop = nn.Dropout(feat_drop)
         self.gru = nn.GRU(input_dim, input_dim, batch_first=True)
@@ -20,27 +39,33 @@ class EOPA(nn.Module):
         self.fc_neigh = nn.Linear(input_dim, output_dim, bias=False)
         self.activation = activation
 
-    def reducer(self, nodes):
-        m = nodes.mailbox['m']
-        _, hn = self.gru(m)
-        return {'neigh': hn.squeeze(0)}
+    def reducer(self, mg, ft):
+        # the last GRU state over the messages of the in-edges of every node in edge order, zero without in-edges
+        if self.mailbox == 'packed':
+            nodes, edges, batch_sizes = mg.packed_mailboxes()
+            _, hn = self.gru(PackedSequence(ft[mg.src[edges]], batch_sizes))
+            return ft.new_zeros(ft.shape).index_copy(0, nodes, hn.squeeze(0))
+        nodes, states = [], []
+        for bucket_nodes, edges in mg.in_degree_buckets():
+            _, hn = self.gru(ft[mg.src[edges]])
+            nodes.append(bucket_nodes)
+            states.append(hn.squeeze(0))
+        return ft.new_zeros(ft.shape).index_copy(0, torch.cat(nodes), torch.cat(states))
 
     def forward(self, mg, feat):
-        with mg.local_scope():
-            if self.batch_norm is not None:
-                feat = self.batch_norm(feat)
+        if self.batch_norm is not None:
+            feat = self.batch_norm(feat)
 
-            mg.ndata['ft'] = self.feat_drop(feat)
-            if mg.number_of_edges() > 0:
-                mg.update_all(dgl.function.copy_u('ft', 'm'), self.reducer)
-                neigh = mg.ndata['neigh']
-                rst = self.fc_self(feat) + self.fc_neigh(neigh)
-            else:
-                rst = self.fc_self(feat)
+        ft = self.feat_drop(feat)
+        if mg.number_of_edges() > 0:
+            neigh = self.reducer(mg, ft)
+            rst = self.fc_self(feat) + self.fc_neigh(neigh)
+        else:
+            rst = self.fc_self(feat)
 
-            if self.activation is not None:
-                rst = self.activation(rst)
-            return rst
+        if self.activation is not None:
+            rst = self.activation(rst)
+        return rst
 
 
 # graph level representation : sessions' global embedding
@@ -64,15 +89,15 @@ class AttnReadout(nn.Module):
         # Equation (13)
         feat_u = self.fc_u(feat)
         feat_v = self.fc_v(feat[last_nodes])
-        feat_v = dgl.broadcast_nodes(g, feat_v) # dgl.broadcast ?!
+        feat_v = feat_v[g.segment]
 
         # Equation (12)
         e = self.fc_e(torch.sigmoid(feat_u + feat_v))
-        beta = dgl.ops.segment.segment_softmax(g.batch_num_nodes(), e)
+        beta = segment_softmax(e, g.segment, g.batch_size)
 
         # Equation (11)
         feat_norm = feat * beta
-        rst = dgl.ops.segment.segment_reduce(g.batch_num_nodes(), feat_norm, 'sum')
+        rst = segment_sum(feat_norm, g.segment, g.batch_size)
 
         if self.fc_out is not None:
             rst = self.fc_out(rst)
@@ -83,7 +108,8 @@ class AttnReadout(nn.Module):
 
 
 class LESSR_part(nn.Module):
-    def __init__(self, num_items, embedding_dim, num_layers, device, batch_norm=True, feat_drop=0.0):
+    def __init__(self, num_items, embedding_dim, num_layers, device, batch_norm=True, feat_drop=0.0,
+                 mailbox='bucket'):
         super().__init__()
         self.embedding = nn.Embedding(num_items, embedding_dim, max_norm=1)
         self.indices = nn.Parameter(torch.arange(num_items, dtype=torch.long), requires_grad=False)
@@ -95,7 +121,7 @@ class LESSR_part(nn.Module):
 
         for i in range(num_layers):
             layer = EOPA(input_dim, embedding_dim, batch_norm=batch_norm,
-                         feat_drop=feat_drop, activation=nn.PReLU(embedding_dim))
+                         feat_drop=feat_drop, activation=nn.PReLU(embedding_dim), mailbox=mailbox)
 
             input_dim += embedding_dim
             self.layers.append(layer)
@@ -109,14 +135,14 @@ class LESSR_part(nn.Module):
         self.fc_sr = nn.Linear(input_dim, embedding_dim, bias=False)
 
     def forward(self, mg):
-        iid = mg.ndata['iid']
+        iid = mg.iid
         feat = self.embedding(iid)
 
         for i, layer in enumerate(self.layers):
             out = layer(mg, feat)
             feat = torch.cat([out, feat], dim=1)
 
-        last_nodes = mg.filter_nodes(lambda nodes: nodes.data['last'] == 1)
+        last_nodes = mg.last
         sr_g = self.readout(mg, feat, last_nodes)
         sr_l = feat[last_nodes]
 
@@ -136,17 +162,11 @@ class LESSR_part(nn.Module):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def mixup_criterion(pred, y_a, y_b, lam):
@@ -213,7 +233,13 @@ def train_test(model, Ks, train_loader, test_loader, n_iters_all, n_items, devic
         i += 1
     print('\t Total Loss:\t%.3f' % loss_meter.avg)
 
-    # eval
+    if test_loader is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_loader, Ks, n_items, device)
+
+
+def evaluate(model, test_loader, Ks, n_items, device):
     print("start predicting: ", datetime.datetime.now())
     epoch_start_eval = time.time()
     model.eval()
@@ -231,4 +257,4 @@ def train_test(model, Ks, train_loader, test_loader, n_iters_all, n_items, devic
         t = time.time() - epoch_start_eval
         results = metric_print(eval10, eval20, n_items, t)  
 
-    return loss, results  
+    return results
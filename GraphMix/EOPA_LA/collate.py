@@ -1,56 +1,121 @@
 from collections import Counter
+import functools
+import itertools
 import numpy as np
 import torch
-import dgl
 
-def label_last(g, last_nid):
-    is_last = torch.zeros(g.number_of_nodes(), dtype=torch.int32)
-    is_last[last_nid] = 1
-    g.ndata['last'] = is_last
-    return g
+class EOPGraph():
+    """A batch of EOP multigraphs as flat index tensors.
 
+    iid holds the item of every node, the nodes of a session contiguous and
+    the sessions in batch order. src and dst hold the edges, those of a
+    session in its order, last the node of the last item of every session,
+    batch_num_nodes the node count of every session and segment the session
+    of every node.
+    """
+    def __init__(self, iid, src, dst, last, batch_num_nodes, segment=None):
+        self.iid, self.src, self.dst, self.last = iid, src, dst, last
+        self.batch_num_nodes = batch_num_nodes
+        if segment is None:
+            segment = torch.repeat_interleave(torch.arange(len(batch_num_nodes)), batch_num_nodes)
+        self.segment = segment
+        self._packed = None
 
-def seq_to_eop_multigraph(seq):
-    items = np.unique(seq)
-    iid2nid = {iid: i for i, iid in enumerate(items)}
-    num_nodes = len(items)
+    @property
+    def batch_size(self):
+        return len(self.batch_num_nodes)
 
-    if len(seq) > 1:
-        seq_nid = [iid2nid[iid] for iid in seq]
-        src = seq_nid[:-1]
-        dst = seq_nid[1:]
+    def number_of_nodes(self):
+        return len(self.iid)
 
-    else:
-        src = torch.LongTensor([])
-        dst = torch.LongTensor([])
+    def number_of_edges(self):
+        return len(self.src)
 
-    g = dgl.graph((src, dst), num_nodes=num_nodes)
-    g.ndata['iid'] = torch.from_numpy(items)
-    label_last(g, iid2nid[seq[-1]])
-    return g
+    def to(self, device, non_blocking=False):
+        return EOPGraph(*(t.to(device, non_blocking=non_blocking) for t in
+                          (self.iid, self.src, self.dst, self.last, self.batch_num_nodes, self.segment)))
 
+    def in_degree_buckets(self):
+        """(nodes, edges) per in-degree, in increasing degree, nodes without in-edges left out.
 
-def collate_fn_factory(seq_to_graph, top_labels):
+        edges is (len(nodes), degree) and holds the in-edges of every node in
+        edge order, the mailboxes DGL's degree bucketing hands to a reducer.
+        """
+        n = self.number_of_nodes()
+        degree = torch.bincount(self.dst, minlength=n)
+        # edges grouped by the degree of their destination, then by destination, in edge order within
+        order = torch.argsort(degree[self.dst] * n + self.dst, stable=True)
+        degrees, counts = torch.unique(degree[degree > 0], return_counts=True)
+        buckets, start = [], 0
+        for d, count in zip(degrees.tolist(), counts.tolist()):
+            edges = order[start:start + d * count].view(count, d)
+            buckets.append((self.dst[edges[:, 0]], edges))
+            start += d * count
+        return buckets
 
-    def collate_fn(samples):
-        seqs, labels = zip(*samples)
+    def packed_mailboxes(self):
+        """(nodes, edges, batch_sizes), the mailboxes of all nodes as one packed sequence.
 
-        inputs = []
-        # make session graph for each sessions
-        graphs = list(map(seq_to_graph, seqs))
-        bg = dgl.batch(graphs)
-        inputs.append(bg)
+        nodes holds the nodes with in-edges by decreasing in-degree and edges
+        their in-edges, each mailbox in edge order, laid out time step by time
+        step as PackedSequence data. batch_sizes stays on the cpu, where
+        PackedSequence wants it.
+        """
+        if self._packed is None:
+            n = self.number_of_nodes()
+            degree = torch.bincount(self.dst, minlength=n)
+            nodes = torch.argsort(degree, descending=True, stable=True)[:int((degree > 0).sum())]
+            rank = torch.zeros_like(degree).index_copy(0, nodes, torch.arange(len(nodes), device=nodes.device))
+            # position of every edge in the mailbox of its destination
+            by_dst = torch.argsort(self.dst, stable=True)
+            start = torch.cumsum(degree, 0) - degree
+            position = torch.empty_like(self.dst)
+            position[by_dst] = torch.arange(len(by_dst), device=by_dst.device) - start[self.dst[by_dst]]
+            edges = torch.argsort(position * len(nodes) + rank[self.dst])
+            self._packed = nodes, edges, torch.bincount(position).cpu()
+        return self._packed
 
-        # top label sidxs
-        top_labels_sidx = []
-        for label in top_labels:
-            try:
-                sidx = np.where(labels == label)[0]
-                top_labels_sidx.append(sidx.tolist())
-            except:
-                top_labels_sidx.append([])  
 
-        labels = torch.LongTensor(labels)
-        return inputs, top_labels_sidx, labels
+def seqs_to_eop_multigraph(seqs):
+    """The EOP multigraphs of a batch of sessions, built as one EOPGraph.
 
-    return collate_fn
\ No newline at end of file
+    The nodes of a session are its distinct items in increasing order and its
+    edges link every two consecutive items. One np.unique over (session, item)
+    keys of the concatenated sessions numbers the nodes of the whole batch.
+    """
+    lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    items = np.fromiter(itertools.chain.from_iterable(seqs), dtype=np.int64, count=int(lens.sum()))
+    sid = np.repeat(np.arange(len(seqs)), lens)
+    base = int(items.max()) + 1
+    keys, nid = np.unique(sid * base + items, return_inverse=True)
+    node_sid = keys // base
+    within = sid[:-1] == sid[1:]
+    return EOPGraph(torch.from_numpy(keys % base), torch.from_numpy(nid[:-1][within]),
+                    torch.from_numpy(nid[1:][within]), torch.from_numpy(nid[np.cumsum(lens) - 1]),
+                    torch.from_numpy(np.bincount(node_sid, minlength=len(seqs))), torch.from_numpy(node_sid))
+
+
+def collate_fn(samples, seqs_to_graph, top_labels):
+    seqs, labels = zip(*samples)
+
+    inputs = []
+    # make the session graphs of all sessions at once
+    bg = seqs_to_graph(seqs)
+    inputs.append(bg)
+
+    # top label sidxs
+    top_labels_sidx = []
+    for label in top_labels:
+        try:
+            sidx = np.where(labels == label)[0]
+            top_labels_sidx.append(sidx.tolist())
+        except:
+            top_labels_sidx.append([])  
+
+    labels = torch.LongTensor(labels)
+    return inputs, top_labels_sidx, labels
+
+
+def collate_fn_factory(seqs_to_graph, top_labels):
+    # a partial rather than a closure, so that DataLoader workers and the evaluation process can pickle it
+    return functools.partial(collate_fn, seqs_to_graph=seqs_to_graph, top_labels=top_labels)
@@ -1,12 +1,13 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
 
 import time
 import datetime
 import numpy as np
 from utils import get_metric_scores, metric_print
+from shared import runtime
 
 
 class NARM(nn.Module):
@@ -36,31 +37,30 @@ class NARM(nn.Module):
         self.v_t = nn.Linear(self.hidden_size, 1, bias=False)
         self.ct_dropout = nn.Dropout(0.5)
         self.b = nn.Linear(self.embedding_dim, 2 * self.hidden_size, bias=False)
+        # (weight versions, self.b of the item embeddings), see item_projection
+        self._item_projection = None
         #self.sf = nn.Softmax()
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = runtime.device()
 
         self.loss_function = nn.CrossEntropyLoss()
         self.optimizer = torch.optim.Adam(self.parameters(), lr=opt.lr)
         self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=opt.lr_dc_step, gamma=opt.lr_dc)
 
 
-    def forward(self, seq, lengths):
+    def forward(self, seq):
         # pdb.set_trace()
-        hidden = self.init_hidden(seq.size(1))
-        embs = self.emb_dropout(self.emb(seq))
-        embs = pack_padded_sequence(embs, lengths)
-        gru_out, hidden = self.gru(embs, hidden)
-        gru_out, lengths = pad_packed_sequence(gru_out)
+        hidden = self.init_hidden(seq.batch_sizes[0].item())
+        gru_out, hidden = self.gru(self.embed(seq), hidden)
+        gru_out, lengths = pad_packed_sequence(gru_out, batch_first=True)
 
         # fetch the last hidden state of last timestamp
         ht = hidden[-1]
-        gru_out = gru_out.permute(1, 0, 2)
 
         c_global = ht
         q1 = self.a_1(gru_out.contiguous().view(-1, self.hidden_size)).view(gru_out.size())  
         q2 = self.a_2(ht)
 
-        mask = torch.where(seq.permute(1, 0) > 0, torch.tensor([1.], device = self.device), torch.tensor([0.], device = self.device))
+        mask = (torch.arange(gru_out.size(1)) < lengths.unsqueeze(1)).float().to(self.device)
         q2_expand = q2.unsqueeze(1).expand_as(q1)
         q2_masked = mask.unsqueeze(2).expand_as(q1) * q2_expand
 
@@ -72,28 +72,41 @@ class NARM(nn.Module):
 
         return c_t
     
+    def embed(self, seq):
+        # the embeddings of the packed item ids, packed like them
+        return PackedSequence(self.emb_dropout(self.emb(seq.data)), seq.batch_sizes, seq.sorted_indices,
+                              seq.unsorted_indices)
+
     def compute_scores(self, c_t):
-        item_embs = self.emb(torch.arange(self.n_items).to(self.device))
-        scores = torch.matmul(c_t, self.b(item_embs).permute(1, 0))
+        scores = torch.matmul(c_t, self.item_projection().permute(1, 0))
         # scores = self.sf(scores)
         return scores
 
+    def item_projection(self):
+        """self.b of the embeddings of all items, as (n_items, 2 * hidden_size).
+
+        Without autograd, in evaluation and when scoring with frozen weights,
+        it is computed once per version of emb and b and reused by every later
+        call. Optimizer steps and load_state_dict write the weights in place,
+        which bumps their version, so the next call recomputes it.
+        """
+        if torch.is_grad_enabled() and (self.emb.weight.requires_grad or self.b.weight.requires_grad):
+            return self.b(self.emb(torch.arange(self.n_items).to(self.device)))
+        key = tuple((w.data_ptr(), w._version, w.dtype) for w in (self.emb.weight, self.b.weight))
+        if self._item_projection is None or self._item_projection[0] != key:
+            self._item_projection = (key, self.b(self.emb.weight))
+        return self._item_projection[1]
+
     def init_hidden(self, batch_size):
         return torch.zeros((self.n_layers, batch_size, self.hidden_size), requires_grad=True).to(self.device)
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def mixup_criterion(criterion, pred, y_a, y_b, lam):
@@ -101,15 +114,15 @@ def mixup_criterion(criterion, pred, y_a, y_b, lam):
 
 
 def forward(model, i, data, top_labels, lam=None, train=True):
-    inputs, targets, inputs_len, top_labels_sidx = data.get_slice(i, top_labels)
+    inputs, targets, top_labels_sidx = data.get_slice(i, top_labels)
     inputs = trans_to_cuda(inputs)
-    feats = model(inputs, inputs_len)
+    feats = model(inputs)
 
     if not train:
         scores = model.compute_scores(feats)
         return targets, scores
     else:
-        mixup_sess_srcs = torch.randint(high=inputs.shape[1], size=(inputs.shape[1], ))
+        mixup_sess_srcs = torch.randint(high=len(targets), size=(len(targets), ))
         mixed_feats = lam * feats + (1-lam) * feats[trans_to_cuda(mixup_sess_srcs), :]
         y_as, y_bs = targets, targets[mixup_sess_srcs]
 
@@ -162,6 +175,13 @@ def train_test(model, train_data, test_data, n_items, top_labels, lam, Ks=[10, 2
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_items, top_labels, Ks)
+
+
+def evaluate(model, test_data, n_items, top_labels, Ks=[10, 20]):
     print('start predicting: ', datetime.datetime.now())
     epoch_start_eval = time.time()
     model.eval()
@@ -179,4 +199,4 @@ def train_test(model, train_data, test_data, n_items, top_labels, lam, Ks=[10, 2
 
     results = metric_print(eval10, eval20, n_items, t)                                                            
 
-    return loss, results
+    return results
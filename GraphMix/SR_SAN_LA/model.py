@@ -8,7 +8,9 @@ import torch.nn.functional as F
 from torch.nn import TransformerEncoder
 from torch.nn import TransformerEncoderLayer
 import time
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 
 class SelfAttentionNetwork(Module):
     def __init__(self, opt, n_node):
@@ -17,7 +19,8 @@ class SelfAttentionNetwork(Module):
         self.n_node = n_node
         self.batch_size = opt.batchSize
         self.embedding = nn.Embedding(self.n_node, self.hidden_size)
-        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward)
+        # batch first, so that evaluation takes the nested tensor fast path and skips the padded item slots
+        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward, batch_first=True)
         self.transformerEncoder = TransformerEncoder(self.transformerEncoderLayer, opt.layer)
 
         self.linear_one = nn.Linear(self.hidden_size, self.hidden_size, bias=True)
@@ -54,25 +57,17 @@ class SelfAttentionNetwork(Module):
         scores = torch.matmul(a, b.transpose(1, 0))
         return scores
 
-    def forward(self, inputs, A):
+    def forward(self, inputs, key_padding_mask=None):
         hidden = self.embedding(inputs)
-        hidden = hidden.transpose(0,1).contiguous()
-        hidden = self.transformerEncoder(hidden)
-        hidden = hidden.transpose(0,1).contiguous()
+        hidden = self.transformerEncoder(hidden, src_key_padding_mask=key_padding_mask)
         return hidden
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 def mixup_criterion(criterion, pred, y_a, y_b, lam):
@@ -83,19 +78,19 @@ def mixup_criterion(criterion, pred, y_a, y_b, lam):
 
 
 def forward(model, i, data, top_labels, lam=None, train=True):
-    alias_inputs, A, items, mask, targets, top_labels_sidx = data.get_slice(i, top_labels)
+    alias_inputs, items, key_padding_mask, mask, targets, top_labels_sidx = data.get_slice(i, top_labels)
     alias_inputs = trans_to_cuda(torch.Tensor(alias_inputs).long())
     items = trans_to_cuda(torch.Tensor(items).long())
-    A = trans_to_cuda(torch.Tensor(A).float())
+    key_padding_mask = trans_to_cuda(torch.Tensor(key_padding_mask).bool())
     mask = trans_to_cuda(torch.Tensor(mask).long())
-    hidden = model(items, A)
+    hidden = model(items, key_padding_mask)
     feats = model.session_encoding(hidden, alias_inputs, mask)
 
     if not train:
         scores = model.compute_scores(feats)
         return targets, scores
     else:  
-        mixup_sess_srcs = torch.randint(high=A.shape[0], size=(A.shape[0], ))
+        mixup_sess_srcs = torch.randint(high=items.shape[0], size=(items.shape[0], ))
         mixed_feats = lam * feats + (1-lam) * feats[trans_to_cuda(mixup_sess_srcs), :]
         y_as, y_bs = targets, targets[mixup_sess_srcs]
 
@@ -145,19 +140,19 @@ def train_test(model, train_data, test_data, n_node, top_labels, lam=0.6, Ks = [
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-    slices = test_data.generate_batch(model.batch_size)
-    for i in slices:
-        targets, logits = forward(model, i, test_data, top_labels, train=False)
-        
-        eval10 = get_metric_scores(logits, targets, Ks[0], eval10)
-        eval20 = get_metric_scores(logits, targets, Ks[1], eval20)
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, top_labels, Ks)
 
-    t = time.time() - epoch_start_eval
 
-    results = metric_print(eval10, eval20, n_node, t)
+def evaluate(model, test_data, n_node, top_labels, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
+
+    def score(i):
+        targets, logits = forward(model, i, test_data, top_labels, train=False)
+        return targets, logits
 
-    return loss, results
\ No newline at end of file
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
@@ -9,6 +9,9 @@ from torch.nn import TransformerEncoder
 from torch.nn import TransformerEncoderLayer
 import time
 from utils import *
+from shared import runtime
+from shared import evaluation
+from shared.sessions import prefix_hidden
 
 class SelfAttentionNetwork(Module):
     def __init__(self, opt, n_node):
@@ -18,7 +21,8 @@ class SelfAttentionNetwork(Module):
         self.scale = opt.scale
         self.batch_size = opt.batchSize
         self.embedding = nn.Embedding(self.n_node, self.hidden_size)
-        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward)
+        # batch first, so that evaluation takes the nested tensor fast path and skips the padded item slots
+        self.transformerEncoderLayer = TransformerEncoderLayer(d_model=self.hidden_size, nhead=opt.nhead,dim_feedforward=self.hidden_size * opt.feedforward, batch_first=True)
         self.transformerEncoder = TransformerEncoder(self.transformerEncoderLayer, opt.layer)
 
         self.linear_one = nn.Linear(self.hidden_size, self.hidden_size, bias=True)
@@ -53,33 +57,31 @@ class SelfAttentionNetwork(Module):
         scores = torch.matmul(a, b.transpose(1, 0))
         return scores
 
-    def forward(self, inputs, A):
+    def forward(self, inputs, key_padding_mask=None, causal=False):
         hidden = self.embedding(inputs)
-        hidden = hidden.transpose(0,1).contiguous()
-        hidden = self.transformerEncoder(hidden)
-        hidden = hidden.transpose(0,1).contiguous()
+        if causal:
+            # inputs are whole sessions, every position attends to itself and the positions before it
+            size = inputs.size(1)
+            causal_mask = torch.ones(size, size, dtype=torch.bool, device=inputs.device).triu(1)
+            hidden = self.transformerEncoder(hidden, mask=causal_mask)
+        else:
+            hidden = self.transformerEncoder(hidden, src_key_padding_mask=key_padding_mask)
         return hidden
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 def forward(model, i, data, top_labels):
-    alias_inputs, A, items, mask, targets, top_labels_sidx = data.get_slice(i,  top_labels)
+    alias_inputs, items, key_padding_mask, mask, targets, top_labels_sidx = data.get_slice(i,  top_labels)
     alias_inputs = trans_to_cuda(torch.Tensor(alias_inputs).long())
     items = trans_to_cuda(torch.Tensor(items).long())
-    A = trans_to_cuda(torch.Tensor(A).float())
+    key_padding_mask = trans_to_cuda(torch.Tensor(key_padding_mask).bool())
     mask = trans_to_cuda(torch.Tensor(mask).long())
-    hidden = model(items, A)
+    hidden = model(items, key_padding_mask)
 
     get = lambda i: hidden[i][alias_inputs[i]]
     seq_hidden = torch.stack([get(i) for i in torch.arange(len(alias_inputs)).long()])
@@ -87,14 +89,25 @@ def forward(model, i, data, top_labels):
     return targets, top_labels_sidx, model.compute_scores(seq_hidden, mask)
 
 
+def forward_sessions(model, i, data, top_labels):
+    # the predictions of all examples of a batch of whole sessions, see Sessions in utils.py: the session
+    # is encoded once and the prefix ending at t is read out from the positions up to t
+    inputs, mask, positions, targets, top_labels_sidx = data.get_slice(i, top_labels)
+    inputs = trans_to_cuda(torch.Tensor(inputs).long())
+    positions = trans_to_cuda(torch.Tensor(positions).long())
+    hidden, prefix_mask = prefix_hidden(model(inputs, None, causal=True), positions)
+    return targets, top_labels_sidx, model.compute_scores(hidden, prefix_mask)
+
+
 def train_test(model, train_data, test_data, n_node, top_labels, lam=1, Ks = [10, 20]):
     epoch_start_train = time.time()
     print('start training: ', datetime.datetime.now())
     model.train()
     total_loss = 0.0
+    forward_batch = forward_sessions if isinstance(train_data, Sessions) else forward
     slices = train_data.generate_batch(model.batch_size)
     for i, j in zip(slices, np.arange(len(slices))):
-        targets,top_labels_sidx, scores_o= forward(model, i, train_data, top_labels)
+        targets,top_labels_sidx, scores_o= forward_batch(model, i, train_data, top_labels)
         targets_cuda = trans_to_cuda(torch.Tensor(targets).long())
         loss_o = model.loss_function(scores_o, targets_cuda - 1)
 
@@ -125,23 +138,21 @@ def train_test(model, train_data, test_data, n_node, top_labels, lam=1, Ks = [10
 
     print('\t\tTotal Loss:\t%.3f' % total_loss)
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-
-
-    slices = test_data.generate_batch(model.batch_size)
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, n_node, top_labels, Ks)
 
-    for i in slices:
-        targets,_, scores = forward(model, i, test_data, top_labels)
-        #  scores, targets, test_data, k, pop_dict, ht_dict, test_label_dict, hit_label, mrr_label, eval
 
-        eval10 = get_metric_scores(scores, targets, Ks[0],   eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1],   eval20)
+def evaluate(model, test_data, n_node, top_labels, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
-    t = time.time() - epoch_start_eval
+    forward_batch = forward_sessions if isinstance(test_data, Sessions) else forward
 
-    results = metric_print(eval10, eval20, n_node, t)
+    def score(i):
+        targets,_, scores = forward_batch(model, i, test_data, top_labels)
+        return targets, scores
 
-    return loss, results
\ No newline at end of file
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
@@ -4,6 +4,7 @@ import pickle
 from collections import Counter
 import networkx as nx
 import random
+from shared.sessions import PaddedSessions
 
 def top75_labels(train_data, test_data, dataset_name):
     try:
@@ -144,6 +145,24 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def session_items(inputs):
+    # the unique items of the padded sessions of a batch, padded to the most of the batch, the alias of every
+    # position in them and the key padding mask of the padded item slots. SR_SAN attends over the items of a
+    # session, it needs no session graph
+    inputs = np.asarray(inputs)
+    base = inputs.max() + 1
+    # unique (row, item) pairs, sorted by row and then item like np.unique of every row
+    unique, inverse = np.unique(inputs + base * np.arange(len(inputs))[:, None], return_inverse=True)
+    rows = unique // base
+    n_node = np.bincount(rows, minlength=len(inputs))
+    starts = np.cumsum(n_node) - n_node
+    items = np.zeros((len(inputs), n_node.max()), dtype=inputs.dtype)
+    items[rows, np.arange(len(unique)) - starts[rows]] = unique % base
+    alias_inputs = inverse.reshape(inputs.shape) - starts[:, None]
+    key_padding_mask = np.arange(n_node.max()) >= n_node[:, None]
+    return alias_inputs, items, key_padding_mask
+
+
 class Data():
     def __init__(self, data,  shuffle=False):
         inputs = data[0]
@@ -172,29 +191,7 @@ class Data():
 
     def get_slice(self, i,  top_labels):
         inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+        alias_inputs, items, key_padding_mask = session_items(inputs)
 
         top_labels_sidx = []
         for label in top_labels:
@@ -204,4 +201,19 @@ class Data():
             except:
                 top_labels_sidx.append([])
 
-        return alias_inputs, A, items, mask, targets, top_labels_sidx
\ No newline at end of file
+        return alias_inputs, items, key_padding_mask, mask, targets, top_labels_sidx
+
+
+class Sessions(PaddedSessions, Data):
+    """Data of the causal mode, see SelfAttentionNetwork.forward and PaddedSessions."""
+    def get_slice(self, i, top_labels):
+        inputs, mask, flat_positions, targets = super().get_slice(i)
+
+        top_labels_sidx = []
+        for label in top_labels:
+            try:
+                sidx = np.where(targets == label)[0]
+                top_labels_sidx.append(sidx.tolist())
+            except:
+                top_labels_sidx.append([])
+        return inputs, mask, flat_positions, targets, top_labels_sidx
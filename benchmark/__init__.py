@@ -0,0 +1,6 @@
+"""Micro and end-to-end throughput benchmarks of the LogitAveraging variants.
+
+    python -m benchmark micro   hot paths in isolation, checked against references
+    python -m benchmark e2e     short training runs of the variants on generated data
+    python -m benchmark.gate    e2e runs stored per commit and compared with a baseline
+"""
@@ -0,0 +1,42 @@
+import argparse
+import json
+import os
+
+from . import micro, e2e
+from .common import FAMILIES, MODELS, variants, environment
+
+parser = argparse.ArgumentParser(prog='python -m benchmark')
+parser.add_argument('suite', choices=['micro', 'e2e', 'all'], help='the benchmarks to run')
+parser.add_argument('--out', default='bench_results.json', help='json file of the results')
+parser.add_argument('--seed', type=int, default=0, help='seed of the generated sessions')
+parser.add_argument('--benchmarks', nargs='+', default=None, choices=list(micro.BENCHMARKS), help='micro benchmarks to run')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128, 512], help='batch sizes of the micro benchmarks')
+parser.add_argument('--n_items', type=int, nargs='+', default=[1000, 43098], help='catalogue sizes of the micro benchmarks')
+parser.add_argument('--repeat', type=int, default=20, help='timed calls per micro benchmark')
+parser.add_argument('--families', nargs='+', default=None, choices=FAMILIES, help='variant families of the e2e runs')
+parser.add_argument('--models', nargs='+', default=None, choices=MODELS, help='models of the e2e runs')
+parser.add_argument('--n_train', type=int, default=5000, help='training sessions of the e2e dataset')
+parser.add_argument('--n_test', type=int, default=1000, help='test sessions of the e2e dataset')
+parser.add_argument('--e2e_items', type=int, default=43098, help='catalogue size of the e2e dataset')
+parser.add_argument('--epochs', type=int, default=1, help='epochs of every e2e run')
+parser.add_argument('--batch_size', type=int, default=None, help='batch size of the e2e runs, the main.py default if unset')
+parser.add_argument('--timeout', type=int, default=1800, help='seconds before an e2e run is stopped')
+parser.add_argument('--keep', default=None, help='directory to keep the e2e scratch tree in')
+opt = parser.parse_args()
+
+results = {'environment': environment()}
+if opt.suite in ('micro', 'all'):
+    results['micro'] = micro.run(opt.benchmarks, opt.batch_sizes, opt.n_items, opt.repeat, opt.seed)
+if opt.suite in ('e2e', 'all'):
+    results['e2e'] = e2e.run(variants(opt.families, opt.models), opt.n_train, opt.n_test, opt.e2e_items, opt.epochs,
+                             opt.batch_size, opt.timeout, opt.seed, opt.keep)
+if os.path.dirname(opt.out):
+    os.makedirs(os.path.dirname(opt.out), exist_ok=True)
+with open(opt.out, 'w') as f:
+    json.dump(results, f, indent=2)
+print(f'Results written to {opt.out}')
+
+failed = [r for r in results.get('micro', []) if (r.get('check') or 'ok') != 'ok']
+failed += [r for r in results.get('e2e', []) if r['status'] != 'ok']
+if failed:
+    raise SystemExit(f'{len(failed)} benchmarks failed')
@@ -0,0 +1,149 @@
+import argparse
+import ast
+import glob
+import importlib
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import torch
+
+from .synthetic import SessionGenerator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAMILIES = ['Baselines', 'LA', 'FLAG', 'GraphMix', 'random']
+MODELS = ['SR-GNN', 'NISER', 'SR_SAN', 'TAGNN++', 'NARM', 'EOPA']
+
+
+def variants(families=None, models=None):
+    """The variant directories of the tree, e.g. 'LA/NARM' or 'FLAG/SR-GNN_LA'."""
+    found = []
+    for path in sorted(glob.glob(os.path.join(ROOT, '*', '*', 'main.py'))):
+        family, name = path.split(os.sep)[-3:-1]
+        model = name[:-3] if name.endswith('_LA') else name
+        if (families is None or family in families) and (models is None or model in models):
+            found.append(f'{family}/{name}')
+    return found
+
+
+def load(variant, module):
+    """Imports `module` of a variant directory.
+
+    Every variant has its own utils/model modules under the same names, so the
+    modules of the previously loaded variant are dropped first. The packages
+    of the root (benchmark, shared) stay.
+    """
+    path = os.path.join(ROOT, variant)
+    for name, mod in list(sys.modules.items()):
+        file = getattr(mod, '__file__', None) or ''
+        if file.startswith(ROOT) and os.path.relpath(file, ROOT).split(os.sep)[0] not in ('benchmark', 'shared'):
+            del sys.modules[name]
+    sys.path.insert(0, path)
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.remove(path)
+
+
+def model_module(variant):
+    return 'narm' if os.path.exists(os.path.join(ROOT, variant, 'narm.py')) else 'model'
+
+
+def main_parser(variant):
+    """The argument parser of a variant's main.py, rebuilt from its add_argument calls.
+
+    The calls are replayed on a fresh parser rather than importing main.py,
+    which parses the command line and trains at import time.
+    """
+    tree = ast.parse(open(os.path.join(ROOT, variant, 'main.py')).read())
+    parser = argparse.ArgumentParser(prog=f'{variant}/main.py')
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'attr', None) == 'add_argument':
+            eval(compile(ast.Expression(node), variant, 'eval'), {'parser': parser})
+    return parser
+
+
+def main_defaults(variant, **overrides):
+    """The option defaults of a variant's main.py, by dest, e.g. opt.batch_size for --batch-size."""
+    opt = main_parser(variant).parse_args([])
+    vars(opt).update(overrides)
+    return opt
+
+
+def main_options(variant):
+    """The option string of every dest of a variant's main.py, e.g. {'batch_size': '--batch-size'}."""
+    return {a.dest: a.option_strings[0] for a in main_parser(variant)._actions
+            if a.option_strings and a.dest != 'help'}
+
+
+def batch_size_dest(opt):
+    return 'batchSize' if hasattr(opt, 'batchSize') else 'batch_size'
+
+
+def batch_size_option(variant):
+    options = main_options(variant)
+    return options.get('batchSize') or options['batch_size']
+
+
+def sessions(n, n_items, rng, **kwargs):
+    """n generated (session, target) pairs, see synthetic.SessionGenerator for kwargs."""
+    gen = SessionGenerator(n_items, seed=rng.integers(2 ** 32), **kwargs)
+    seqs = gen.sessions(n)
+    return [s[:-1] for s in seqs], [s[-1] for s in seqs]
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def measure(fn, sessions, repeat=20, warmup=3):
+    """Step latency percentiles, throughput and peak memory of fn().
+
+    Python allocations (numpy included) are traced in one extra call, so the
+    timed calls run without tracemalloc.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        _sync()
+        t0 = time.perf_counter()
+        fn()
+        _sync()
+        times.append(time.perf_counter() - t0)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    start = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - start
+    if not tracing:
+        tracemalloc.stop()
+    times = np.array(times)
+    result = {
+        'p50_ms': float(np.percentile(times, 50) * 1e3),
+        'p99_ms': float(np.percentile(times, 99) * 1e3),
+        'mean_ms': float(times.mean() * 1e3),
+        'sessions_per_sec': float(sessions / times.mean()),
+        'py_peak_bytes': int(peak),
+    }
+    if torch.cuda.is_available():
+        result['cuda_peak_bytes'] = int(torch.cuda.max_memory_allocated())
+    return result
+
+
+def environment():
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        'cpus': os.cpu_count(),
+        'threads': torch.get_num_threads(),
+    }
@@ -0,0 +1,73 @@
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from .common import ROOT, batch_size_option
+from .synthetic import write_dataset
+
+# Short end-to-end runs of the variants. Every variant is copied, with the
+# shared package, next to a generated dataset (see synthetic.py) in a scratch
+# tree, trains for `epochs` epochs through its main.py and is measured through
+# its telemetry records (one per step).
+
+DATASET = 'synthetic'
+
+
+def run_variant(tree, variant, epochs=1, batch_size=None, timeout=1800, extra=()):
+    """Trains one variant of the scratch tree and summarizes its telemetry."""
+    cwd = os.path.join(tree, variant)
+    args = ['--dataset', DATASET, '--epoch', str(epochs), '--telemetry_every', '1', '--telemetry_dir', 'telemetry']
+    if batch_size is not None:
+        args += [batch_size_option(variant), str(batch_size)]
+    start = time.time()
+    proc = subprocess.run([sys.executable, 'main.py'] + args + list(extra),
+                          cwd=cwd, capture_output=True, text=True, timeout=timeout)
+    record = {'variant': variant, 'wall_s': time.time() - start}
+    if proc.returncode != 0:
+        return dict(record, status='failed', error=proc.stderr.strip().splitlines()[-1:])
+    records = []
+    for path in glob.glob(os.path.join(cwd, 'telemetry', DATASET, '*.jsonl')):
+        with open(path) as f:
+            records += [json.loads(line) for line in f]
+    steps = np.array([r['time'] for r in records if r['event'] == 'steps'])
+    epochs = [r for r in records if r['event'] == 'epoch']
+    train_time = sum(r['time'] for r in epochs)
+    return dict(record, status='ok', steps=len(steps), train_s=train_time, steps_per_sec=len(steps) / train_time,
+                sessions_per_sec=sum(r['sessions'] for r in epochs) / train_time,
+                p50_step_ms=float(np.percentile(steps, 50) * 1e3), p99_step_ms=float(np.percentile(steps, 99) * 1e3),
+                eval_s=sum(r.get('eval', {}).get('time', 0.0) for r in epochs),
+                peak_rss_bytes=max(r['memory']['maxrss'] for r in epochs),
+                stages={k: sum(r['stages'].get(k, 0.0) for r in epochs) for k in epochs[0]['stages']})
+
+
+def run(variants, n_train=5000, n_test=1000, n_items=43098, epochs=1, batch_size=None, timeout=1800, seed=0, keep=None):
+    tree = keep or tempfile.mkdtemp(prefix='logitavg-bench-')
+    try:
+        write_dataset(tree, DATASET, n_items, n_train, n_test, prefixes=False, seed=seed)
+        shutil.copytree(os.path.join(ROOT, 'shared'), os.path.join(tree, 'shared'), dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        results = []
+        for variant in variants:
+            shutil.copytree(os.path.join(ROOT, variant), os.path.join(tree, variant), dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('ckpt', 'telemetry', 'profile', '__pycache__'))
+            try:
+                result = run_variant(tree, variant, epochs, batch_size, timeout)
+            except subprocess.TimeoutExpired:
+                result = {'variant': variant, 'status': 'timeout'}
+            if result['status'] == 'ok':
+                print(f"{variant:<20} {result['sessions_per_sec']:10.0f} sessions/s  p50 {result['p50_step_ms']:9.2f} ms"
+                      f"  p99 {result['p99_step_ms']:9.2f} ms  eval {result['eval_s']:7.2f} s"
+                      f"  peak {result['peak_rss_bytes'] / 2 ** 20:7.0f} MB")
+            else:
+                print(f"{variant:<20} {result['status']} {result.get('error', '')}")
+            results.append(result)
+        return results
+    finally:
+        if keep is None:
+            shutil.rmtree(tree, ignore_errors=True)
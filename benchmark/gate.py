@@ -0,0 +1,192 @@
+"""Throughput regression gate over the e2e benchmark.
+
+    python -m benchmark.gate                 run the profile on HEAD and compare it with the baseline
+    python -m benchmark.gate run             only run and store the results of HEAD
+    python -m benchmark.gate compare [REV]   compare stored results of REV (default HEAD) with the baseline
+    python -m benchmark.gate baseline [REV]  make the stored results of REV (default HEAD) the baseline
+
+Every variant is run `repeat` times and then until its training steps
+took `min_seconds` in all, and the median of its runs is compared. A
+variant that stays shorter within `max_repeat` runs is not compared.
+Results are stored as {history}/{commit}.json, with a -dirty suffix for
+uncommitted trees. The baseline is {history}/baseline.json. The gate exits
+1 when a variant of the baseline fails or regresses beyond the tolerances:
+steps/sec and sessions/sec may drop by --tol_throughput, eval time and
+peak memory may grow by --tol_eval and --tol_memory. It exits 3 without
+comparing when the torch version, device or thread count of the results
+differ from those of the baseline.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import numpy as np
+
+from . import e2e
+from .common import ROOT, variants, environment
+
+# fixed e2e settings, so that runs of different commits are comparable
+PROFILES = {
+    'quick': dict(n_train=5000, n_test=500, n_items=20000, epochs=1, repeat=5, min_seconds=10, max_repeat=20),
+    'full': dict(n_train=20000, n_test=4000, n_items=43098, epochs=1, repeat=5, min_seconds=120, max_repeat=15),
+}
+# environment of the results that throughput depends on, results of different ones are not compared
+ENVIRONMENT = ('torch', 'cuda', 'threads')
+NOT_COMPARED = 3
+# metric: (higher is better, tolerance argument)
+METRICS = {
+    'steps_per_sec': (True, 'tol_throughput'),
+    'sessions_per_sec': (True, 'tol_throughput'),
+    'eval_s': (False, 'tol_eval'),
+    'peak_rss_bytes': (False, 'tol_memory'),
+}
+
+
+def commit(rev='HEAD'):
+    sha = subprocess.run(['git', 'rev-parse', '--short', rev], cwd=ROOT, capture_output=True, text=True,
+                         check=True).stdout.strip()
+    if rev == 'HEAD':
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        if dirty:
+            sha += '-dirty'
+    return sha
+
+
+def run(profile, families=None, models=None, timeout=1800, seed=0):
+    """Runs every variant of the profile `repeat` times, and then again until its training took `min_seconds`
+    in all or it ran `max_repeat` times, and keeps the median of every metric per variant."""
+    settings = dict(PROFILES[profile])
+    repeat, min_seconds, max_repeat = settings.pop('repeat'), settings.pop('min_seconds'), settings.pop('max_repeat')
+    runs = {variant: [] for variant in variants(families, models)}
+    pending = list(runs)
+    while pending:
+        for result in e2e.run(pending, timeout=timeout, seed=seed, **settings):
+            runs[result['variant']].append(result)
+        pending = [variant for variant, results in runs.items()
+                   if all(r['status'] == 'ok' for r in results) and len(results) < max_repeat
+                   and (len(results) < repeat or sum(r['train_s'] for r in results) < min_seconds)]
+    results = {}
+    for variant, per_variant in runs.items():
+        ok = [r for r in per_variant if r['status'] == 'ok']
+        if len(ok) < len(per_variant):
+            results[variant] = {'status': next(r['status'] for r in per_variant if r['status'] != 'ok')}
+            continue
+        train_s = sum(r['train_s'] for r in ok)
+        results[variant] = dict({m: float(np.median([r[m] for r in ok])) for m in METRICS},
+                                status='ok' if train_s >= min_seconds else 'too_short', runs=len(ok), train_s=train_s)
+    return results
+
+
+def environment_differences(current, baseline):
+    """(key, baseline, current) of the ENVIRONMENT keys that differ, results of older gates have none."""
+    return [(key, baseline.get('environment', {}).get(key), current['environment'].get(key))
+            for key in ENVIRONMENT if baseline.get('environment', {}).get(key) != current['environment'].get(key)]
+
+
+def compare(current, baseline, tolerances):
+    """Regressions of `current` against `baseline` as (variant, metric, baseline, current) tuples."""
+    regressions = []
+    for variant, base in sorted(baseline['results'].items()):
+        cur = current['results'].get(variant)
+        if base['status'] != 'ok':
+            continue
+        if cur is not None and cur['status'] == 'too_short':
+            # measured too briefly to tell a regression from noise
+            continue
+        if cur is None or cur['status'] != 'ok':
+            regressions.append((variant, 'status', 'ok', cur['status'] if cur else 'missing'))
+            continue
+        for metric, (higher, tol) in METRICS.items():
+            limit = base[metric] * (1 - tolerances[tol]) if higher else base[metric] * (1 + tolerances[tol])
+            if (cur[metric] < limit) if higher else (cur[metric] > limit):
+                regressions.append((variant, metric, base[metric], cur[metric]))
+    return regressions
+
+
+def _report(current, baseline, regressions):
+    print(f"{'variant':<20}" + ''.join(f'{m:>22}' for m in METRICS))
+    for variant, cur in sorted(current['results'].items()):
+        base = baseline['results'].get(variant, {})
+        line = f'{variant:<20}'
+        for metric in METRICS:
+            if cur['status'] != 'ok' or base.get('status') != 'ok':
+                line += f"{cur['status']:>22}"
+                continue
+            change = cur[metric] / base[metric] - 1 if base[metric] else 0.0
+            line += f'{cur[metric]:>13.4g} ({change:+6.1%})'
+        print(line)
+    for variant, metric, base, cur in regressions:
+        print(f'REGRESSION {variant} {metric}: {base} -> {cur}')
+
+
+def _path(history, name):
+    return os.path.join(history, f'{name}.json')
+
+
+def _load(history, name):
+    path = _path(history, name)
+    if not os.path.exists(path):
+        raise SystemExit(f'no stored results at {path}, run `python -m benchmark.gate run` first')
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmark.gate')
+    parser.add_argument('command', nargs='?', default='check', choices=['check', 'run', 'compare', 'baseline'])
+    parser.add_argument('rev', nargs='?', default='HEAD', help='git revision of the stored results to use')
+    parser.add_argument('--profile', default='quick', choices=list(PROFILES), help='e2e settings of the runs')
+    parser.add_argument('--history', default=os.path.join(ROOT, 'bench_history'), help='directory of stored results')
+    parser.add_argument('--families', nargs='+', default=None, help='variant families to run, all by default')
+    parser.add_argument('--models', nargs='+', default=None, help='models to run, all by default')
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds before a run is stopped')
+    parser.add_argument('--tol_throughput', type=float, default=0.10, help='allowed drop of steps/sec and sessions/sec')
+    parser.add_argument('--tol_eval', type=float, default=0.15, help='allowed growth of the eval time')
+    parser.add_argument('--tol_memory', type=float, default=0.10, help='allowed growth of the peak memory')
+    opt = parser.parse_args()
+    tolerances = {k: getattr(opt, k) for k in ('tol_throughput', 'tol_eval', 'tol_memory')}
+    os.makedirs(opt.history, exist_ok=True)
+
+    if opt.command in ('check', 'run'):
+        name = commit()
+        current = {'commit': name, 'profile': opt.profile, 'environment': environment(),
+                   'results': run(opt.profile, opt.families, opt.models, opt.timeout)}
+        with open(_path(opt.history, name), 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f'Results of {name} written to {_path(opt.history, name)}')
+        if opt.command == 'run':
+            return
+    else:
+        current = _load(opt.history, commit(opt.rev))
+
+    if opt.command == 'baseline':
+        shutil.copy(_path(opt.history, current['commit']), _path(opt.history, 'baseline'))
+        print(f"Baseline set to {current['commit']}")
+        return
+    if not os.path.exists(_path(opt.history, 'baseline')):
+        shutil.copy(_path(opt.history, current['commit']), _path(opt.history, 'baseline'))
+        print(f"No baseline yet, {current['commit']} is the baseline now")
+        return
+    baseline = _load(opt.history, 'baseline')
+    if baseline['profile'] != current['profile']:
+        raise SystemExit(f"baseline profile {baseline['profile']} differs from {current['profile']}")
+    differences = environment_differences(current, baseline)
+    if differences:
+        for key, base, cur in differences:
+            print(f'ENVIRONMENT {key}: {base} (baseline) != {cur}')
+        print(f"{current['commit']} not compared with baseline {baseline['commit']}, "
+              f"set a baseline in this environment with `python -m benchmark.gate baseline`")
+        sys.exit(NOT_COMPARED)
+    regressions = compare(current, baseline, tolerances)
+    print(f"{current['commit']} against baseline {baseline['commit']}")
+    _report(current, baseline, regressions)
+    if regressions:
+        raise SystemExit(f'{len(regressions)} regressions')
+    print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+import contextlib
+import inspect
+import io
+import os
+import re
+from collections import Counter
+import numpy as np
+import torch
+
+from shared import augment
+from .common import ROOT, MODELS, load, model_module, main_defaults, batch_size_dest, sessions, measure
+
+# Hot paths timed in isolation. Every benchmark takes (batch_size, n_items,
+# rng, repeat) and returns result records; `check` holds the comparison of the
+# timed path with its reference: 'ok', a failure message, or None when the
+# benchmark has no reference.
+
+BENCHMARKS = {}
+GET_SLICE = ['Baselines/SR-GNN', 'Baselines/NISER', 'Baselines/SR_SAN', 'Baselines/TAGNN++', 'Baselines/NARM']
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def _record(name, variant, batch_size, n_items, result, check=None, **extra):
+    return dict({'benchmark': name, 'variant': variant, 'batch_size': batch_size, 'n_items': n_items},
+                **result, check=check, **extra)
+
+
+def _check(fn):
+    try:
+        fn()
+        return 'ok'
+    except AssertionError as e:
+        return f'failed: {e}'
+
+
+def _fill(fn, **values):
+    # the arguments of fn that are known by name
+    return {k: values[k] for k in inspect.signature(fn).parameters if k in values}
+
+
+def _top_labels(targets):
+    # the most frequent targets covering 75% of the sessions, as top75_labels
+    counts = Counter(targets).most_common()
+    cum = np.cumsum([c for _, c in counts])
+    return [label for label, _ in counts[:int(np.sum(cum < round(len(targets) * 0.75)))]]
+
+
+def _data(utils, seqs, targets):
+    kwargs = _fill(utils.Data.__init__, batch_aug=False, mixup=False, input_aug_type=None, shuffle=False)
+    return utils.Data((seqs, targets), **kwargs)
+
+
+def session_graphs_reference(inputs):
+    # the unique items, normalized in|out adjacency and aliases of padded sessions, one session at a time as the
+    # original get_slice built them
+    n_node = max(len(np.unique(u_input)) for u_input in inputs)
+    items, A, alias_inputs = [], [], []
+    for u_input in inputs:
+        node = np.unique(u_input)
+        items.append(node.tolist() + (n_node - len(node)) * [0])
+        u_A = np.zeros((n_node, n_node))
+        for k in range(len(u_input) - 1):
+            if u_input[k + 1] == 0:
+                break
+            u_A[np.where(node == u_input[k])[0][0], np.where(node == u_input[k + 1])[0][0]] = 1
+        u_sum_in = np.sum(u_A, 0)
+        u_sum_in[u_sum_in == 0] = 1
+        u_sum_out = np.sum(u_A, 1)
+        u_sum_out[u_sum_out == 0] = 1
+        A.append(np.concatenate([u_A / u_sum_in, u_A.transpose() / u_sum_out]).transpose())
+        alias_inputs.append([np.where(node == item)[0][0] for item in u_input])
+    return alias_inputs, A, items
+
+
+def check_get_slice(variant, out, seqs, targets):
+    """Compares a get_slice batch of all the sessions with the original per-session construction."""
+    padded = np.zeros((len(seqs), max(map(len, seqs))), dtype=np.int64)
+    for k, seq in enumerate(seqs):
+        padded[k, :len(seq)] = seq
+    if variant.endswith('NARM'):
+        # padded sessions and lengths as the original NARM get_slice, here in batch order
+        inputs, lens = torch.nn.utils.rnn.pad_packed_sequence(out[0], batch_first=True)
+        assert np.array_equal(inputs.numpy(), padded), 'padded sessions differ'
+        assert lens.tolist() == [len(seq) for seq in seqs], 'session lengths differ'
+        assert out[1].tolist() == list(targets), 'targets differ'
+        return
+    alias_inputs, A, items = session_graphs_reference(padded)
+    assert np.array_equal(np.asarray(out[0]), np.asarray(alias_inputs)), 'aliases differ'
+    if variant.endswith('SR_SAN'):
+        # no session graph, the item slots past the unique items of a session are masked instead
+        assert np.array_equal(out[1], np.asarray(items)), 'items differ'
+        n_node = np.array([len(np.unique(row)) for row in padded])
+        assert np.array_equal(out[2], np.arange(out[1].shape[1]) >= n_node[:, None]), 'key padding masks differ'
+    else:
+        assert np.allclose(np.asarray(out[1]), np.asarray(A)), 'adjacency differs'
+        assert np.array_equal(np.asarray(out[2]), np.asarray(items)), 'items differ'
+    assert np.array_equal(out[3], padded > 0), 'masks differ'
+    assert out[4].tolist() == list(targets), 'targets differ'
+
+
+@benchmark('get_slice')
+def bench_get_slice(batch_size, n_items, rng, repeat):
+    records = []
+    seqs, targets = sessions(batch_size, n_items, rng)
+    i = np.arange(batch_size)
+    for variant in GET_SLICE:
+        data = _data(load(variant, 'utils'), seqs, targets)
+        kwargs = _fill(data.get_slice, top_labels=[], input_aug_type=None, mixup=False)
+        result = measure(lambda: data.get_slice(i, **kwargs), batch_size, repeat)
+        check = _check(lambda: check_get_slice(variant, data.get_slice(i, **kwargs), seqs, targets))
+        records.append(_record('get_slice', variant, batch_size, n_items, result, check))
+    return records
+
+
+@benchmark('la_grouping')
+def bench_la_grouping(batch_size, n_items, rng, repeat):
+    # LA get_slice with the top label grouping against the same call without labels
+    seqs, targets = sessions(batch_size, n_items, rng)
+    data = _data(load('LA/SR-GNN', 'utils'), seqs, targets)
+    i, top_labels = np.arange(batch_size), _top_labels(targets)
+    plain = measure(lambda: data.get_slice(i, []), batch_size, repeat)
+    result = measure(lambda: data.get_slice(i, top_labels), batch_size, repeat)
+    return [_record('la_grouping', 'LA/SR-GNN', batch_size, n_items, result,
+                    n_labels=len(top_labels), without_grouping_p50_ms=plain['p50_ms'])]
+
+
+def la_average_loop(scores, top_labels_sidx):
+    # logit averaging as written in the LA train_test loops
+    probs = scores.clone()
+    with torch.no_grad():
+        for sidx in top_labels_sidx:
+            if len(sidx) > 0:
+                gathered_logits = torch.mean(scores[sidx], dim=0)
+                probs.index_copy_(0, torch.tensor(sidx, device=scores.device),
+                                  gathered_logits.view(1, -1).repeat(len(sidx), 1))
+    return probs
+
+
+@benchmark('la_averaging')
+def bench_la_averaging(batch_size, n_items, rng, repeat):
+    seqs, targets = sessions(batch_size, n_items, rng)
+    data = _data(load('LA/SR-GNN', 'utils'), seqs, targets)
+    top_labels_sidx = data.get_slice(np.arange(batch_size), _top_labels(targets))[-1]
+    scores = torch.randn(batch_size, n_items - 1, device='cuda' if torch.cuda.is_available() else 'cpu')
+
+    def check():
+        probs = la_average_loop(scores, top_labels_sidx).cpu().numpy()
+        reference = scores.cpu().numpy().copy()
+        for sidx in top_labels_sidx:
+            if len(sidx) > 0:
+                reference[sidx] = reference[sidx].mean(0)
+        assert np.allclose(probs, reference, atol=1e-6), 'averaged logits differ from the group means'
+    result = measure(lambda: la_average_loop(scores, top_labels_sidx), batch_size, repeat)
+    return [_record('la_averaging', 'LA/SR-GNN', batch_size, n_items, result, _check(check))]
+
+
+@benchmark('get_metric_scores')
+def bench_get_metric_scores(batch_size, n_items, rng, repeat):
+    utils = load('Baselines/SR-GNN', 'utils')
+    scores = torch.randn(batch_size, n_items - 1, device='cuda' if torch.cuda.is_available() else 'cpu')
+    targets = rng.integers(1, n_items, batch_size)
+
+    def check():
+        k = 20
+        hits, mrrs, cov = utils.get_metric_scores(scores, targets, k, [[], [], []])
+        top = scores.topk(k)[1].cpu().numpy()
+        match = top == (targets - 1).reshape(-1, 1)
+        found = match.any(1)
+        assert np.array_equal(np.asarray(hits, dtype=bool), found), 'hits differ'
+        assert np.allclose(mrrs, np.where(found, 1 / (match.argmax(1) + 1), 0)), 'mrr differs'
+        assert sorted(cov) == np.unique(top).tolist(), 'coverage differs'
+    result = measure(lambda: utils.get_metric_scores(scores, targets, 20, [[], [], []]), batch_size, repeat)
+    return [_record('get_metric_scores', 'Baselines/SR-GNN', batch_size, n_items, result, _check(check))]
+
+
+def build_model(variant, n_items, batch_size):
+    """The model module and the model of a variant, built as its main.py does with the default options."""
+    module = load(variant, model_module(variant))
+    opt = main_defaults(variant, dataset='benchmark', **{batch_size_dest(main_defaults(variant)): batch_size})
+    ctor = re.search(r"model = trans_to_cuda\((.*)\)\n", open(os.path.join(ROOT, variant, 'main.py')).read()).group(1)
+    model = eval(ctor, dict(vars(module), opt=opt, n_node=n_items, n_items=n_items, num_items=n_items))
+    return module, module.trans_to_cuda(model)
+
+
+@benchmark('compute_scores')
+def bench_compute_scores(batch_size, n_items, rng, repeat):
+    # the inputs of compute_scores are captured from one evaluate() call of the model
+    records = []
+    seqs, targets = sessions(batch_size, n_items, rng)
+    for model_name in MODELS:
+        variant = f'Baselines/{model_name}'
+        try:
+            module, model = build_model(variant, n_items, batch_size)
+        except ImportError as e:
+            records.append(_record('compute_scores', variant, batch_size, n_items, {}, skipped=str(e)))
+            continue
+        if not hasattr(model, 'compute_scores'):
+            continue
+        captured = []
+        compute_scores = model.compute_scores
+        model.compute_scores = lambda *args: captured.append(args) or compute_scores(*args)
+        data = _data(load(variant, 'utils'), seqs, targets)
+        kwargs = _fill(module.evaluate, model=model, test_data=data, n_node=n_items, n_items=n_items,
+                       top_labels=_top_labels(targets), input_aug_type=None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            module.evaluate(**kwargs)
+        # evaluate() runs in inference mode, its tensors are cloned to take part in autograd below
+        args = [arg.clone() if torch.is_tensor(arg) else arg for arg in captured[0]]
+
+        def run():
+            with torch.no_grad():
+                return compute_scores(*args)
+
+        def check():
+            # the evaluation path against the training one, with autograd and nothing cached, and against the
+            # scores of every session on its own
+            scores = run()
+            with torch.enable_grad():
+                reference = compute_scores(*args).detach()
+            assert torch.allclose(scores, reference, atol=1e-5), 'scores differ from the autograd path'
+            rows = [arg[:1] if torch.is_tensor(arg) and len(arg) == len(scores) else arg for arg in args]
+            with torch.no_grad():
+                single = compute_scores(*rows)
+            assert torch.allclose(scores[:1], single, atol=1e-5), 'scores depend on the rest of the batch'
+        records.append(_record('compute_scores', variant, batch_size, n_items, measure(run, batch_size, repeat),
+                               _check(check)))
+    return records
+
+
+def eop_multigraphs_reference(seqs):
+    # node items, edges, last nodes and node counts of the EOP multigraphs of sessions, built one session at a
+    # time as the original seq_to_eop_multigraph and numbered across the batch as dgl.batch does
+    iid, src, dst, last, num_nodes = [], [], [], [], []
+    for seq in seqs:
+        items = np.unique(seq)
+        iid2nid = {item: len(iid) + k for k, item in enumerate(items)}
+        nids = [iid2nid[item] for item in seq]
+        src += nids[:-1]
+        dst += nids[1:]
+        last.append(iid2nid[seq[-1]])
+        iid += items.tolist()
+        num_nodes.append(len(items))
+    return iid, src, dst, last, num_nodes
+
+
+@benchmark('collate_fn')
+def bench_collate_fn(batch_size, n_items, rng, repeat):
+    try:
+        collate = load('Baselines/EOPA', 'collate')
+        utils = load('Baselines/EOPA', 'utils')
+    except ImportError as e:
+        return [_record('collate_fn', 'Baselines/EOPA', batch_size, n_items, {}, skipped=str(e))]
+    seqs, targets = sessions(batch_size, n_items, rng)
+    dataset = utils.Dataset([s + [t] for s, t in zip(seqs, targets)], sort_by_length=False)
+    collate_fn = collate.collate_fn_factory(collate.seqs_to_eop_multigraph)
+    batch = [dataset[j] for j in range(min(batch_size, len(dataset)))]
+
+    def check():
+        (graph,), labels = collate_fn(batch)
+        iid, src, dst, last, num_nodes = eop_multigraphs_reference([seq for seq, _ in batch])
+        assert graph.iid.tolist() == iid, 'node items differ'
+        assert graph.src.tolist() == src and graph.dst.tolist() == dst, 'edges differ'
+        assert graph.last.tolist() == last, 'last nodes differ'
+        assert graph.batch_num_nodes.tolist() == num_nodes, 'node counts differ'
+        assert labels.tolist() == [label for _, label in batch], 'labels differ'
+    result = measure(lambda: collate_fn(batch), len(batch), repeat)
+    return [_record('collate_fn', 'Baselines/EOPA', batch_size, n_items, result, _check(check))]
+
+
+@benchmark('create_aug_sessions')
+def bench_create_aug_sessions(batch_size, n_items, rng, repeat):
+    utils = load('random/NARM', 'utils')
+    seqs, targets = sessions(batch_size, n_items, rng)
+    targets = np.asarray(targets)
+    records = []
+    for aug_type in ('deletion', 'insertion'):
+        def check():
+            items, lens = augment.from_lists(seqs)
+            out, out_lens, sidx = augment.augment(items, lens, aug_type, np.random.default_rng(0))
+            for aug, j in zip(augment.to_lists(out, out_lens), sidx):
+                short, long = (aug, seqs[j]) if aug_type == 'deletion' else (seqs[j], aug)
+                assert len(long) == len(short) + 1, f'{aug_type} changed the length by more than one'
+                assert any(long[:p] + long[p + 1:] == short for p in range(len(long))), \
+                    f'{aug_type} changed more than one item'
+                if aug_type == 'insertion':
+                    assert set(aug) <= set(items.tolist()), 'insertion used an item outside the batch'
+        aug_rng = np.random.default_rng(0)
+        result = measure(lambda: utils.create_aug_sessions(seqs, targets, aug_type, aug_rng), batch_size, repeat)
+        records.append(_record(f'create_aug_sessions_{aug_type}', 'random/NARM', batch_size, n_items, result,
+                               _check(check)))
+    return records
+
+
+def get_overlap_reference(sessions):
+    # pairwise jaccard overlap of the item sets
+    sets = [set(s) - {0} for s in sessions]
+    matrix = np.ones((len(sets), len(sets)))
+    for a in range(len(sets)):
+        for b in range(len(sets)):
+            if a != b:
+                union = len(sets[a] | sets[b])
+                matrix[a, b] = len(sets[a] & sets[b]) / union if union else 0
+    return matrix
+
+
+@benchmark('get_overlap')
+def bench_get_overlap(batch_size, n_items, rng, repeat):
+    utils = load('Baselines/SR-GNN', 'utils')
+    seqs, targets = sessions(batch_size, n_items, rng)
+    data = _data(utils, seqs, targets)
+    items = np.asarray(data.get_slice(np.arange(batch_size), **_fill(data.get_slice, mixup=True))[2])
+
+    def check():
+        matrix, _ = data.get_overlap(items)
+        assert np.allclose(matrix.cpu().numpy(), get_overlap_reference(items.tolist()), atol=1e-6), \
+            'overlap differs from the pairwise jaccard'
+    result = measure(lambda: data.get_overlap(items), batch_size, repeat)
+    return [_record('get_overlap', 'Baselines/SR-GNN', batch_size, n_items, result, _check(check))]
+
+
+def run(names=None, batch_sizes=(32, 128, 512), n_items=(1000, 43098), repeat=20, seed=0):
+    records = []
+    for name in names or BENCHMARKS:
+        for n in n_items:
+            for batch_size in batch_sizes:
+                for record in BENCHMARKS[name](batch_size, n, np.random.default_rng(seed), repeat):
+                    print(_summary(record))
+                    records.append(record)
+    return records
+
+
+def _summary(r):
+    line = f"{r['benchmark']:<30} {r['variant']:<18} b={r['batch_size']:<5} n={r['n_items']:<8}"
+    if 'skipped' in r:
+        return line + f" skipped: {r['skipped']}"
+    line += f" p50 {r['p50_ms']:9.3f} ms  p99 {r['p99_ms']:9.3f} ms  {r['sessions_per_sec']:10.0f} sessions/s"
+    return line + (f"  check {r['check']}" if r['check'] is not None else '')
@@ -0,0 +1,161 @@
+"""Synthetic session datasets in the formats the variants read.
+
+    python -m benchmark.synthetic --name synthetic --n_items 1000000 --n_train 20000000
+
+writes, under --out_dir (the top of the tree by default):
+    Dataset/{name}/train.txt, test.txt      pickled (sequences, targets), one record per session prefix
+    Dataset/{name}/n_node.txt               pickled item count, read by main.py for unknown dataset names
+    Dataset_eopa/{name}/train.txt, test.txt one comma separated session per line
+    Dataset_eopa/{name}/num_items.txt
+
+Sessions are generated and written in chunks, so memory stays bounded by the
+chunk size and the O(n_items) popularity tables whatever the dataset size.
+Item ids run from 1 to n_items - 1, 0 is the padding item.
+"""
+import argparse
+import os
+import pickle
+import numpy as np
+
+
+class SessionGenerator():
+    """Random sessions with Zipfian popularity, log-normal lengths and local transitions.
+
+    The first item of a session follows a Zipf(alpha) popularity over the
+    catalogue. Every next item repeats an earlier item of the session with
+    probability `repeat`, moves to a neighbour of the previous item (a Laplace
+    step of scale `window` over the item ids) with probability `locality`, and
+    is drawn from the popularity otherwise. Popularity ranks are shuffled over
+    the ids, so popular items are not neighbours of each other.
+    """
+    def __init__(self, n_items, alpha=1.0, len_mean=5.0, len_sigma=0.8, min_len=2, max_len=50, locality=0.3,
+                 window=50, repeat=0.1, seed=0):
+        self.n_items = n_items
+        self.len_mu = np.log(len_mean) - len_sigma ** 2 / 2
+        self.len_sigma = len_sigma
+        self.min_len, self.max_len = min_len, max_len
+        self.locality, self.window, self.repeat = locality, window, repeat
+        self.rng = np.random.default_rng(seed)
+        weights = np.arange(1, n_items, dtype=np.float64) ** -alpha
+        self.cdf = np.cumsum(weights)
+        self.cdf /= self.cdf[-1]
+        self.ids = self.rng.permutation(np.arange(1, n_items, dtype=np.int64))
+
+    def popular(self, n):
+        idx = np.searchsorted(self.cdf, self.rng.random(n), side='right')
+        return self.ids[np.minimum(idx, len(self.ids) - 1)]
+
+    def lengths(self, n):
+        lens = np.rint(self.rng.lognormal(self.len_mu, self.len_sigma, n)).astype(np.int64)
+        return np.clip(lens, self.min_len, self.max_len)
+
+    def chunk(self, n):
+        """n sessions as a right padded (n x max length) array and their lengths."""
+        lens = self.lengths(n)
+        out = np.zeros((n, lens.max()), dtype=np.int64)
+        out[:, 0] = self.popular(n)
+        for p in range(1, out.shape[1]):
+            rows = np.nonzero(lens > p)[0]
+            u = self.rng.random(len(rows))
+            step = np.rint(self.rng.laplace(0, self.window, len(rows))).astype(np.int64)
+            step[step == 0] = 1
+            near = np.clip(out[rows, p - 1] + step, 1, self.n_items - 1)
+            earlier = out[rows, self.rng.integers(0, p, len(rows))]
+            out[rows, p] = np.where(u < self.repeat, earlier,
+                                    np.where(u < self.repeat + self.locality, near, self.popular(len(rows))))
+        return out, lens
+
+    def sessions(self, n):
+        out, lens = self.chunk(n)
+        return [row[:l].tolist() for row, l in zip(out, lens)]
+
+
+def records(sessions, prefixes=True):
+    # (sequence, target) records as the preprocessing writes them: every prefix with its next item, longest first
+    seqs, targets = [], []
+    for s in sessions:
+        for k in range(len(s) - 1, 0, -1) if prefixes else [len(s) - 1]:
+            seqs.append(s[:k])
+            targets.append(s[k])
+    return seqs, targets
+
+
+def _appends(items):
+    # pickle opcodes appending `items` to the list on top of the stack: the pickle of the list without
+    # its protocol header, list creation and memo (']q\x00') and the STOP
+    return pickle.dumps(items, protocol=2)[5:-1]
+
+
+def write_split(gen, n_sessions, pickle_path, tsv_path=None, prefixes=True, chunk=100000):
+    """Streams n_sessions generated sessions to a (sequences, targets) pickle and optionally an EOPA TSV."""
+    targets_path = pickle_path + '.targets'
+    tsv = open(tsv_path, 'w') if tsv_path is not None else None
+    n_records = 0
+    with open(pickle_path, 'wb') as f, open(targets_path, 'wb') as t:
+        f.write(b'\x80\x02]')  # PROTO 2, EMPTY_LIST
+        for start in range(0, n_sessions, chunk):
+            sessions = gen.sessions(min(chunk, n_sessions - start))
+            seqs, targets = records(sessions, prefixes)
+            f.write(_appends(seqs))
+            t.write(_appends(targets))
+            n_records += len(seqs)
+            if tsv is not None:
+                tsv.writelines(','.join(map(str, s)) + '\n' for s in sessions)
+        f.write(b']')
+        t.close()
+        with open(targets_path, 'rb') as src:
+            while True:
+                block = src.read(1 << 24)
+                if not block:
+                    break
+                f.write(block)
+        f.write(b'\x86.')  # TUPLE2, STOP
+    os.remove(targets_path)
+    if tsv is not None:
+        tsv.close()
+    return n_records
+
+
+def write_dataset(out_dir, name, n_items, n_train, n_test, eopa=True, prefixes=True, chunk=100000, **kwargs):
+    gen = SessionGenerator(n_items, **kwargs)
+    data_dir = os.path.join(out_dir, 'Dataset', name)
+    eopa_dir = os.path.join(out_dir, 'Dataset_eopa', name)
+    os.makedirs(data_dir, exist_ok=True)
+    if eopa:
+        os.makedirs(eopa_dir, exist_ok=True)
+        with open(os.path.join(eopa_dir, 'num_items.txt'), 'w') as f:
+            f.write(f'{n_items}\n')
+    with open(os.path.join(data_dir, 'n_node.txt'), 'wb') as f:
+        pickle.dump(n_items, f)
+    counts = {}
+    for split, n in (('train', n_train), ('test', n_test)):
+        counts[split] = write_split(gen, n, os.path.join(data_dir, f'{split}.txt'),
+                                    os.path.join(eopa_dir, f'{split}.txt') if eopa else None, prefixes, chunk)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmark.synthetic')
+    parser.add_argument('--name', default='synthetic', help='dataset name')
+    parser.add_argument('--out_dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help='directory holding Dataset/ and Dataset_eopa/')
+    parser.add_argument('--n_items', type=int, default=43098, help='catalogue size, including the padding item 0')
+    parser.add_argument('--n_train', type=int, default=100000, help='training sessions')
+    parser.add_argument('--n_test', type=int, default=10000, help='test sessions')
+    parser.add_argument('--alpha', type=float, default=1.0, help='zipf exponent of the item popularity')
+    parser.add_argument('--len_mean', type=float, default=5.0, help='mean session length')
+    parser.add_argument('--len_sigma', type=float, default=0.8, help='sigma of the log-normal session length')
+    parser.add_argument('--max_len', type=int, default=50, help='longest session')
+    parser.add_argument('--locality', type=float, default=0.3, help='probability of moving to a neighbouring item')
+    parser.add_argument('--window', type=float, default=50, help='scale of the moves to neighbouring items')
+    parser.add_argument('--repeat', type=float, default=0.1, help='probability of repeating an item of the session')
+    parser.add_argument('--last_only', action='store_true', help='one record per session instead of one per prefix')
+    parser.add_argument('--no_eopa', action='store_true', help='skip the Dataset_eopa TSV files')
+    parser.add_argument('--chunk', type=int, default=100000, help='sessions generated at a time')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    opt = parser.parse_args()
+    counts = write_dataset(opt.out_dir, opt.name, opt.n_items, opt.n_train, opt.n_test, eopa=not opt.no_eopa,
+                           prefixes=not opt.last_only, chunk=opt.chunk, alpha=opt.alpha, len_mean=opt.len_mean,
+                           len_sigma=opt.len_sigma, max_len=opt.max_len, locality=opt.locality, window=opt.window,
+                           repeat=opt.repeat, seed=opt.seed)
+    print(f"{opt.name}: {counts['train']} training and {counts['test']} test records over {opt.n_items} items")
@@ -0,0 +1,5 @@
+"""Runs of several variants from one command.
+
+    python -m multirun.lockstep   variants trained side by side on one shared batch stream
+    python -m multirun.sweep      parallel hyper-parameter sweep of a variant with asynchronous successive halving
+"""
@@ -0,0 +1,18 @@
+import importlib.util
+import os
+import sys
+
+from benchmark.common import ROOT
+
+
+def load_utils(variant, name='_multirun_utils'):
+    """The utils.py of a variant, imported under `name` so that it does not shadow the runner's modules."""
+    path = os.path.join(ROOT, variant)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(path, 'utils.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, path)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(path)
+    return module
@@ -0,0 +1,258 @@
+"""Trains several variants in lockstep on one shared batch stream.
+
+    python -m multirun.lockstep --dataset diginetica Baselines/SR-GNN LA/SR-GNN FLAG/SR-GNN "GraphMix/SR-GNN:--lam 0.5"
+
+Every variant trains in its own process through its unmodified main.py, with
+the arguments after the ':' of its spec. The parent process draws one batch
+order per epoch, builds the session graphs of every training and test batch
+once (see session_graphs in utils.py) and streams them to all variants, so the
+graph construction runs once for all of them instead of once per variant.
+SR_SAN builds no graphs, only the unique items of the sessions (session_items
+in its utils.py); the stream carries what the first variant builds, and a
+variant that builds the other kind takes the order from the stream and builds
+its batches itself.
+Variants take the batches in the same order and at most --lead messages ahead
+of the slowest one.
+
+A variant whose batch differs from the stream's, e.g. one augmented in
+get_slice, builds its graphs itself; the number of shared batches is printed
+by every variant at the end. Only the graph models (SR-GNN, NISER, SR_SAN,
+TAGNN++) build their batches this way, so NARM and EOPA variants are not
+accepted.
+"""
+import argparse
+import functools
+import hashlib
+import importlib
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import runpy
+import shlex
+import sys
+import numpy as np
+
+from benchmark.common import ROOT, main_defaults, batch_size_dest, batch_size_option
+from .common import load_utils
+
+# main.py arguments that change the batches a variant asks for, or ask for them from another process
+UNSUPPORTED = ['--async_eval', '--resume', '--aug_workers', '--validation', '--eval_batch_size', '--eval_ckpt',
+               '--eval_cache']
+
+# what utils.py builds the batches of a graph model with
+BUILDERS = ['session_graphs', 'session_items']
+
+_build = None
+
+
+def _key(inputs):
+    # identifies a batch by its padded sessions
+    inputs = np.ascontiguousarray(inputs)
+    key = hashlib.blake2b(str(inputs.shape).encode(), digest_size=16)
+    key.update(inputs.data)
+    return key.digest()
+
+
+def builder(variant):
+    source = open(os.path.join(ROOT, variant, 'utils.py')).read()
+    return next((name for name in BUILDERS if f'def {name}(' in source), None)
+
+
+def _init_builder(variant):
+    global _build
+    _build = getattr(load_utils(variant), builder(variant))
+
+
+def _build_batch(inputs):
+    payload = pickle.dumps(tuple(np.array(value) for value in _build(inputs)), pickle.HIGHEST_PROTOCOL)
+    return _key(inputs), payload
+
+
+def _slices(order, batch_size):
+    # same batches as Data.generate_batch, over `order`
+    return [order[k:k + batch_size] for k in range(0, len(order), batch_size)]
+
+
+class Stream():
+    """The batch stream as seen from a variant's process."""
+    def __init__(self, variant, messages, batch_size, name, build, shared):
+        self.variant = variant
+        self.messages = messages
+        self.batch_size = batch_size
+        self.name, self.build = name, build
+        # whether the stream carries what this variant builds
+        self.sharing = shared
+        self.pending = None
+        self.shared, self.built = 0, 0
+
+    def _next(self, kind):
+        while True:
+            try:
+                message = self.messages.get(timeout=1)
+                break
+            except queue.Empty:
+                if not mp.parent_process().is_alive():
+                    raise SystemExit(f'{self.variant}: the batch stream stopped')
+        if message[0] != kind:
+            raise RuntimeError(f'{self.variant} asked for a {kind} but the stream sent a {message[0]}')
+        return message[1:]
+
+    def generate_batch(self, data, batch_size):
+        slices, = self._next('order')
+        if batch_size != self.batch_size or data.length != sum(len(s) for s in slices):
+            raise RuntimeError(f'{self.variant} batches {data.length} sessions by {batch_size}, '
+                               f'the stream {sum(len(s) for s in slices)} by {self.batch_size}')
+        return slices
+
+    def get_slice(self):
+        self.pending = self._next('batch')
+
+    def build_batch(self, inputs):
+        pending, self.pending = self.pending, None
+        if self.sharing and pending is not None and pending[0] == _key(inputs):
+            self.shared += 1
+            if self.name == 'session_items':
+                return pickle.loads(pending[1])
+            alias_inputs, A, items = pickle.loads(pending[1])
+            return alias_inputs.tolist(), list(A), items.tolist()
+        self.built += 1
+        return self.build(inputs)
+
+
+def _train(variant, argv, messages, batch_size, threads, stream_builder):
+    # runs in the variant's process: hooks its utils.py to the stream, then runs its main.py
+    import torch
+    torch.set_num_threads(threads)
+    os.chdir(os.path.join(ROOT, variant))
+    sys.path.insert(0, '.')
+    sys.argv = ['main.py'] + argv
+    utils = importlib.import_module('utils')
+    name = builder(variant)
+    stream = Stream(variant, messages, batch_size, name, getattr(utils, name), name == stream_builder)
+    get_slice = utils.Data.get_slice
+
+    @functools.wraps(get_slice)
+    def stream_get_slice(self, i, *args, **kwargs):
+        stream.get_slice()
+        return get_slice(self, i, *args, **kwargs)
+    utils.Data.get_slice = stream_get_slice
+    utils.Data.generate_batch = lambda self, batch_size: stream.generate_batch(self, batch_size)
+    setattr(utils, name, stream.build_batch)
+    runpy.run_path('main.py', run_name='__main__')
+    print(f'{variant}: {stream.shared} of {stream.shared + stream.built} batches from the shared stream')
+
+
+def parse_spec(spec):
+    variant, _, args = spec.partition(':')
+    variant = variant.strip().rstrip('/')
+    argv = shlex.split(args)
+    if not os.path.exists(os.path.join(ROOT, variant, 'main.py')):
+        raise SystemExit(f'{variant} is not a variant directory')
+    if builder(variant) is None:
+        raise SystemExit(f'{variant} builds no session graphs to share')
+    for arg in argv:
+        if arg.split('=')[0] in UNSUPPORTED:
+            raise SystemExit(f'{variant}: {arg} is not supported in lockstep runs')
+    return variant, argv
+
+
+class Lockstep():
+    def __init__(self, specs, dataset, epochs, batch_size=None, seed=0, workers=1, threads=None, lead=8):
+        self.variants = [parse_spec(spec) for spec in specs]
+        names = [variant for variant, _ in self.variants]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            # their checkpoints and telemetry would share the same directories
+            raise SystemExit(f'variants given twice: {", ".join(duplicates)}')
+        self.dataset, self.epochs, self.seed, self.workers, self.lead = dataset, epochs, seed, workers, lead
+        if batch_size is None:
+            opt = main_defaults(names[0])
+            batch_size = getattr(opt, batch_size_dest(opt))
+        self.batch_size = batch_size
+        self.threads = threads or max(1, (os.cpu_count() or 1) // len(self.variants))
+
+    def _inputs(self, utils, split):
+        seqs, _ = pickle.load(open(os.path.join(ROOT, 'Dataset', self.dataset, f'{split}.txt'), 'rb'))
+        inputs, _, _ = utils.data_masks(seqs, [0])
+        return np.asarray(inputs)
+
+    def messages(self, build):
+        # the messages every variant reads in order: per epoch the training order and batches, then the test ones
+        utils = load_utils(self.variants[0][0])
+        train, test = self._inputs(utils, 'train'), self._inputs(utils, 'test')
+        rng = np.random.default_rng(self.seed)
+        test_slices = _slices(np.arange(len(test)), self.batch_size)
+        for epoch in range(self.epochs):
+            for inputs, slices in ((train, _slices(rng.permutation(len(train)), self.batch_size)),
+                                   (test, test_slices)):
+                yield 'order', slices
+                for key, payload in build(inputs[s] for s in slices):
+                    yield 'batch', key, payload
+
+    def run(self):
+        ctx = mp.get_context('spawn')
+        procs = []
+        for variant, argv in self.variants:
+            argv = ['--dataset', self.dataset, '--epoch', str(self.epochs),
+                    batch_size_option(variant), str(self.batch_size)] + argv
+            # the test batches come from the stream at every evaluation
+            argv += ['--eval_cache', 'off']
+            messages = ctx.Queue(self.lead)
+            proc = ctx.Process(target=_train, args=(variant, argv, messages, self.batch_size, self.threads,
+                                                    builder(self.variants[0][0])), name=variant)
+            proc.start()
+            procs.append((proc, messages))
+
+        pool = None
+        if self.workers > 1:
+            pool = ctx.Pool(self.workers, _init_builder, (self.variants[0][0],))
+            build = functools.partial(pool.imap, _build_batch, chunksize=1)
+        else:
+            _init_builder(self.variants[0][0])
+            build = functools.partial(map, _build_batch)
+        live = list(procs)
+        try:
+            for message in self.messages(build):
+                for proc, messages in list(live):
+                    while True:
+                        try:
+                            messages.put(message, timeout=1)
+                            break
+                        except queue.Full:
+                            if not proc.is_alive():
+                                # stopped early, e.g. by its patience
+                                messages.cancel_join_thread()
+                                live.remove((proc, messages))
+                                break
+                if not live:
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+            for proc, _ in procs:
+                proc.join()
+        failed = [proc.name for proc, _ in procs if proc.exitcode != 0]
+        for proc, _ in procs:
+            print(f'{proc.name:<20} exit code {proc.exitcode}')
+        return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m multirun.lockstep')
+    parser.add_argument('variants', nargs='+', help="variant directories, each optionally followed by ':' and "
+                                                    "its own main.py arguments")
+    parser.add_argument('--dataset', required=True, help='dataset name, read from Dataset/')
+    parser.add_argument('--epoch', type=int, default=30, help='the number of epochs to train for')
+    parser.add_argument('--batch_size', type=int, default=None, help='batch size of every variant, the main.py '
+                                                                     'default of the first one if unset')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the batch order')
+    parser.add_argument('--workers', type=int, default=1, help='processes building the session graphs')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads of every variant, '
+                                                                  'the cores split evenly if unset')
+    parser.add_argument('--lead', type=int, default=8, help='messages the stream may run ahead of a variant')
+    opt = parser.parse_args()
+    failed = Lockstep(opt.variants, opt.dataset, opt.epoch, opt.batch_size, opt.seed, opt.workers, opt.threads,
+                      opt.lead).run()
+    if failed:
+        raise SystemExit(f'failed: {", ".join(failed)}')
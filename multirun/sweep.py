@@ -0,0 +1,344 @@
+"""Parallel hyper-parameter sweep of one variant with asynchronous successive halving (ASHA).
+
+    python -m multirun.sweep LA/SR-GNN --dataset diginetica --space lr=0.001,0.0005,0.0001 l2=1e-5,1e-4 \
+        lam=0.3,0.6,0.9 lr_dc_step=3,5 hiddenSize=100,200 --trials 30 --jobs 4 --threads 2 --epoch 27
+
+Every trial runs the variant's unmodified main.py in a process of its own, in
+{store}/trials/{trial}, so checkpoints and telemetry stay apart, with at most
+--threads torch threads and, when the cores suffice, pinned to cores of its own.
+Trials report their get_best_result metrics after every epoch. With the
+stopping form of ASHA, a trial reaching a rung (--min_epochs * eta^k completed
+epochs) is stopped unless its best --metric so far is in the top 1/eta of all
+trials that reached the same rung.
+
+For the variants whose Data pads sessions with data_masks, the padded training
+and test sessions are written once to {store}/data, with a hash of each split,
+and memory mapped by every trial, and the in place shuffle of Data.generate_batch is replaced by the same
+shuffle of an index, so the trials keep sharing the mapped pages.
+
+Every finished trial is appended to {store}/trials.jsonl with its arguments,
+status (completed, pruned or failed), per epoch metrics and timing.
+"""
+import argparse
+import ast
+import functools
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import runpy
+import shlex
+import sys
+import textwrap
+import time
+import numpy as np
+
+from benchmark.common import ROOT, main_options
+from .common import load_utils
+
+KS = [10, 20]
+METRICS = ['HR', 'MRR', 'Cov']
+
+# Data.generate_batch of the variants that shuffle their arrays in place
+_IN_PLACE_SHUFFLE = ast.dump(ast.parse('''
+def generate_batch(self, batch_size):
+    if self.shuffle:
+        shuffled_arg = np.arange(self.length)
+        np.random.shuffle(shuffled_arg)
+        self.inputs = self.inputs[shuffled_arg]
+        self.mask = self.mask[shuffled_arg]
+        self.targets = self.targets[shuffled_arg]
+    n_batch = int(self.length / batch_size)
+    if self.length % batch_size != 0:
+        n_batch += 1
+    slices = np.split(np.arange(n_batch * batch_size), n_batch)
+    slices[-1] = slices[-1][:(self.length - batch_size * (n_batch - 1))]
+    return slices
+'''))
+
+
+def metric_index(metric):
+    name, _, k = metric.partition('@')
+    if name not in METRICS or not k.isdigit() or int(k) not in KS:
+        raise ValueError(f'unknown metric {metric}, select one of HR/MRR/Cov@10/20')
+    return KS.index(int(k)), METRICS.index(name)
+
+
+def prepare_data(variant, dataset, data_dir):
+    """Writes the padded sessions of both splits for memory mapping, None if the variant pads otherwise."""
+    utils = load_utils(variant)
+    if 'data_masks(' not in inspect.getsource(utils.Data.__init__):
+        return None
+    os.makedirs(data_dir, exist_ok=True)
+    for split in ('train', 'test'):
+        seqs, _ = pickle.load(open(os.path.join(ROOT, 'Dataset', dataset, f'{split}.txt'), 'rb'))
+        inputs, mask, _ = utils.data_masks(seqs, [0])
+        inputs, mask = np.asarray(inputs), np.asarray(mask)
+        np.save(os.path.join(data_dir, f'{split}_inputs.npy'), inputs)
+        np.save(os.path.join(data_dir, f'{split}_mask.npy'), mask)
+        with open(os.path.join(data_dir, f'{split}.blake2b'), 'w') as f:
+            f.write(_digest(inputs, mask))
+    return data_dir
+
+
+def _digest(inputs, mask):
+    # hash of the whole padded sessions and mask, shapes and dtypes included
+    key = hashlib.blake2b(digest_size=16)
+    for array in (inputs, mask):
+        array = np.ascontiguousarray(array)
+        key.update(f'{array.shape} {array.dtype}'.encode())
+        key.update(array.data)
+    return key.hexdigest()
+
+
+def _same_sessions(seqs, digest):
+    # whether data_masks(seqs, [0]) gives the padded sessions of `digest`, padded here with numpy
+    lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    if not len(lens):
+        return False
+    mask = np.arange(lens.max()) < lens[:, None]
+    inputs = np.zeros(mask.shape, dtype=np.int64)
+    inputs[mask] = np.fromiter(itertools.chain.from_iterable(seqs), dtype=np.int64, count=int(lens.sum()))
+    return _digest(inputs, mask.astype(np.int64)) == digest
+
+
+def _share_data(utils, data_dir):
+    # hooks data_masks to the mapped arrays and generate_batch to an index shuffle
+    data_masks = utils.data_masks
+    shared = [(np.load(os.path.join(data_dir, f'{split}_inputs.npy'), mmap_mode='r'),
+               np.load(os.path.join(data_dir, f'{split}_mask.npy'), mmap_mode='r'),
+               open(os.path.join(data_dir, f'{split}.blake2b')).read()) for split in ('train', 'test')]
+
+    @functools.wraps(data_masks)
+    def shared_masks(all_usr_pois, item_tail):
+        for inputs, mask, digest in shared:
+            if item_tail == [0] and len(all_usr_pois) == len(inputs) and _same_sessions(all_usr_pois, digest):
+                return inputs, mask, inputs.shape[1]
+        return data_masks(all_usr_pois, item_tail)
+    utils.data_masks = shared_masks
+
+    generate_batch = utils.Data.generate_batch
+    if ast.dump(ast.parse(textwrap.dedent(inspect.getsource(generate_batch)))) != _IN_PLACE_SHUFFLE:
+        return
+
+    @functools.wraps(generate_batch)
+    def index_generate_batch(self, batch_size):
+        if getattr(self, 'order', None) is None:
+            self.order = np.arange(self.length)
+        if self.shuffle:
+            shuffled_arg = np.arange(self.length)
+            np.random.shuffle(shuffled_arg)
+            self.order = self.order[shuffled_arg]
+        n_batch = int(self.length / batch_size)
+        if self.length % batch_size != 0:
+            n_batch += 1
+        slices = np.split(np.arange(n_batch * batch_size), n_batch)
+        slices[-1] = slices[-1][:(self.length - batch_size * (n_batch - 1))]
+        return [self.order[s] for s in slices]
+    utils.Data.generate_batch = index_generate_batch
+
+
+def _trial(trial, variant, argv, trial_dir, threads, cores, data_dir, reports):
+    # runs in the trial's process
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(threads)
+    os.makedirs(trial_dir, exist_ok=True)
+    os.chdir(trial_dir)
+    sys.path.insert(0, os.path.join(ROOT, variant))
+    sys.argv = ['main.py'] + argv
+    utils = importlib.import_module('utils')
+    if data_dir is not None:
+        _share_data(utils, data_dir)
+    name = 'get_best_result' if hasattr(utils, 'get_best_result') else 'get_best_results'
+    get_best_result = getattr(utils, name)
+
+    @functools.wraps(get_best_result)
+    def reported(results, epoch, best_results, best_epochs):
+        flag = get_best_result(results, epoch, best_results, best_epochs)
+        reports.put(('epoch', trial, epoch, [[float(v) for v in r] for r in results],
+                     [[float(v) for v in r] for r in best_results], time.time()))
+        return flag
+    setattr(utils, name, reported)
+    runpy.run_path(os.path.join(ROOT, variant, 'main.py'), run_name='__main__')
+    reports.put(('done', trial))
+
+
+class ASHA():
+    """Stopping rule of asynchronous successive halving over the rungs min_epochs * eta^k."""
+    def __init__(self, min_epochs, eta, max_epochs):
+        self.eta = eta
+        self.rungs = {}
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs[epochs] = []
+            epochs *= eta
+
+    def keep(self, epochs, value):
+        # whether a trial with best metric `value` after `epochs` completed epochs continues
+        if epochs not in self.rungs:
+            return True
+        values = self.rungs[epochs]
+        values.append(value)
+        return value >= np.percentile(values, 100 * (1 - 1 / self.eta))
+
+
+def configs(space, trials=None, seed=0):
+    """The grid of `space` ({argument: [values]}), or `trials` distinct points of it drawn at random."""
+    names = sorted(space)
+    grid = list(itertools.product(*(space[name] for name in names)))
+    if trials is not None and trials < len(grid):
+        rng = np.random.default_rng(seed)
+        grid = [grid[k] for k in sorted(rng.choice(len(grid), trials, replace=False))]
+    return [dict(zip(names, values)) for values in grid]
+
+
+def parse_space(variant, specs):
+    # names as on the command line (batch-size) or as the dest (batch_size), kept as on the command line
+    names = {dest: option.lstrip('-') for dest, option in main_options(variant).items()}
+    names.update({name: name for name in list(names.values())})
+    space = {}
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if name not in names:
+            raise SystemExit(f'{variant}/main.py has no --{name} argument')
+        space[names[name]] = values.split(',')
+    return space
+
+
+class Sweep():
+    def __init__(self, variant, dataset, space, store, epochs, trials=None, jobs=1, threads=1, metric='HR@20',
+                 min_epochs=1, eta=3, fixed=(), seed=0, share_data=True):
+        self.variant, self.dataset, self.store, self.epochs = variant, dataset, store, epochs
+        self.configs = configs(space, trials, seed)
+        self.jobs, self.threads, self.fixed, self.share_data = jobs, threads, list(fixed), share_data
+        self.metric = metric_index(metric)
+        self.asha = ASHA(min_epochs, eta, epochs)
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        self.cores = [cores[k * threads:(k + 1) * threads] for k in range(jobs)] if jobs * threads <= len(cores) \
+            else [None] * jobs
+
+    def _prepare(self):
+        os.makedirs(os.path.join(self.store, 'trials'), exist_ok=True)
+        # trials run two levels below the store, where main.py looks for ../../Dataset
+        for name in ('Dataset', 'Dataset_eopa'):
+            link = os.path.join(self.store, name)
+            if os.path.exists(os.path.join(ROOT, name)) and not os.path.lexists(link):
+                os.symlink(os.path.join(ROOT, name), link)
+        utils = load_utils(self.variant)
+        if hasattr(utils, 'top75_labels'):
+            # cached in the dataset directory, written here once instead of by every trial at the same time
+            data = [pickle.load(open(os.path.join(ROOT, 'Dataset', self.dataset, f'{split}.txt'), 'rb'))
+                    for split in ('train', 'test')]
+            cwd = os.getcwd()
+            os.chdir(os.path.join(ROOT, self.variant))
+            try:
+                utils.top75_labels(data[0], data[1], self.dataset)
+            finally:
+                os.chdir(cwd)
+        if self.share_data:
+            return prepare_data(self.variant, self.dataset, os.path.join(self.store, 'data'))
+        return None
+
+    def _record(self, record):
+        with open(os.path.join(self.store, 'trials.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        best = record['best']
+        print(f"trial {record['trial']:>3} {record['status']:<9} epochs {len(record['epochs']):>3} "
+              f"best {best if best is not None else float('nan'):6.2f}  {' '.join(f'--{k} {v}' for k, v in record['args'].items())}")
+
+    def _handle(self, running, message):
+        if message[1] not in running:
+            return
+        proc, _, record = running[message[1]]
+        if record['status'] == 'pruned':
+            return
+        if message[0] == 'done':
+            record['status'] = 'completed'
+            return
+        _, _, epoch, results, best_results, now = message
+        last = record['epochs'][-1]['end'] if record['epochs'] else record['start']
+        record['epochs'].append({'epoch': epoch, 'results': results, 'end': now, 'time': now - last})
+        record['best'] = best_results[self.metric[0]][self.metric[1]]
+        if not self.asha.keep(len(record['epochs']), record['best']):
+            record['status'] = 'pruned'
+            proc.terminate()
+
+    def run(self):
+        data_dir = self._prepare()
+        ctx = mp.get_context('spawn')
+        reports = ctx.Queue()
+        pending = list(enumerate(self.configs))
+        free, running, done = list(range(self.jobs)), {}, []
+        while pending or running:
+            while pending and free:
+                trial, args = pending.pop(0)
+                slot = free.pop(0)
+                argv = ['--dataset', self.dataset, '--epoch', str(self.epochs)] + self.fixed
+                argv += [token for name, value in args.items() for token in (f'--{name}', value)]
+                proc = ctx.Process(target=_trial, name=f'trial{trial}',
+                                   args=(trial, self.variant, argv, os.path.join(self.store, 'trials', str(trial)),
+                                         self.threads, self.cores[slot], data_dir, reports))
+                proc.start()
+                running[trial] = (proc, slot, {'trial': trial, 'variant': self.variant, 'args': args, 'argv': argv,
+                                               'slot': slot, 'cores': self.cores[slot], 'status': 'failed',
+                                               'start': time.time(), 'epochs': [], 'best': None})
+            try:
+                self._handle(running, reports.get(timeout=1))
+            except queue.Empty:
+                pass
+            exited = [trial for trial, (proc, _, _) in running.items() if proc.exitcode is not None]
+            if exited:
+                # whatever a trial reported is in the queue once its process exited
+                while True:
+                    try:
+                        self._handle(running, reports.get_nowait())
+                    except queue.Empty:
+                        break
+            for trial in exited:
+                proc, slot, record = running.pop(trial)
+                record['exitcode'] = proc.exitcode
+                record['end'] = time.time()
+                record['wall_s'] = record['end'] - record['start']
+                self._record(record)
+                done.append(record)
+                free.append(slot)
+        return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m multirun.sweep')
+    parser.add_argument('variant', help='variant directory, e.g. LA/SR-GNN')
+    parser.add_argument('--dataset', required=True, help='dataset name, read from Dataset/')
+    parser.add_argument('--space', nargs='+', required=True, help='searched main.py arguments as name=v1,v2,...')
+    parser.add_argument('--trials', type=int, default=None, help='points of the grid drawn at random, all if unset')
+    parser.add_argument('--epoch', type=int, default=30, help='epochs of a trial that is never stopped')
+    parser.add_argument('--jobs', type=int, default=1, help='trials running at the same time')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads of every trial')
+    parser.add_argument('--metric', default='HR@20', help='metric ranking the trials: HR/MRR/Cov@10/20')
+    parser.add_argument('--min_epochs', type=int, default=1, help='epochs of the first rung')
+    parser.add_argument('--eta', type=int, default=3, help='reduction factor between rungs')
+    parser.add_argument('--args', default='', help='main.py arguments shared by all trials')
+    parser.add_argument('--store', default=None, help='results directory, sweeps/<variant>-<time> if unset')
+    parser.add_argument('--no_share_data', action='store_true', help='let every trial pad the sessions itself')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the drawn grid points')
+    opt = parser.parse_args()
+    variant = opt.variant.rstrip('/')
+    store = opt.store or os.path.join('sweeps', f"{variant.replace('/', '_')}-{time.strftime('%Y%m%d-%H%M%S')}")
+    sweep = Sweep(variant, opt.dataset, parse_space(variant, opt.space), os.path.abspath(store), opt.epoch,
+                  opt.trials, opt.jobs, opt.threads, opt.metric, opt.min_epochs, opt.eta, shlex.split(opt.args),
+                  opt.seed, not opt.no_share_data)
+    records = sweep.run()
+    print('-' * 100)
+    print(f'Best trials by {opt.metric}, all results in {os.path.join(store, "trials.jsonl")}')
+    for record in sorted(records, key=lambda r: -1 if r['best'] is None else r['best'], reverse=True)[:5]:
+        print(f"trial {record['trial']:>3} {record['best'] or 0:6.2f}  {record['status']:<9} "
+              f"{' '.join(f'--{k} {v}' for k, v in record['args'].items())}")
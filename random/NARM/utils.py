@@ -8,11 +8,13 @@ Modified on January, 2022
 """
 
 import networkx as nx
+import itertools
 import numpy as np
 import random
+from shared.augment import from_lists, random_deletion, random_insertion
 import pdb
 import torch
-import itertools
+from torch.nn.utils.rnn import pack_padded_sequence
 
 
 def get_metric_scores(scores, targets, k, eval):
@@ -121,60 +123,71 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
-def random_deletion(sessions, targets):
-    candidate_sess_idx = [i for i, sess in enumerate(sessions) if len(sess) > 1]
-    aug_sess_sidx = random.sample(candidate_sess_idx, int(len(candidate_sess_idx)*0.8))
+def create_aug_sessions(batch_seqs, targets, input_aug_type, rng):
+    items, lens = from_lists(batch_seqs)
+    return augment_sessions(items, lens, targets, input_aug_type, rng)
 
-    aug_sess = []
-    aug_tars = []
-    for i in aug_sess_sidx:
-        cur_sess = sessions[i].copy()
-        remove_item = random.choice(cur_sess)
-        cur_sess.remove(remove_item)
-        aug_sess.append(cur_sess)
-        aug_tars.append(targets[i])
 
-    return aug_sess, aug_tars
+def augment_sessions(items, lens, targets, input_aug_type, rng):
+    # create_aug_sessions of a ragged batch
+    if input_aug_type == 'deletion':
+        items, lens, sidx = random_deletion(items, lens, rng)
+    elif input_aug_type == 'insertion':
+        items, lens, sidx = random_insertion(items, lens, rng, sample_num=int(len(lens)*0.5))
 
-def random_insertion(sessions, targets, sample_num):
-    aug_sess_sidx = random.sample(range(len(sessions)), sample_num)
-    candidate_item = list(set(itertools.chain.from_iterable(sessions)))
-    
-    aug_sess = []
-    aug_tars = []
-    for i in aug_sess_sidx:
-        cur_sess = sessions[i].copy()
-        insert_index = random.randint(0, len(cur_sess)-1)
-        cur_sess.insert(insert_index, random.choice(candidate_item))
-        aug_sess.append(cur_sess)
-        aug_tars.append(targets[i])
+    return items, lens, targets[sidx]
 
-    return aug_sess, aug_tars
 
-def create_aug_sessions(batch_seqs, targets, input_aug_type, sample_num=50):
+def ragged(sessions):
+    # sessions as one flat item array, the offset of every session in it and its length
+    lens = np.fromiter(map(len, sessions), dtype=np.int64, count=len(sessions))
+    items = np.fromiter(itertools.chain.from_iterable(sessions), dtype=np.int64, count=int(lens.sum()))
+    return items, np.cumsum(lens) - lens, lens
 
-    if input_aug_type == 'deletion':
-        aug_sess, aug_tars = random_deletion(batch_seqs, targets)
-    elif input_aug_type == 'insertion':
-        aug_sess, aug_tars = random_insertion(batch_seqs, targets, int(len(batch_seqs)*0.5))
-            
-    lens = [len(sess) for sess in aug_sess]
-    return aug_sess, np.array(aug_tars), np.array(lens) 
+
+def gather(items, offsets, lens):
+    # the sessions (offsets, lens) of the flat `items`, one after the other
+    return items[np.arange(lens.sum()) + np.repeat(offsets - (np.cumsum(lens) - lens), lens)]
+
+
+def pack_sessions(items, offsets, lens):
+    """The sessions (offsets, lens) of the flat `items` as a PackedSequence of item ids.
+
+    They are padded by one scatter and packed with enforce_sorted=False, so
+    they keep the order of the batch: packing sorts them by length itself and
+    the GRU returns its outputs in the order of the batch again.
+    """
+    positions = np.arange(lens.max()) < lens[:, None]
+    padded = np.zeros(positions.shape, dtype=np.int64)
+    padded[positions] = gather(items, offsets, lens)
+    return pack_padded_sequence(torch.from_numpy(padded), torch.from_numpy(lens), batch_first=True,
+                                enforce_sorted=False)
 
 
 class Data():
-    def __init__(self, data, input_aug_type=None, shuffle=False):
-        self.inputs = np.asarray(data[0], dtype=object)
+    def __init__(self, data, input_aug_type=None, shuffle=False, seed=None):
+        # the sessions as one flat item array, with the offset and length of every session in it
+        self.items, self.offsets, self.lens = ragged(data[0])
         self.targets = np.asarray(data[1])
-        self.length = len(self.inputs)
+        self.length = len(self.lens)
         self.shuffle = shuffle
         self.input_aug_type = input_aug_type
+        self.rng = np.random.default_rng(seed)
+        self.aug_store = None
+        self.aug_shard = None
 
     def generate_batch(self, batch_size):
-        if self.shuffle:
+        shuffled_arg = None
+        if self.aug_store is not None:
+            # the store fixes the order of every epoch in advance to augment it ahead of time
+            self.aug_shard = self.aug_store.next_epoch()
+            shuffled_arg = self.aug_shard.permutation
+        elif self.shuffle:
             shuffled_arg = np.arange(self.length)
             np.random.shuffle(shuffled_arg)
-            self.inputs = self.inputs[shuffled_arg]
+        if shuffled_arg is not None:
+            self.offsets = self.offsets[shuffled_arg]
+            self.lens = self.lens[shuffled_arg]
             self.targets = self.targets[shuffled_arg]
         n_batch = int(self.length / batch_size)
         if self.length % batch_size != 0:
@@ -183,28 +196,24 @@ class Data():
         slices[-1] = slices[-1][:(self.length - batch_size * (n_batch - 1))]
         return slices
 
+    def augment_batch(self, i, input_aug_type, rng):
+        # augmented sessions of the batch i as (items, lens, targets), also run by the AugmentStore workers
+        items = gather(self.items, self.offsets[i], self.lens[i])
+        return augment_sessions(items, self.lens[i], self.targets[i], input_aug_type, rng)
+
     def get_slice(self, i):
-        inputs, targets = self.inputs[i].tolist(), self.targets[i]
-        inputs_len = np.array([len(input) for input in inputs])
+        items, lens, targets = gather(self.items, self.offsets[i], self.lens[i]), self.lens[i], self.targets[i]
 
         if self.input_aug_type is not None:
-            aug_inputs, aug_targets, aug_inputs_len = create_aug_sessions(inputs, targets, self.input_aug_type)
-            inputs = inputs + aug_inputs
-            inputs_len = np.concatenate([inputs_len, aug_inputs_len], axis=0)
+            if self.aug_shard is not None:
+                aug_items, aug_inputs_len, aug_targets = self.aug_shard.batch(i)
+            else:
+                aug_items, aug_inputs_len, aug_targets = self.augment_batch(i, self.input_aug_type, self.rng)
+            items = np.concatenate([items, aug_items], axis=0)
+            lens = np.concatenate([lens, aug_inputs_len], axis=0)
             targets = np.concatenate([targets, aug_targets], axis=0)
 
-        inputs = np.array(inputs, dtype=object)        
-        sorted_idxs = np.argsort(inputs_len)[::-1]
-        inputs = inputs[sorted_idxs]
-        targets = targets[sorted_idxs]
-        inputs_len = inputs_len[sorted_idxs]
-        inputs_len = [int(item) for item in inputs_len]
-
-        padded_sesss = torch.zeros(len(inputs), max(inputs_len)).long()
-        for i, input in enumerate(inputs):
-            padded_sesss[i,:inputs_len[i]] = torch.LongTensor(input)
-            
-        padded_sesss = padded_sesss.transpose(0, 1)
-        return padded_sesss, torch.LongTensor(targets), inputs_len
+        inputs = pack_sessions(items, np.cumsum(lens) - lens, lens)
+        return inputs, torch.LongTensor(targets)
         
         
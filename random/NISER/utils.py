@@ -9,7 +9,7 @@ Created on July, 2018
 import networkx as nx
 import numpy as np
 import random
-import itertools
+from shared.augment import from_padded, to_padded, random_deletion, random_insertion
 
 def get_metric_scores(scores, targets, k, eval):
     # eval : hit, mrr, cov
@@ -112,53 +112,48 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
-def random_deletion(sessions, targets):
-    candidate_sess_idx = [i for i, sess in enumerate(sessions) if len(sess) > 1]
-    aug_sess_sidx = random.sample(candidate_sess_idx, int(len(candidate_sess_idx)*0.8))
-
-    aug_sess = []
-    aug_tars = []
-    for i in aug_sess_sidx:
-        cur_sess = sessions[i].copy()
-        remove_item = random.choice(cur_sess)
-        cur_sess.remove(remove_item)
-        aug_sess.append(cur_sess)
-        aug_tars.append(targets[i])
-
-    return aug_sess, aug_tars
-
-def random_insertion(sessions, targets, len_max):
-    candidate_sess_idx = [i for i, sess in enumerate(sessions) if len(sess) < len_max]
-    aug_sess_sidx = random.sample(candidate_sess_idx, int(len(candidate_sess_idx)*0.8))
-    candidate_item = list(set(itertools.chain.from_iterable(sessions)))
-    
-    aug_sess = []
-    aug_tars = []
-    for i in aug_sess_sidx:
-        cur_sess = sessions[i].copy()
-        insert_index = random.randint(0, len(cur_sess)-1)
-        cur_sess.insert(insert_index, random.choice(candidate_item))
-        aug_sess.append(cur_sess)
-        aug_tars.append(targets[i])
-
-    return aug_sess, aug_tars
-
-def create_aug_sessions(batch_seqs, targets, input_aug_type, len_max, sample_num=100):
-
+def create_aug_sessions(inputs, mask, targets, input_aug_type, len_max, rng):
+    # augmented sessions keep the target as their last item
+    items, lens = from_padded(inputs, mask, tail=targets)
     if input_aug_type == 'deletion':
-        aug_sess, aug_tars = random_deletion(batch_seqs, targets)
+        items, lens, sidx = random_deletion(items, lens, rng)
     elif input_aug_type == 'insertion':
-        aug_sess, aug_tars = random_insertion(batch_seqs, targets, len_max)
-            
-    lens = [len(sess) for sess in aug_sess]
-    aug_sess_pois = [sess + [0]* (len_max - le) for sess, le in zip(aug_sess, lens)]
-    aug_msks = [[1] * le + [0] * (len_max-le) for le in lens]
-
-    return np.array(aug_sess_pois), np.array(aug_msks), np.array(aug_tars)
+        items, lens, sidx = random_insertion(items, lens, rng, len_max=len_max)
+
+    return items, lens, targets[sidx]
+
+
+def session_graphs(inputs):
+    # the graphs of the padded sessions of a batch: the alias of every position in the unique items, the
+    # normalized in|out adjacency and the unique items, padded to the largest graph of the batch
+    items, n_node, A, alias_inputs = [], [], [], []
+    for u_input in inputs:
+        n_node.append(len(np.unique(u_input)))
+    max_n_node = np.max(n_node)
+    for u_input in inputs:
+        node = np.unique(u_input)
+        items.append(node.tolist() + (max_n_node - len(node)) * [0])
+        u_A = np.zeros((max_n_node, max_n_node))
+        for i in np.arange(len(u_input) - 1):
+            if u_input[i + 1] == 0:
+                break
+            u = np.where(node == u_input[i])[0][0]
+            v = np.where(node == u_input[i + 1])[0][0]
+            u_A[u][v] = 1
+        u_sum_in = np.sum(u_A, 0)
+        u_sum_in[np.where(u_sum_in == 0)] = 1
+        u_A_in = np.divide(u_A, u_sum_in)
+        u_sum_out = np.sum(u_A, 1)
+        u_sum_out[np.where(u_sum_out == 0)] = 1
+        u_A_out = np.divide(u_A.transpose(), u_sum_out)
+        u_A = np.concatenate([u_A_in, u_A_out]).transpose()
+        A.append(u_A)
+        alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+    return alias_inputs, A, items
 
 
 class Data():
-    def __init__(self, data, input_aug_type=None, shuffle=False, graph=None):
+    def __init__(self, data, input_aug_type=None, shuffle=False, seed=None, graph=None):
         inputs = data[0]
         inputs, mask, len_max = data_masks(inputs, [0])
         self.inputs = np.asarray(inputs)
@@ -169,11 +164,20 @@ class Data():
         self.shuffle = shuffle
         self.graph = graph
         self.input_aug_type = input_aug_type
+        self.rng = np.random.default_rng(seed)
+        self.aug_store = None
+        self.aug_shard = None
 
     def generate_batch(self, batch_size):
-        if self.shuffle:
+        shuffled_arg = None
+        if self.aug_store is not None:
+            # the store fixes the order of every epoch in advance to augment it ahead of time
+            self.aug_shard = self.aug_store.next_epoch()
+            shuffled_arg = self.aug_shard.permutation
+        elif self.shuffle:
             shuffled_arg = np.arange(self.length)
             np.random.shuffle(shuffled_arg)
+        if shuffled_arg is not None:
             self.inputs = self.inputs[shuffled_arg]
             self.mask = self.mask[shuffled_arg]
             self.targets = self.targets[shuffled_arg]
@@ -184,45 +188,24 @@ class Data():
         slices[-1] = slices[-1][:(self.length - batch_size * (n_batch - 1))]
         return slices
 
+    def augment_batch(self, i, input_aug_type, rng):
+        # augmented sessions of the batch i as (items, lens, targets), also run by the AugmentStore workers
+        return create_aug_sessions(self.inputs[i], self.mask[i], self.targets[i], input_aug_type, self.len_max, rng)
+
     def get_slice(self, i):
         inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
 
         if self.input_aug_type is not None:
-            batch_seqs = []
-            for i in range(inputs.shape[0]):
-                nonzero_edges = np.stack(np.nonzero(inputs)).T
-                edges = nonzero_edges[nonzero_edges[:, 0] == i]
-                seq = [inputs[i, j].tolist() for i, j in edges] + [targets[i]]
-                batch_seqs.append(seq)
-            # pdb.set_trace()
-            aug_inputs, aug_masks, aug_targets = create_aug_sessions(batch_seqs, targets, self.input_aug_type, self.len_max)
+            if self.aug_shard is not None:
+                aug_items, aug_lens, aug_targets = self.aug_shard.batch(i)
+            else:
+                aug_items, aug_lens, aug_targets = self.augment_batch(i, self.input_aug_type, self.rng)
+            aug_inputs, aug_masks = to_padded(aug_items, aug_lens, self.len_max)
             inputs = np.concatenate([inputs, aug_inputs], axis=0)
             mask = np.concatenate([mask, aug_masks], axis=0)
             targets = np.concatenate([targets, aug_targets], axis=0)
 
 
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+        alias_inputs, A, items = session_graphs(inputs)
         
         return alias_inputs, np.array(A), items, mask, targets
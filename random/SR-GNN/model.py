@@ -15,7 +15,9 @@ from torch import nn
 from torch.nn import Module, Parameter
 import torch.nn.functional as F
 
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 
 
 
@@ -111,30 +113,25 @@ class SessionGraph(Module):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 def find_mixup_srcs(tail_idxs, overlap_A, batch_size):
     with torch.no_grad():
+        overlap_A = torch.as_tensor(overlap_A, dtype=torch.float)
     # construct tail mask
-        tail_masks = torch.zeros(batch_size)
+        tail_masks = torch.zeros(batch_size, device=overlap_A.device)
         tail_masks[tail_idxs] = 1
 
         # eliminate self loop
-        A_hat2 = torch.FloatTensor(overlap_A) - torch.eye(batch_size)
+        A_hat2 = overlap_A - torch.eye(batch_size, device=overlap_A.device)
         tails_overlap = tail_masks.view(-1, 1) * A_hat2
 
         # select nonzero max weight session
-        mixup_sess_idxs = torch.max(tails_overlap, axis=1)[1]
+        mixup_sess_idxs = torch.max(tails_overlap, axis=1)[1].cpu()
         srcs = torch.nonzero(mixup_sess_idxs)
         mixup_sess_srcs1 = torch.cat([srcs, mixup_sess_idxs[srcs]], axis=1)
 
@@ -155,10 +152,10 @@ def mixup_criterion(criterion, pred, y_a, y_b, lam):
 
 def forward(model, i, data,  input_aug_type,lam=0.6, train=True, mixup=False):
     alias_inputs, A, items, mask, targets, num_augs = data.get_slice(i,  input_aug_type)
-    if mixup:
-        overlap_A, _ = data.get_overlap(items)
     alias_inputs = trans_to_cuda(torch.Tensor(np.array(alias_inputs)).long())
     items = trans_to_cuda(torch.Tensor(np.array(items)).long())
+    if mixup:
+        overlap_A, _ = data.get_overlap(items)
     A = trans_to_cuda(torch.Tensor(np.array(A)).float())
     mask = trans_to_cuda(torch.Tensor(mask).long())
 
@@ -239,22 +236,23 @@ def train_test(model, train_data, test_data, mixup, input_aug_type, n_node,  lam
     # np.save(path + f'tail_emb_{epoch}', np.array(tail_emb))
     # np.save(path + f'head_emb_{epoch}', np.array(head_emb))
 
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-    slices = test_data.generate_batch(model.batch_size)
-    for i in slices:
-        targets, scores, num_augs  = forward(model, i, test_data, input_aug_type, lam=None, train=False,
-                                                                 mixup=False)
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, input_aug_type, n_node, Ks)
 
 
-        eval10 = get_metric_scores(scores, targets, Ks[0],  eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1], eval20)
+def evaluate(model, test_data, input_aug_type, n_node, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
-    t = time.time() - epoch_start_eval
+    def score(i):
+        targets, scores, num_augs  = forward(model, i, test_data, input_aug_type, lam=None, train=False,
+                                                                 mixup=False)
+        return targets, scores
 
-    results = metric_print(eval10, eval20, n_node, t)
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
 
 #    checkpoint = {
 #        'epoch': epoch ,
@@ -265,7 +263,7 @@ def train_test(model, train_data, test_data, mixup, input_aug_type, n_node,  lam
 
 #    save_ckp(checkpoint, path)
 
-    return loss, results
+    return results
 
 
 
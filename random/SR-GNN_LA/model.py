@@ -15,7 +15,9 @@ from torch import nn
 from torch.nn import Module, Parameter
 import torch.nn.functional as F
 
-from utils import get_metric_scores, metric_print
+from utils import metric_print
+from shared import runtime
+from shared import evaluation
 
 
 
@@ -104,17 +106,11 @@ class SessionGraph(Module):
 
 
 def trans_to_cuda(variable):
-    if torch.cuda.is_available():
-        return variable.cuda()
-    else:
-        return variable
+    return variable.to(runtime.device())
 
 
 def trans_to_cpu(variable):
-    if torch.cuda.is_available():
-        return variable.cpu()
-    else:
-        return variable
+    return variable.cpu()
 
 
 
@@ -180,24 +176,22 @@ def train_test(model, train_data, test_data, input_aug_type, n_node, top_labels,
 
     print('\t\tTotal Loss: %.3f' % (total_loss))
 
-
-    print('start predicting: ', datetime.datetime.now())
-    epoch_start_eval = time.time()
-    model.eval()
-    eval10, eval20 = [[] for i in range(3)], [[] for i in range(3)]
-    slices = test_data.generate_batch(model.batch_size)
-    for i in slices:
-        targets,_, scores = forward(model, i, test_data, input_aug_type, top_labels)
+    if test_data is None:
+        # evaluated by the caller, see async_eval.py
+        return loss, None
+    return loss, evaluate(model, test_data, input_aug_type, n_node, top_labels, Ks)
 
 
-        eval10 = get_metric_scores(scores, targets, Ks[0],  eval10)
-        eval20 = get_metric_scores(scores, targets, Ks[1], eval20)
-
-    t = time.time() - epoch_start_eval
+def evaluate(model, test_data, input_aug_type, n_node, top_labels, Ks=[10, 20]):
+    print('start predicting: ', datetime.datetime.now())
 
-    results = metric_print(eval10, eval20, n_node, t)
+    def score(i):
+        targets,_, scores = forward(model, i, test_data, input_aug_type, top_labels)
+        return targets, scores
 
-    return loss, results
+    evals, t = evaluation.run(model, test_data, score, Ks)
+    results = metric_print(*evals, n_node, t)
+    return results
 
 
 
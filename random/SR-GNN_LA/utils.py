@@ -10,7 +10,7 @@ Modified on January, 2022
 import networkx as nx
 import numpy as np
 import random
-import itertools
+from shared.augment import from_lists, from_padded, to_lists, to_padded, random_deletion, random_insertion
 import pickle
 from collections import Counter
 
@@ -38,29 +38,6 @@ def top75_labels(train_data, test_data, dataset_name):
     return top_labels
 
 
-def random_deletion(session):
-    new_sess = []
-    for sess in session:
-        if len(sess) <= 1:
-            new_sess.append(sess)
-            session.remove(sess)
-        else:
-            del_index = random.randint(0, len(sess)-1)
-            del sess[del_index]
-            new_sess.append(sess)
-
-
-    return new_sess
-
-
-def random_insertion(session):
-    candidate_item = list(set(itertools.chain.from_iterable(session)))
-    for sess in session:
-        insert_index = random.randint(0, len(sess)-1)
-        sess.insert(insert_index, random.choice(candidate_item))
-    return session
-
-
 def get_metric_scores(scores, targets, k, eval):
     # eval : hit, mrr, cov, arp, tail, tailcov
     sub_scores = scores.topk(k)[1]
@@ -153,35 +130,31 @@ def build_graph(train_data):
     return graph
 
 
-def create_aug_sessions(batch_seqs, input_aug_type, targets, len_max, sample_num=5, ):
+def create_aug_sessions(batch_seqs, input_aug_type, targets, len_max, rng, sample_num=5):
     batch_graph = build_graph(batch_seqs)
-
     aug_sess = []
     aug_targets = []
-    # pdb.set_trace()
     for target in targets:
         shortest_paths = list(nx.single_target_shortest_path(batch_graph, target).values())
         shortest_paths = [path for path in shortest_paths if len(path) > 1 and len(path) < len_max]
-        if len(shortest_paths) < 3:
-            cur_aug_sess = [sess[:-1] for sess in shortest_paths]
-        else:
-            try: cur_aug_sess = [sess[:-1] for sess in random.sample(shortest_paths, sample_num)]
-            except: cur_aug_sess = [sess[:-1] for sess in shortest_paths]
-
-        if input_aug_type == 'deletion':
-            cur_aug_sess = random_deletion(cur_aug_sess)
+        if len(shortest_paths) >= 3:
+            sampled = rng.choice(len(shortest_paths), min(sample_num, len(shortest_paths)), replace=False)
+            shortest_paths = [shortest_paths[j] for j in sampled]
 
-        elif input_aug_type == 'insertion':
-            cur_aug_sess = random_insertion(cur_aug_sess)
+        aug_sess += [sess[:-1] for sess in shortest_paths]
+        aug_targets += [target] * len(shortest_paths)
 
-        aug_sess += cur_aug_sess
-        aug_targets+= [target] * len(cur_aug_sess)
-        
-    lens = [len(sess) for sess in aug_sess]
-    aug_sess_pois = [sess + [0]* (len_max - le) for sess, le in zip(aug_sess, lens)]
-    aug_msks = [[1] * le + [0] * (len_max - le) for le in lens]
+    # perturb every sampled path at once
+    items, lens = from_lists(aug_sess)
+    aug_targets = np.asarray(aug_targets, dtype=targets.dtype)
+    if input_aug_type == 'deletion':
+        items, lens, sidx = random_deletion(items, lens, rng, ratio=1.0, keep_rest=True)
+        aug_targets = aug_targets[sidx]
+    elif input_aug_type == 'insertion':
+        items, lens, sidx = random_insertion(items, lens, rng, ratio=1.0, keep_rest=True)
+        aug_targets = aug_targets[sidx]
 
-    return np.array(aug_sess_pois), np.array(aug_msks), np.array(aug_targets)
+    return items, lens, aug_targets
 
 
 
@@ -208,8 +181,37 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def session_graphs(inputs):
+    # the graphs of the padded sessions of a batch: the alias of every position in the unique items, the
+    # normalized in|out adjacency and the unique items, padded to the largest graph of the batch
+    items, n_node, A, alias_inputs = [], [], [], []
+    for u_input in inputs:
+        n_node.append(len(np.unique(u_input)))
+    max_n_node = np.max(n_node)
+    for u_input in inputs:
+        node = np.unique(u_input)
+        items.append(node.tolist() + (max_n_node - len(node)) * [0])
+        u_A = np.zeros((max_n_node, max_n_node))
+        for i in np.arange(len(u_input) - 1):
+            if u_input[i + 1] == 0:
+                break
+            u = np.where(node == u_input[i])[0][0]
+            v = np.where(node == u_input[i + 1])[0][0]
+            u_A[u][v] = 1
+        u_sum_in = np.sum(u_A, 0)
+        u_sum_in[np.where(u_sum_in == 0)] = 1
+        u_A_in = np.divide(u_A, u_sum_in)
+        u_sum_out = np.sum(u_A, 1)
+        u_sum_out[np.where(u_sum_out == 0)] = 1
+        u_A_out = np.divide(u_A.transpose(), u_sum_out)
+        u_A = np.concatenate([u_A_in, u_A_out]).transpose()
+        A.append(u_A)
+        alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+    return alias_inputs, A, items
+
+
 class Data():
-    def __init__(self, data, batch_aug, shuffle=False):
+    def __init__(self, data, batch_aug, shuffle=False, seed=None):
         inputs = data[0]
         inputs, mask, len_max = data_masks(inputs, [0])
         self.inputs = np.asarray(inputs)
@@ -219,11 +221,20 @@ class Data():
         self.length = len(inputs)
         self.shuffle = shuffle
         self.batch_aug = batch_aug
+        self.rng = np.random.default_rng(seed)
+        self.aug_store = None
+        self.aug_shard = None
 
     def generate_batch(self, batch_size):
-        if self.shuffle:
+        shuffled_arg = None
+        if self.aug_store is not None:
+            # the store fixes the order of every epoch in advance to augment it ahead of time
+            self.aug_shard = self.aug_store.next_epoch()
+            shuffled_arg = self.aug_shard.permutation
+        elif self.shuffle:
             shuffled_arg = np.arange(self.length)
             np.random.shuffle(shuffled_arg)
+        if shuffled_arg is not None:
             self.inputs = self.inputs[shuffled_arg]
             self.mask = self.mask[shuffled_arg]
             self.targets = self.targets[shuffled_arg]
@@ -234,19 +245,22 @@ class Data():
         slices[-1] = slices[-1][:(self.length - batch_size * (n_batch - 1))]
         return slices
 
+    def augment_batch(self, i, input_aug_type, rng):
+        # augmented sessions of the batch i as (items, lens, targets), also run by the AugmentStore workers
+        inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
+        batch_seqs = to_lists(*from_padded(inputs, mask, tail=targets))
+        return create_aug_sessions(batch_seqs, input_aug_type, targets, self.len_max, rng)
+
     def get_slice(self, i,  input_aug_type, top_labels):
         inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
         ### augment True
         if self.batch_aug:
             # pdb.set_trace()
-            batch_seqs = []
-            for i in range(inputs.shape[0]):
-                nonzero_edges = np.stack(np.nonzero(inputs)).T
-                edges = nonzero_edges[nonzero_edges[:, 0] == i]
-                seq = [inputs[i, j].tolist() for i, j in edges] + [targets[i]]
-                batch_seqs.append(seq)
-            
-            aug_inputs, aug_masks, aug_targets = create_aug_sessions(batch_seqs, input_aug_type, targets, self.len_max)
+            if self.aug_shard is not None:
+                aug_items, aug_lens, aug_targets = self.aug_shard.batch(i)
+            else:
+                aug_items, aug_lens, aug_targets = self.augment_batch(i, input_aug_type, self.rng)
+            aug_inputs, aug_masks = to_padded(aug_items, aug_lens, self.len_max)
 
             if aug_inputs.shape != (0,):
                 inputs = np.concatenate([inputs, aug_inputs], axis=0)
@@ -254,29 +268,7 @@ class Data():
                 targets = np.concatenate([targets, aug_targets], axis=0)
 
             # print(f"after augmentation # sessions : {len(targets)}")
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
+        alias_inputs, A, items = session_graphs(inputs)
 
         top_labels_sidx = []
         for label in top_labels:
@@ -1,32 +1,11 @@
 import numpy as np
+import torch
 import os
 import pickle
 from collections import Counter
 import networkx as nx
 import random
-import itertools
-
-def random_deletion(session):
-    new_sess = []
-    for sess in session:
-        if len(sess) <= 1:
-            new_sess.append(sess)
-            session.remove(sess)
-        else:
-            del_index = random.randint(0, len(sess)-1)
-            del sess[del_index]
-            new_sess.append(sess)
-
-
-    return new_sess
-
-
-def random_insertion(session):
-    candidate_item = list(set(itertools.chain.from_iterable(session)))
-    for sess in session:
-        insert_index = random.randint(0, len(sess)-1)
-        sess.insert(insert_index, random.choice(candidate_item))
-    return session
+from shared.augment import from_lists, from_padded, to_lists, to_padded, random_deletion, random_insertion
 
 def get_metric_scores(scores, targets, k, eval):
     # eval : hit, mrr, cov, arp, tail, tailcov
@@ -156,36 +135,31 @@ def build_graph(train_data):
     return graph
 
 
-def create_aug_sessions(batch_seqs, input_aug_type, targets, len_max, sample_num=5):
+def create_aug_sessions(batch_seqs, input_aug_type, targets, len_max, rng, sample_num=5):
     batch_graph = build_graph(batch_seqs)
     aug_sess = []
     aug_targets = []
-    # pdb.set_trace()
     for target in targets:
         shortest_paths = list(nx.single_target_shortest_path(batch_graph, target).values())
         shortest_paths = [path for path in shortest_paths if len(path) > 1 and len(path) < len_max]
-        if len(shortest_paths) < 3:
-            cur_aug_sess = [sess[:-1] for sess in shortest_paths]
-        else:
-            try:
-                cur_aug_sess = [sess[:-1] for sess in random.sample(shortest_paths, sample_num)]
-            except:
-                cur_aug_sess = [sess[:-1] for sess in shortest_paths]
-
-        if input_aug_type == 'deletion':
-            cur_aug_sess = random_deletion(cur_aug_sess)
+        if len(shortest_paths) >= 3:
+            sampled = rng.choice(len(shortest_paths), min(sample_num, len(shortest_paths)), replace=False)
+            shortest_paths = [shortest_paths[j] for j in sampled]
 
-        elif input_aug_type == 'insertion':
-            cur_aug_sess = random_insertion(cur_aug_sess)
+        aug_sess += [sess[:-1] for sess in shortest_paths]
+        aug_targets += [target] * len(shortest_paths)
 
-        aug_sess += cur_aug_sess
-        aug_targets += [target] * len(cur_aug_sess)
+    # perturb every sampled path at once
+    items, lens = from_lists(aug_sess)
+    aug_targets = np.asarray(aug_targets, dtype=targets.dtype)
+    if input_aug_type == 'deletion':
+        items, lens, sidx = random_deletion(items, lens, rng, ratio=1.0, keep_rest=True)
+        aug_targets = aug_targets[sidx]
+    elif input_aug_type == 'insertion':
+        items, lens, sidx = random_insertion(items, lens, rng, ratio=1.0, keep_rest=True)
+        aug_targets = aug_targets[sidx]
 
-    lens = [len(sess) for sess in aug_sess]
-    aug_sess_pois = [sess + [0] * (len_max - le) for sess, le in zip(aug_sess, lens)]
-    aug_msks = [[1] * le + [0] * (len_max - le) for le in lens]
-
-    return np.array(aug_sess_pois), np.array(aug_msks), np.array(aug_targets)
+    return items, lens, aug_targets
 
 
 def data_masks(all_usr_pois, item_tail):
@@ -210,8 +184,26 @@ def split_validation(train_set, valid_portion):
     return (train_set_x, train_set_y), (valid_set_x, valid_set_y)
 
 
+def session_items(inputs):
+    # the unique items of the padded sessions of a batch, padded to the most of the batch, the alias of every
+    # position in them and the key padding mask of the padded item slots. SR_SAN attends over the items of a
+    # session, it needs no session graph
+    inputs = np.asarray(inputs)
+    base = inputs.max() + 1
+    # unique (row, item) pairs, sorted by row and then item like np.unique of every row
+    unique, inverse = np.unique(inputs + base * np.arange(len(inputs))[:, None], return_inverse=True)
+    rows = unique // base
+    n_node = np.bincount(rows, minlength=len(inputs))
+    starts = np.cumsum(n_node) - n_node
+    items = np.zeros((len(inputs), n_node.max()), dtype=inputs.dtype)
+    items[rows, np.arange(len(unique)) - starts[rows]] = unique % base
+    alias_inputs = inverse.reshape(inputs.shape) - starts[:, None]
+    key_padding_mask = np.arange(n_node.max()) >= n_node[:, None]
+    return alias_inputs, items, key_padding_mask
+
+
 class Data():
-    def __init__(self, data, batch_aug, mixup, shuffle=False):
+    def __init__(self, data, batch_aug, mixup, shuffle=False, seed=None):
         inputs = data[0]
         inputs, mask, len_max = data_masks(inputs, [0])
         self.inputs = np.asarray(inputs)
@@ -222,30 +214,46 @@ class Data():
         self.shuffle = shuffle
         self.batch_aug = batch_aug
         self.mixup = mixup
+        self.rng = np.random.default_rng(seed)
+        self.aug_store = None
+        self.aug_shard = None
 
 
     def get_overlap(self, sessions):
-        matrix = np.zeros((len(sessions), len(sessions)))
-        for i in range(len(sessions)):
-            seq_a = set(sessions[i])
-            seq_a.discard(0)
-            for j in range(i+1, len(sessions)):
-                seq_b = set(sessions[j])
-                seq_b.discard(0)
-                overlap = seq_a.intersection(seq_b)
-                ab_set = seq_a | seq_b
-                matrix[i][j] = float(len(overlap))/float(len(ab_set))
-                matrix[j][i] = matrix[i][j]
-        matrix = matrix + np.diag([1.0]*len(sessions))
-        degree = np.sum(np.array(matrix), 1)
-        degree = np.diag(1.0/degree)
+        # jaccard overlap between the sessions of a batch, computed on the device of `sessions`
+        # intersection : S @ S^T of the (session x item) multi-hot matrix S
+        # union        : |a| + |b| - |a & b|
+        if not torch.is_tensor(sessions):
+            sessions = torch.as_tensor(np.asarray(sessions))
+        n_sess = sessions.shape[0]
+        rows, cols = torch.nonzero(sessions, as_tuple=True)
+        items, cols = torch.unique(sessions[rows, cols], return_inverse=True)
+        n_items = max(len(items), 1)
+        # an item repeated inside a session counts once
+        keys = torch.unique(rows * n_items + cols)
+        indices = torch.stack([keys // n_items, keys % n_items])
+        values = torch.ones(indices.shape[1], device=sessions.device)
+        multi_hot = torch.sparse_coo_tensor(indices, values, (n_sess, n_items))
+
+        overlap = torch.sparse.mm(multi_hot, multi_hot.t().to_dense())
+        sizes = torch.diagonal(overlap)
+        union = sizes.view(-1, 1) + sizes.view(1, -1) - overlap
+        matrix = torch.where(union > 0, overlap / union.clamp(min=1), torch.zeros_like(overlap))
+        matrix.fill_diagonal_(1.0)
+        degree = torch.diag(1.0 / torch.sum(matrix, 1))
         return matrix, degree
 
 
     def generate_batch(self, batch_size):
-        if self.shuffle:
+        shuffled_arg = None
+        if self.aug_store is not None:
+            # the store fixes the order of every epoch in advance to augment it ahead of time
+            self.aug_shard = self.aug_store.next_epoch()
+            shuffled_arg = self.aug_shard.permutation
+        elif self.shuffle:
             shuffled_arg = np.arange(self.length)
             np.random.shuffle(shuffled_arg)
+        if shuffled_arg is not None:
             self.inputs = self.inputs[shuffled_arg]
             self.mask = self.mask[shuffled_arg]
             self.targets = self.targets[shuffled_arg]
@@ -256,6 +264,12 @@ class Data():
         slices[-1] = slices[-1][:(self.length - batch_size * (n_batch - 1))]
         return slices
 
+    def augment_batch(self, i, input_aug_type, rng):
+        # augmented sessions of the batch i as (items, lens, targets), also run by the AugmentStore workers
+        inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
+        batch_seqs = to_lists(*from_padded(inputs, mask, tail=targets))
+        return create_aug_sessions(batch_seqs, input_aug_type, targets, self.len_max, rng)
+
     def get_slice(self, i,  input_aug_type, mixup):
         inputs, mask, targets = self.inputs[i], self.mask[i], self.targets[i]
 
@@ -269,42 +283,17 @@ class Data():
         ### augment True
         if self.batch_aug:
             # pdb.set_trace()
-            batch_seqs = []
-            for i in range(inputs.shape[0]):
-                nonzero_edges = np.stack(np.nonzero(inputs)).T
-                edges = nonzero_edges[nonzero_edges[:, 0] == i]
-                seq = [inputs[i, j].tolist() for i, j in edges] + [targets[i]]
-                batch_seqs.append(seq)
-
-            aug_inputs, aug_masks, aug_targets = create_aug_sessions(batch_seqs, input_aug_type, targets, self.len_max)
+            if self.aug_shard is not None:
+                aug_items, aug_lens, aug_targets = self.aug_shard.batch(i)
+            else:
+                aug_items, aug_lens, aug_targets = self.augment_batch(i, input_aug_type, self.rng)
+            aug_inputs, aug_masks = to_padded(aug_items, aug_lens, self.len_max)
             if aug_inputs.shape != (0,):
                 inputs = np.concatenate([inputs, aug_inputs], axis=0)
                 mask = np.concatenate([mask, aug_masks], axis=0)
                 targets = np.concatenate([targets, aug_targets], axis=0)
 
             # print(f"after augmentation # sessions : {len(targets)}")
-        items, n_node, A, alias_inputs = [], [], [], []
-        for u_input in inputs:
-            n_node.append(len(np.unique(u_input)))
-        max_n_node = np.max(n_node)
-        for u_input in inputs:
-            node = np.unique(u_input)
-            items.append(node.tolist() + (max_n_node - len(node)) * [0])
-            u_A = np.zeros((max_n_node, max_n_node))
-            for i in np.arange(len(u_input) - 1):
-                if u_input[i + 1] == 0:
-                    break
-                u = np.where(node == u_input[i])[0][0]
-                v = np.where(node == u_input[i + 1])[0][0]
-                u_A[u][v] = 1
-            u_sum_in = np.sum(u_A, 0)
-            u_sum_in[np.where(u_sum_in == 0)] = 1
-            u_A_in = np.divide(u_A, u_sum_in)
-            u_sum_out = np.sum(u_A, 1)
-            u_sum_out[np.where(u_sum_out == 0)] = 1
-            u_A_out = np.divide(u_A.transpose(), u_sum_out)
-            u_A = np.concatenate([u_A_in, u_A_out]).transpose()
-            A.append(u_A)
-            alias_inputs.append([np.where(node == i)[0][0] for i in u_input])
-
-        return alias_inputs, A, items, mask, targets
\ No newline at end of file
+        alias_inputs, items, key_padding_mask = session_items(inputs)
+
+        return alias_inputs, items, key_padding_mask, mask, targets
\ No newline at end of file
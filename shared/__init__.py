@@ -0,0 +1,14 @@
+"""Training infrastructure shared by the main.py of every variant.
+
+    augment      vectorized random insertion/deletion of the random variants
+    pregen       background pre-generation of the augmented sessions
+    checkpoint   background checkpoint writer with best-N retention and resume
+    async_eval   evaluation of finished epochs in a separate process
+    runtime      device, CPU thread and affinity selection
+    evaluation   inference-mode evaluation of the graph models and its batch cache
+    sessions     whole sessions of prefix-expanded examples, NARM and SR_SAN
+    telemetry    per-stage step timing, throughput and memory as JSONL
+    profiling    opt-in torch.profiler windows
+
+A main.py puts the repository root on sys.path and imports them from here.
+"""
@@ -0,0 +1,110 @@
+import copy
+import itertools
+import queue
+import sys
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+from . import evaluation, runtime
+
+# Evaluation of finished epochs in a separate process. The worker is spawned,
+# not forked, so it starts without the trainer's CUDA context. It gets a CPU
+# copy of the model and the arguments of `evaluate` once, then receives the
+# host copy of the weights of every epoch and evaluates them while the next
+# epoch trains. CUDA stays with the trainer: the worker runs on its own share
+# of the CPU threads only. The model class, `evaluate` and its arguments are
+# pickled, so they have to be importable from the variant's modules.
+
+
+def _cpu_copy(model):
+    # deep copy of the model with its parameters and buffers copied straight to the host, without the
+    # optimizer and scheduler the worker has no use for
+    memo = {id(getattr(model, name)): None for name in ('optimizer', 'scheduler') if hasattr(model, name)}
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        host = tensor.detach().to('cpu', copy=True)
+        if isinstance(tensor, torch.nn.Parameter):
+            host = torch.nn.Parameter(host, tensor.requires_grad)
+        memo[id(tensor)] = host
+    return copy.deepcopy(model, memo)
+
+
+def _worker(model, evaluate, args, kwargs, threads, settings, tasks, results):
+    # everything in the worker stays on the CPU, whatever the trainer runs on
+    runtime.select('cpu')
+    if isinstance(getattr(model, 'device', None), torch.device):
+        model.device = torch.device('cpu')
+    evaluation.configure(*settings)
+    torch.set_num_threads(threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        epoch, weights = task
+        try:
+            model.load_state_dict(weights)
+            results.put((epoch, evaluate(model, *args, **kwargs), None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+
+class AsyncEvaluator():
+    """Runs evaluate(model, *args, **kwargs) on the weights of finished epochs in a worker process.
+
+    submit() returns the (epoch, results, state) of every evaluation finished
+    so far in epoch order, and waits while more than max_lag epochs are not
+    evaluated yet. The trainer's CPU threads are split between the two
+    processes: threads (a quarter by default) go to the worker, at least one
+    stays with the trainer.
+    """
+    def __init__(self, model, evaluate, *args, max_lag=1, threads=0, **kwargs):
+        self.budget = torch.get_num_threads()
+        threads = min(threads or max(1, self.budget // 4), max(1, self.budget - 1))
+        ctx = mp.get_context('spawn')
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.max_lag = max_lag
+        self.pending = {}
+        self.process = ctx.Process(target=_worker, args=(_cpu_copy(model), evaluate, args, kwargs, threads,
+                                                         evaluation.settings(), self.tasks, self.results))
+        # the worker needs nothing of the script that trains: without its path spawn does not re-run it
+        main = sys.modules['__main__']
+        path = main.__dict__.pop('__file__', None)
+        try:
+            self.process.start()
+        finally:
+            if path is not None:
+                main.__file__ = path
+        torch.set_num_threads(max(1, self.budget - threads))
+
+    def _collect(self, block):
+        finished = []
+        while self.pending:
+            try:
+                epoch, results, error = self.results.get(timeout=1 if block else 0.001)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('evaluation process died')
+                if block:
+                    continue
+                break
+            if error is not None:
+                raise RuntimeError(f'evaluation of epoch {epoch} failed\n{error}')
+            finished.append((epoch, results, self.pending.pop(epoch)))
+            block = len(self.pending) > self.max_lag
+        return finished
+
+    def submit(self, epoch, state):
+        # state is a CheckpointManager.capture(), the worker only reads its weights
+        self.pending[epoch] = state
+        self.tasks.put((epoch, state['model']))
+        return self._collect(block=len(self.pending) > self.max_lag)
+
+    def close(self):
+        # waits for the evaluations still running and returns them
+        finished = []
+        while self.pending:
+            finished += self._collect(block=True)
+        self.tasks.put(None)
+        self.process.join()
+        torch.set_num_threads(self.budget)
+        return finished
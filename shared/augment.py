@@ -0,0 +1,104 @@
+import numpy as np
+
+# Random insertion / deletion over a ragged batch of sessions.
+# A batch is kept as a flat item array plus per-session lengths, so every
+# augmentation is index arithmetic over numpy arrays instead of list edits.
+# All randomness comes from the numpy Generator passed in, so a seeded
+# generator gives reproducible batches.
+
+
+def from_lists(sessions):
+    lens = np.fromiter(map(len, sessions), dtype=np.int64, count=len(sessions))
+    if lens.sum() == 0:
+        return np.zeros(0, dtype=np.int64), lens
+    items = np.concatenate([np.asarray(sess, dtype=np.int64) for sess in sessions])
+    return items, lens
+
+
+def from_padded(inputs, mask, tail=None):
+    # right padded (batch x len_max) sessions -> ragged, optionally appending one `tail` item per session
+    mask = np.asarray(mask).astype(bool)
+    lens = mask.sum(1).astype(np.int64)
+    items = np.asarray(inputs)[mask].astype(np.int64)
+    if tail is not None:
+        items = np.insert(items, np.cumsum(lens), tail)
+        lens = lens + 1
+    return items, lens
+
+
+def to_lists(items, lens):
+    return [sess.tolist() for sess in np.split(items, np.cumsum(lens)[:-1])] if len(lens) else []
+
+
+def to_padded(items, lens, len_max):
+    mask = np.arange(len_max) < lens.reshape(-1, 1)
+    pois = np.zeros((len(lens), len_max), dtype=items.dtype)
+    pois[mask] = items
+    return pois, mask.astype(np.int64)
+
+
+def _gather(items, lens, sidx):
+    # flat positions of the sessions `sidx` (in that order) and the in-session index of each position
+    offsets = np.cumsum(lens) - lens
+    sel_lens = lens[sidx]
+    pos = np.arange(sel_lens.sum()) - np.repeat(np.cumsum(sel_lens) - sel_lens, sel_lens)
+    src = np.repeat(offsets[sidx], sel_lens) + pos
+    return src, pos, sel_lens
+
+
+def _select(rng, candidates, n_sess, ratio, sample_num, keep_rest):
+    if sample_num is None:
+        sample_num = int(len(candidates) * ratio)
+    sidx = rng.choice(candidates, min(sample_num, len(candidates)), replace=False)
+    if keep_rest:
+        selected = np.zeros(n_sess, dtype=bool)
+        selected[sidx] = True
+        return np.arange(n_sess), selected
+    return sidx, np.ones(len(sidx), dtype=bool)
+
+
+def random_deletion(items, lens, rng, ratio=0.8, sample_num=None, keep_rest=False):
+    """Drop one random item from sessions longer than one item.
+
+    Returns the augmented (items, lens) and the index of the source session of
+    every output session. With keep_rest the unselected sessions are passed
+    through unchanged, otherwise only the augmented sessions are returned.
+    """
+    candidates = np.nonzero(lens > 1)[0]
+    sidx, selected = _select(rng, candidates, len(lens), ratio, sample_num, keep_rest)
+    src, pos, sel_lens = _gather(items, lens, sidx)
+
+    del_pos = np.full(len(sidx), -1)
+    del_pos[selected] = rng.integers(0, sel_lens[selected])
+    keep = pos != np.repeat(del_pos, sel_lens)
+    return items[src][keep], sel_lens - selected, sidx
+
+
+def random_insertion(items, lens, rng, ratio=0.8, sample_num=None, keep_rest=False, len_max=None):
+    """Insert one random batch item in front of a random position of each selected session.
+
+    Inserted items are drawn from the items of the batch. Sessions already at
+    len_max are never selected. The return value matches random_deletion.
+    """
+    candidates = np.arange(len(lens)) if len_max is None else np.nonzero(lens < len_max)[0]
+    sidx, selected = _select(rng, candidates, len(lens), ratio, sample_num, keep_rest)
+    src, _, sel_lens = _gather(items, lens, sidx)
+    candidate_item = np.unique(items)
+
+    new_lens = sel_lens + selected
+    starts = np.cumsum(new_lens) - new_lens
+    is_new = np.zeros(new_lens.sum(), dtype=bool)
+    is_new[starts[selected] + rng.integers(0, sel_lens[selected])] = True
+
+    out = np.empty(len(is_new), dtype=items.dtype)
+    out[is_new] = candidate_item[rng.integers(0, len(candidate_item), size=selected.sum())]
+    out[~is_new] = items[src]
+    return out, new_lens, sidx
+
+
+def augment(items, lens, input_aug_type, rng, **kwargs):
+    if input_aug_type == 'deletion':
+        return random_deletion(items, lens, rng, **kwargs)
+    elif input_aug_type == 'insertion':
+        return random_insertion(items, lens, rng, **kwargs)
+    raise ValueError(f'unknown input_aug_type {input_aug_type}, select deletion or insertion')
@@ -0,0 +1,166 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+# Checkpointing for main.py. The state of every epoch is copied to host memory
+# on the training thread and serialized by a background writer thread:
+#   {ckpt_dir}/last.pt      full state of the latest epoch, for --resume
+#   {ckpt_dir}/{epoch}.pt   model weights of the best `keep` epochs by `metric`
+
+METRICS = ['HR', 'MRR', 'Cov']
+KS = [10, 20]
+
+
+def _to_host(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_host(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_to_host(v) for v in obj]
+    return obj
+
+
+def _save(obj, path):
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _load(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location='cpu')
+
+
+class CheckpointManager():
+    """Writes checkpoints in a background thread and keeps the best `keep` epochs.
+
+    metric is one of HR/MRR/Cov@10/20 and ranks the kept epochs. With half the
+    kept weights are stored in fp16, last.pt always keeps full precision.
+    """
+    def __init__(self, ckpt_dir, metric='HR@20', keep=3, half=False):
+        name, _, k = metric.partition('@')
+        if name not in METRICS or not k.isdigit() or int(k) not in KS:
+            raise ValueError(f'unknown checkpoint metric {metric}, select one of HR/MRR/Cov@10/20')
+        if keep < 1:
+            raise ValueError(f'cannot keep {keep} checkpoints, keep at least 1')
+        self.ckpt_dir = ckpt_dir
+        self.metric = (KS.index(int(k)), METRICS.index(name))
+        self.keep = keep
+        self.half = half
+        self.kept = []
+        self.data = None
+        self.shuffles = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def track(self, data):
+        # record the numpy RNG state in front of every shuffle, resume replays them to restore the data order
+        self.data = data
+        generate_batch = data.generate_batch
+
+        def tracked(batch_size):
+            self.shuffles.append((np.random.get_state(), batch_size))
+            return generate_batch(batch_size)
+        data.generate_batch = tracked
+
+    def _rng_state(self):
+        state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+        if torch.cuda.is_available():
+            state['cuda'] = torch.cuda.get_rng_state_all()
+        if getattr(self.data, 'rng', None) is not None:
+            state['data'] = self.data.rng.bit_generator.state
+        return state
+
+    def capture(self, epoch, model):
+        # host copy of the training state at the end of `epoch`, completed by save() once its results are known
+        optimizer, scheduler = getattr(model, 'optimizer', None), getattr(model, 'scheduler', None)
+        return {
+            'epoch': epoch,
+            'model': _to_host(model.state_dict()),
+            'optimizer': _to_host(optimizer.state_dict()) if optimizer is not None else None,
+            'scheduler': _to_host(scheduler.state_dict()) if scheduler is not None else None,
+            'shuffles': list(self.shuffles),
+            'rng': self._rng_state(),
+        }
+
+    def save(self, epoch, results, model, bad_counter, best_results, best_epochs, state=None):
+        if self.error is not None:
+            raise RuntimeError('checkpoint writer failed') from self.error
+        if state is None:
+            state = self.capture(epoch, model)
+        score = float(results[self.metric[0]][self.metric[1]])
+        ranked = sorted(self.kept + [(score, epoch)], key=lambda x: -x[0])
+        self.kept, dropped = ranked[:self.keep], [e for _, e in ranked[self.keep:]]
+        state.update({
+            'bad_counter': bad_counter,
+            'best_results': _to_host([list(r) for r in best_results]),
+            'best_epochs': [list(e) for e in best_epochs],
+            'kept': list(self.kept),
+        })
+        # blocks once the writer is two checkpoints behind
+        self.queue.put((state, epoch not in dropped, dropped))
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, kept, dropped = item
+            try:
+                os.makedirs(self.ckpt_dir, exist_ok=True)
+                if kept:
+                    weights = state['model']
+                    if self.half:
+                        weights = {k: v.half() if v.is_floating_point() else v for k, v in weights.items()}
+                    _save(weights, os.path.join(self.ckpt_dir, f"{state['epoch']}.pt"))
+                _save(state, os.path.join(self.ckpt_dir, 'last.pt'))
+                for epoch in dropped:
+                    if epoch != state['epoch']:
+                        os.remove(os.path.join(self.ckpt_dir, f'{epoch}.pt'))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def resume(self, path, model):
+        """Restores model, optimizer, scheduler, data order and RNG from a last.pt.
+
+        Returns the saved state, the caller continues from state['epoch'] + 1
+        with its bad_counter, best_results and best_epochs.
+        """
+        state = _load(path)
+        model.load_state_dict(state['model'])
+        if state['optimizer'] is not None:
+            model.optimizer.load_state_dict(state['optimizer'])
+        if state['scheduler'] is not None:
+            model.scheduler.load_state_dict(state['scheduler'])
+        if self.data is not None:
+            for rng_state, batch_size in state['shuffles']:
+                np.random.set_state(rng_state)
+                self.data.generate_batch(batch_size)
+        rng = state['rng']
+        torch.set_rng_state(rng['torch'])
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['random'])
+        if 'cuda' in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        if 'data' in rng and getattr(self.data, 'rng', None) is not None:
+            self.data.rng.bit_generator.state = rng['data']
+        self.kept = [tuple(k) for k in state['kept']]
+        print(f"Resumed from {path} at epoch {state['epoch']}")
+        return state
+
+    def close(self):
+        self.queue.put(None)
+        self.queue.join()
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('checkpoint writer failed') from self.error
@@ -0,0 +1,239 @@
+import inspect
+import tempfile
+import time
+import numpy as np
+import torch
+
+# Evaluation engine of the graph models. evaluate() of model.py hands its
+# per-batch scoring to run(), which
+#   - runs under torch.inference_mode, so no autograd graph is recorded,
+#   - batches the test set by the --eval_batch_size given to configure(), or
+#     by the training batch size when it is unset,
+#   - takes the top max(Ks) items of every batch into output buffers that are
+#     allocated once and reused by every batch and every epoch, and counts
+#     hits, reciprocal ranks and covered items on the device, so the host
+#     waits for the device once per evaluation instead of once per batch.
+#   - passes an empty top_labels to test_data.get_slice, so the top_labels
+#     groups of the logit averaging variants, which only serve the training
+#     loss, are not built,
+#   - records what test_data.get_slice returns for every test batch at the
+#     first evaluation and replays it at the later ones, see BatchCache.
+# main.py --eval_ckpt evaluates the weights of a saved checkpoint with it,
+# without training.
+
+CACHES = ['mmap', 'memory', 'off']
+
+_batch_size = 0
+_cache_mode = 'mmap'
+_buffers = None
+_cache = None
+
+
+def configure(batch_size=0, cache='mmap'):
+    global _batch_size, _cache_mode
+    if cache not in CACHES:
+        raise ValueError(f'unknown eval cache {cache}, select one of {", ".join(CACHES)}')
+    _batch_size, _cache_mode = batch_size, cache
+
+
+def settings():
+    # the arguments of the last configure()
+    return _batch_size, _cache_mode
+
+
+def load(path, model):
+    """Loads the weights of a kept {epoch}.pt, fp16 ones included, or of a last.pt into model."""
+    try:
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:  # torch < 1.13
+        state = torch.load(path, map_location='cpu')
+    if 'model' in state and 'epoch' in state:
+        state = state['model']
+    model.load_state_dict(state)
+    print(f'Evaluating {path}')
+
+
+def _compact(value):
+    # rectangular int and float outputs as int32 and float32 arrays, anything else as it is
+    if not isinstance(value, (list, np.ndarray)) or len(value) == 0:
+        return value
+    try:
+        array = np.asarray(value)
+    except ValueError:  # ragged
+        return value
+    if array.dtype.kind == 'i' and array.itemsize > 4 and array.min() >= -2 ** 31 and array.max() < 2 ** 31:
+        return array.astype(np.int32)
+    if array.dtype.kind == 'f' and array.itemsize > 4:
+        return array.astype(np.float32)
+    if array.dtype.kind in 'iufb':
+        return array
+    return value
+
+
+class BatchCache():
+    """What test_data.get_slice returns for every test batch, recorded once and replayed.
+
+    The test set and its batches are fixed, so the session graphs, alias maps
+    and adjacency matrices of a batch are the same at every evaluation. The
+    first evaluation records them as compact int32/float32 arrays, the later
+    ones skip get_slice for the recorded batches. mmap keeps the arrays in an
+    unlinked temporary file and reads them back memory-mapped, so the cache
+    lives in the page cache rather than in the process; memory keeps them on
+    the heap.
+    """
+    def __init__(self, data, batch_size, mode='mmap'):
+        self.data, self.batch_size, self.mode = data, batch_size, mode
+        self.batches = {}
+        self.file = tempfile.TemporaryFile(prefix='eval_cache') if mode == 'mmap' else None
+        self.size = 0
+        self.map = None
+
+    def _store(self, value):
+        value = _compact(value)
+        if self.file is None or not isinstance(value, np.ndarray):
+            return value
+        # 8 byte aligned, so every array can be viewed in place
+        offset = -(-self.size // 8) * 8
+        self.file.seek(offset)
+        self.file.write(np.ascontiguousarray(value).data)
+        self.size = offset + value.nbytes
+        return (offset, value.dtype, value.shape)
+
+    def _load(self, value):
+        if self.file is None or not isinstance(value, tuple):
+            return value
+        offset, dtype, shape = value
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self.map[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def wrap(self, get_slice):
+        def cached(i, *args, **kwargs):
+            key = np.asarray(i).tobytes()
+            if key in self.batches:
+                return tuple(self._load(v) for v in self.batches[key])
+            out = get_slice(i, *args, **kwargs)
+            self.batches[key] = tuple(self._store(v) for v in out)
+            return out
+        return cached
+
+    def sync(self):
+        # maps what the last evaluation wrote, copy-on-write so the arrays are writable like get_slice's own
+        if self.file is not None and self.size and (self.map is None or len(self.map) < self.size):
+            self.file.flush()
+            self.map = np.memmap(self.file, dtype=np.uint8, mode='c', shape=(self.size,))
+
+
+def _without_top_labels(data, get_slice):
+    # get_slice with an empty top_labels wherever it is passed one
+    signature = inspect.signature(type(data).get_slice)
+    if 'top_labels' not in signature.parameters:
+        return get_slice
+
+    def sliced(i, *args, **kwargs):
+        bound = signature.bind(data, i, *args, **kwargs)
+        if 'top_labels' in bound.arguments:
+            bound.arguments['top_labels'] = []
+        return get_slice(*bound.args[1:], **bound.kwargs)
+    return sliced
+
+
+def _get_cache(test_data, batch_size):
+    global _cache
+    if _cache_mode == 'off' or getattr(test_data, 'batch_aug', False):
+        # augmented test batches differ at every evaluation
+        return None
+    if _cache is None or (_cache.data, _cache.batch_size, _cache.mode) != (test_data, batch_size, _cache_mode):
+        _cache = BatchCache(test_data, batch_size, _cache_mode)
+    return _cache
+
+
+class _Buffers():
+    def __init__(self, rows, k, n_items, Ks, dtype, device):
+        # mps has no float64
+        acc = torch.float32 if device.type == 'mps' else torch.float64
+        self.key = (k, n_items, tuple(Ks), dtype, device)
+        self.dtype = dtype
+        self.inv_rank = 1 / torch.arange(1, k + 1, dtype=acc, device=device)
+        self.hits = torch.zeros(len(Ks), dtype=acc, device=device)
+        self.rr = torch.zeros(len(Ks), dtype=acc, device=device)
+        self.covered = torch.zeros(len(Ks), n_items, dtype=torch.bool, device=device)
+        self.rows = 0
+        self.grow(rows)
+
+    def grow(self, rows):
+        # the per-row outputs of a batch of up to `rows` sessions
+        if rows <= self.rows:
+            return
+        k, device = self.inv_rank.size(0), self.inv_rank.device
+        self.rows = rows
+        self.values = torch.empty(rows, k, dtype=self.dtype, device=device)
+        self.indices = torch.empty(rows, k, dtype=torch.long, device=device)
+        self.targets = torch.empty(rows, 1, dtype=torch.long, device=device)
+        self.hit = torch.empty(rows, k, dtype=torch.bool, device=device)
+
+
+def _get_buffers(rows, scores, Ks):
+    # kept across evaluations, reallocated only when the shape of the outputs changes
+    global _buffers
+    key = (max(Ks), scores.size(1), tuple(Ks), scores.dtype, scores.device)
+    if _buffers is None or _buffers.key != key:
+        _buffers = _Buffers(rows, *key)
+    _buffers.grow(rows)
+    _buffers.hits.zero_()
+    _buffers.rr.zero_()
+    _buffers.covered.zero_()
+    return _buffers
+
+
+def run(model, test_data, score, Ks=(10, 20)):
+    """Evaluates score(i) -> (targets, scores) over the batches i of test_data.
+
+    Returns one [HR, MRR, covered items] list per K, in the form metric_print
+    takes, and the elapsed time. Raises ValueError on an empty test set, whose
+    metrics are undefined.
+    """
+    if not test_data.length:
+        raise ValueError('the test set is empty, there are no sessions to evaluate')
+    start = time.time()
+    model.eval()
+    batch_size = _batch_size or model.batch_size
+    cache = _get_cache(test_data, batch_size)
+    patched = 'get_slice' in vars(test_data)
+    get_slice = test_data.get_slice
+    test_data.get_slice = _without_top_labels(test_data, get_slice)
+    if cache is not None:
+        test_data.get_slice = cache.wrap(test_data.get_slice)
+    try:
+        evals = _run(test_data, score, Ks, batch_size)
+    finally:
+        if patched:
+            test_data.get_slice = get_slice
+        else:
+            del test_data.get_slice
+        if cache is not None:
+            cache.sync()
+    return evals, time.time() - start
+
+
+def _run(test_data, score, Ks, batch_size):
+    buffers, n = None, 0
+    with torch.inference_mode():
+        for i in test_data.generate_batch(batch_size):
+            targets, scores = score(i)
+            rows = scores.size(0)
+            if buffers is None:
+                buffers = _get_buffers(max(rows, batch_size), scores, Ks)
+            buffers.grow(rows)
+            values, indices = buffers.values[:rows], buffers.indices[:rows]
+            torch.topk(scores, max(Ks), out=(values, indices))
+            target = buffers.targets[:rows]
+            target.copy_(torch.as_tensor(targets).view(-1, 1), non_blocking=True).sub_(1)
+            hit = torch.eq(indices, target, out=buffers.hit[:rows])
+            for j, k in enumerate(Ks):
+                buffers.hits[j] += hit[:, :k].sum()
+                buffers.rr[j] += (hit[:, :k] * buffers.inv_rank[:k]).sum()
+                buffers.covered[j][indices[:, :k]] = True
+            n += rows
+        evals = [[[(buffers.hits[j] / n).item()], [(buffers.rr[j] / n).item()],
+                  buffers.covered[j].nonzero().view(-1).tolist()] for j in range(len(Ks))]
+    return evals
@@ -0,0 +1,167 @@
+import os
+import shutil
+import threading
+import multiprocessing as mp
+import numpy as np
+
+# Pre-generation of the input augmentation in background worker processes.
+# A producer thread hands the batches of upcoming epochs to a process pool and
+# writes every epoch as one shard of files under `out_dir`/epoch{k}:
+#   items.bin    flat augmented items (int64), read back as a memmap
+#   lens.npy     length of every augmented session
+#   targets.npy  target of every augmented session
+#   offsets.npy  first augmented session of every batch (n_batch + 1)
+#   order.npy    order of the training set the epoch was batched in
+# The trainer only reads slices of the current shard in get_slice.
+# Workers are forked from the process that calls start(), so they see the
+# training set in its original order and must be started before the first
+# generate_batch.
+
+_data = None
+_input_aug_type = None
+
+
+def _init_worker(data, input_aug_type):
+    global _data, _input_aug_type
+    _data, _input_aug_type = data, input_aug_type
+
+
+def _augment(task):
+    idx, seed = task
+    return _data.augment_batch(idx, _input_aug_type, np.random.default_rng(seed))
+
+
+class AugmentShard():
+    def __init__(self, path, batch_size, permutation):
+        self.batch_size = batch_size
+        # applied by generate_batch to move the training set from the previous epoch's order to this one
+        self.permutation = permutation
+        self.lens = np.load(os.path.join(path, 'lens.npy'))
+        self.targets = np.load(os.path.join(path, 'targets.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.item_offsets = np.concatenate([[0], np.cumsum(self.lens)])
+        if self.item_offsets[-1] > 0:
+            self.items = np.memmap(os.path.join(path, 'items.bin'), dtype=np.int64, mode='r')
+        else:
+            self.items = np.zeros(0, dtype=np.int64)
+
+    def batch(self, i):
+        # augmented (items, lens, targets) of the batch starting at index i[0]
+        j = i[0] // self.batch_size
+        lo, hi = self.offsets[j], self.offsets[j + 1]
+        items = np.array(self.items[self.item_offsets[lo]:self.item_offsets[hi]])
+        return items, self.lens[lo:hi], self.targets[lo:hi]
+
+
+class AugmentStore():
+    """Augments the batches of upcoming epochs in a pool of worker processes.
+
+    With epochs=None the producer keeps at most `window` epochs ahead of the
+    trainer and removes every shard once the next epoch starts. With epochs=K
+    the K shards are written once and the trainer cycles through them.
+    Every batch gets its own seed, so the shards do not depend on the number
+    of workers.
+    """
+    def __init__(self, data, batch_size, input_aug_type, out_dir, epochs=None, window=2, workers=None,
+                 shuffle=True, seed=None):
+        self.data = data
+        self.batch_size = batch_size
+        self.input_aug_type = input_aug_type
+        self.out_dir = out_dir
+        self.epochs = epochs
+        self.window = max(window, 1)
+        self.workers = workers or os.cpu_count()
+        self.shuffle = shuffle
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.order = np.arange(data.length)
+        self.epoch = 0
+        self.ready = 0
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self.pool = ctx.Pool(self.workers, initializer=_init_worker, initargs=(self.data, self.input_aug_type))
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+        return self
+
+    def _path(self, k):
+        return os.path.join(self.out_dir, f'epoch{k}')
+
+    def _slices(self):
+        # same batches as Data.generate_batch
+        n_batch = int(self.data.length / self.batch_size)
+        if self.data.length % self.batch_size != 0:
+            n_batch += 1
+        slices = np.split(np.arange(n_batch * self.batch_size), n_batch)
+        slices[-1] = slices[-1][:(self.data.length - self.batch_size * (n_batch - 1))]
+        return slices
+
+    def _produce(self):
+        rng = np.random.default_rng([self.seed])
+        k = 0
+        try:
+            while self.epochs is None or k < self.epochs:
+                with self.cond:
+                    while self.epochs is None and k - self.epoch >= self.window and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                order = rng.permutation(self.data.length) if self.shuffle else np.arange(self.data.length)
+                self._write(k, order)
+                with self.cond:
+                    self.ready = k + 1
+                    self.cond.notify_all()
+                k += 1
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def _write(self, k, order):
+        path = self._path(k)
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        tasks = [(order[s], [self.seed, k, j]) for j, s in enumerate(self._slices())]
+        lens, targets, offsets = [], [], [0]
+        with open(os.path.join(tmp, 'items.bin'), 'wb') as f:
+            for items, sess_lens, sess_targets in self.pool.imap(_augment, tasks, chunksize=8):
+                f.write(np.asarray(items, dtype=np.int64).tobytes())
+                lens.append(sess_lens)
+                targets.append(sess_targets)
+                offsets.append(offsets[-1] + len(sess_lens))
+        np.save(os.path.join(tmp, 'lens.npy'), np.concatenate(lens).astype(np.int64))
+        np.save(os.path.join(tmp, 'targets.npy'), np.concatenate(targets))
+        np.save(os.path.join(tmp, 'offsets.npy'), np.asarray(offsets))
+        np.save(os.path.join(tmp, 'order.npy'), order)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+
+    def next_epoch(self):
+        with self.cond:
+            k = self.epoch if self.epochs is None else self.epoch % self.epochs
+            while self.ready <= k and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise RuntimeError('augmentation pre-generation failed') from self.error
+            if self.epochs is None and self.epoch > 0:
+                shutil.rmtree(self._path(self.epoch - 1), ignore_errors=True)
+            self.epoch += 1
+            self.cond.notify_all()
+        order = np.load(os.path.join(self._path(k), 'order.npy'))
+        permutation = np.argsort(self.order)[order] if self.shuffle else None
+        self.order = order
+        return AugmentShard(self._path(k), self.batch_size, permutation)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.pool.terminate()
+        self.thread.join(timeout=1)
+        if self.epochs is None:
+            shutil.rmtree(self.out_dir, ignore_errors=True)
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import torch
+from torch.profiler import profile, schedule, ProfilerActivity, record_function
+
+# Opt-in torch.profiler window over the training steps. Every training batch
+# fetch advances the schedule (wait, warmup, active steps, repeated `repeat`
+# times). Each finished window writes to the run directory:
+#   trace_step{n}.json   Chrome trace, open in chrome://tracing or Perfetto
+#   ops_step{n}.txt      operators by self time
+#   shapes_step{n}.txt   operators by self time and input shapes
+# The stages are labelled with record_function through wrappers and hooks:
+# get_slice, GNNCell, compute_scores, loss_function and, where the variant has
+# them as functions, logit_avg, flag, mixup_criterion, create_aug_sessions and
+# find_mixup_srcs. Logit averaging written inline in train_test shows up
+# between loss_function and the backward ops.
+
+FUNCTIONS = ['logit_avg', 'flag', 'mixup_criterion', 'create_aug_sessions', 'find_mixup_srcs']
+
+
+class _Loader():
+    def __init__(self, loader, profiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        while True:
+            self.profiler._step()
+            try:
+                with record_function('next_batch'):
+                    batch = next(it)
+            except StopIteration:
+                return
+            yield batch
+
+
+def _label(fn, name):
+    def wrapped(*args, **kwargs):
+        with record_function(name):
+            return fn(*args, **kwargs)
+    return wrapped
+
+
+class Profiler():
+    """Profiles `active` training steps after `wait` idle and `warmup` steps, `repeat` times.
+
+    Works on CPU only machines, CUDA activity is recorded when it is available.
+    """
+    def __init__(self, out_dir, model, wait=5, warmup=2, active=5, repeat=1, with_stack=False):
+        self.run_dir = os.path.join(out_dir, time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}')
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.cuda = torch.cuda.is_available()
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.cuda else [])
+        self.prof = profile(activities=activities,
+                            schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+                            on_trace_ready=self._export, record_shapes=True, with_stack=with_stack)
+        self.started = False
+        self.handles = []
+        self._hook(model)
+
+    def _hook(self, model):
+        ranges = {}
+
+        def enter(module, inputs):
+            ranges[module] = record_function('loss_function')
+            ranges[module].__enter__()
+
+        def leave(module, inputs, output):
+            ranges.pop(module).__exit__(None, None, None)
+
+        if hasattr(model, 'compute_scores'):
+            model.compute_scores = _label(model.compute_scores, 'compute_scores')
+        for module in model.modules():
+            if hasattr(module, 'GNNCell'):
+                module.GNNCell = _label(module.GNNCell, 'GNNCell')
+        if isinstance(getattr(model, 'loss_function', None), torch.nn.Module):
+            self.handles += [model.loss_function.register_forward_pre_hook(enter),
+                             model.loss_function.register_forward_hook(leave)]
+        for name in (type(model).__module__, 'utils'):
+            module = sys.modules.get(name)
+            for fn in FUNCTIONS:
+                if module is not None and callable(getattr(module, fn, None)):
+                    setattr(module, fn, _label(getattr(module, fn), fn))
+
+    def watch(self, train_data, test_data=None):
+        # labels get_slice, the training calls advance the schedule
+        def get_slice(data, train):
+            fn = _label(data.get_slice, 'get_slice')
+
+            def wrapped(*args, **kwargs):
+                if train:
+                    self._step()
+                return fn(*args, **kwargs)
+            data.get_slice = wrapped
+        get_slice(train_data, True)
+        if test_data is not None:
+            get_slice(test_data, False)
+
+    def watch_loader(self, loader):
+        return _Loader(loader, self)
+
+    def _step(self):
+        if not self.started:
+            self.prof.start()
+            self.started = True
+        else:
+            self.prof.step()
+
+    def _export(self, prof):
+        step = prof.step_num
+        prof.export_chrome_trace(os.path.join(self.run_dir, f'trace_step{step}.json'))
+        sort_by = 'self_cuda_time_total' if self.cuda else 'self_cpu_time_total'
+        with open(os.path.join(self.run_dir, f'ops_step{step}.txt'), 'w') as f:
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+        with open(os.path.join(self.run_dir, f'shapes_step{step}.txt'), 'w') as f:
+            f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=50))
+        print(f'Profile of step {step} written to {self.run_dir}')
+
+    def close(self):
+        if self.started:
+            self.prof.stop()
+        for handle in self.handles:
+            handle.remove()
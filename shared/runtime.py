@@ -0,0 +1,60 @@
+import os
+import torch
+
+# Device and CPU threads of the process. main.py calls setup() once, before
+# the model is built; trans_to_cuda of the model module and everything else
+# that places tensors reads the selected device from device(). Several
+# training processes share a many-core machine by giving each its own --cores
+# and as many --threads.
+
+_device = None
+
+
+def parse_cores(spec):
+    # '0-7,16' -> [0, 1, ..., 7, 16]
+    cores = set()
+    for part in spec.split(','):
+        lo, _, hi = part.partition('-')
+        cores.update(range(int(lo), int(hi or lo) + 1))
+    return sorted(cores)
+
+
+def select(name='auto', gpu_num=0):
+    """Makes `name` (auto, cpu, cuda, cuda:N, mps) the device of the process; auto is cuda when available."""
+    global _device
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if name == 'cuda':
+        name = f'cuda:{gpu_num}'
+    device = torch.device(name)
+    if device.type == 'cuda':
+        if not torch.cuda.is_available():
+            raise RuntimeError(f'device {name} selected but cuda is not available')
+        torch.cuda.set_device(device)
+    _device = device
+    return device
+
+
+def device():
+    if _device is None:
+        select()
+    return _device
+
+
+def setup(name='auto', gpu_num=0, threads=0, interop_threads=0, cores=None):
+    """Pins the process to `cores`, sets its intra-op and inter-op threads and selects its device.
+
+    threads=0 keeps the torch default, or one thread per pinned core.
+    """
+    if cores:
+        cores = parse_cores(cores)
+        os.sched_setaffinity(0, cores)
+        threads = threads or len(cores)
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+    device = select(name, gpu_num)
+    print(f'Device: {device}\tthreads: {torch.get_num_threads()}\tinter-op threads: {torch.get_num_interop_threads()}'
+          + (f'\tcores: {cores[0]}-{cores[-1]} ({len(cores)})' if cores else ''))
+    return device
@@ -0,0 +1,79 @@
+from collections import defaultdict
+import numpy as np
+import torch
+
+# Whole sessions in place of their prefix-expanded examples.
+# The datasets hold every prefix of a session as an example of its own.
+# prefix_sessions gathers them back into whole sessions, so that the models
+# reading out every prefix from one pass over a session (NARM with
+# --prefix_sharing, SR_SAN with --causal) encode every session once.
+
+
+def prefix_sessions(seqs, targets):
+    """Whole sessions of prefix-expanded (seqs, targets) examples.
+
+    Returns the sessions and, per session, the positions t at which predicting
+    session[t + 1] from session[:t + 1] is one of the examples. Every example
+    is covered exactly once, also when several sessions share a prefix.
+    """
+    examples = sorted((list(seq) + [target] for seq, target in zip(seqs, targets)), key=len, reverse=True)
+    sessions, positions = [], []
+    # prefixes of the sessions taken so far whose example has not been seen yet
+    pending = defaultdict(list)
+    for example in examples:
+        key = tuple(example)
+        if pending[key]:
+            positions[pending[key].pop()].append(len(example) - 2)
+            continue
+        sid = len(sessions)
+        sessions.append(example)
+        positions.append([len(example) - 2])
+        for k in range(2, len(example)):
+            pending[tuple(example[:k])].append(sid)
+    return sessions, [sorted(p) for p in positions]
+
+
+class PaddedSessions():
+    """Whole sessions batched as right padded arrays, for SR_SAN's causal mode.
+
+    Batches are drawn and shuffled by session: inputs are the sessions,
+    targets the positions of each that are examples of the dataset and mask
+    the session lengths. Mixed into the Data of a variant, whose
+    generate_batch shuffles and slices them.
+    """
+    def __init__(self, data, shuffle=False):
+        sessions, positions = prefix_sessions(data[0], data[1])
+        # 1-d arrays of lists, also when all sessions have the same length
+        self.inputs = np.asarray(sessions + [None], dtype=object)[:-1]
+        self.targets = np.asarray(positions + [None], dtype=object)[:-1]
+        self.mask = np.array([len(session) for session in sessions])
+        self.length = len(self.inputs)
+        self.n_examples = len(data[0])
+        self.shuffle = shuffle
+        self.batch_aug, self.mixup = False, False
+
+    def get_slice(self, i):
+        """The padded sessions i without their last items, their mask, and the flat positions in them and
+        targets of their examples."""
+        sessions, positions = self.inputs[i], self.targets[i]
+        # the last item of a session is only a target
+        lens = self.mask[i] - 1
+        mask = (np.arange(lens.max()) < lens[:, None]).astype(np.int64)
+        inputs = np.zeros(mask.shape, dtype=np.int64)
+        inputs[mask.astype(bool)] = [item for session in sessions for item in session[:-1]]
+        flat_positions, targets = [], []
+        for k, (session, position) in enumerate(zip(sessions, positions)):
+            flat_positions += [k * lens.max() + t for t in position]
+            targets += [session[t + 1] for t in position]
+        return inputs, mask, np.array(flat_positions), np.array(targets)
+
+
+def prefix_hidden(hidden, positions):
+    """The hidden states of the session of every flat position and the mask of the prefix ending there.
+
+    hidden is (batch, max_len, hidden_size) from one causal pass over padded
+    sessions, positions the flat positions of PaddedSessions.get_slice.
+    """
+    rows, ends = positions // hidden.size(1), positions % hidden.size(1)
+    prefix_mask = (torch.arange(hidden.size(1), device=hidden.device) <= ends.unsqueeze(1)).long()
+    return hidden[rows], prefix_mask
@@ -0,0 +1,397 @@
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+import torch
+from torch.optim import optimizer as _optimizer
+
+# Always-on stage timing for train_test, written as JSONL records every
+# `every` training steps and once per epoch. Stages are measured through hooks
+# and wrappers, so the training loops themselves are unchanged:
+#   data       get_slice of the training Data, or the wait on the training DataLoader
+#   h2d        trans_to_cuda of the model module
+#   forward    the model's forward, excluding nested stages
+#   scoring    model.compute_scores, for the models that have one
+#   backward   from the first gradient reaching the model or scoring output to
+#              the next forward or optimizer step
+#   optimizer  optimizer.step
+#   loss       from the scores of a step to the start of its backward, excluding
+#              nested stages. It opens when compute_scores returns, the forward
+#              for the models without one, or at the first call of
+#              model.loss_function, logit_avg or mixup_criterion, so the
+#              losses, logit averaging written inline in train_test, mixup and
+#              the FLAG perturbation steps fall in it
+#   other      the rest of the step, e.g. the gathers in forward() and logging
+#   eval       evaluate, with the stages inside it reported separately
+# For the Data based models the data stage runs on the training thread, so
+# it is the stall time. CUDA kernels run asynchronously, so the GPU stage
+# times are only exact with sync.
+#
+# The epoch records also carry the memory of every stage: the peak process RSS
+# at its ends, the peak CUDA allocated/reserved bytes when CUDA is available
+# (torch keeps no statistics for its CPU allocator) and, with tensors, the
+# largest tensors alive when the epoch peak was reached. Listing them walks
+# every Python object, so it is opt-in. With tracemalloc the Python
+# allocations of get_slice, create_aug_sessions and get_metric_scores are
+# traced as well.
+
+TRACED = ['create_aug_sessions', 'get_metric_scores']
+LOSSES = ['logit_avg', 'mixup_criterion']
+
+
+def _rss(statm):
+    # resident set size in bytes, the lifetime peak where /proc is missing
+    if statm is not None:
+        return int(os.pread(statm, 64, 0).split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _largest_tensors(n=10):
+    # tensors referenced from Python, one per storage; tensors only saved by autograd are not visible
+    seen, found = set(), []
+    for obj in gc.get_objects():
+        try:
+            if not torch.is_tensor(obj):
+                continue
+            storage = obj.untyped_storage() if hasattr(obj, 'untyped_storage') else obj.storage()
+            key = (storage.data_ptr(), str(obj.device))
+            if key in seen:
+                continue
+            seen.add(key)
+            found.append({'bytes': storage.nbytes(), 'shape': list(obj.shape), 'dtype': str(obj.dtype),
+                          'device': str(obj.device)})
+        except Exception:  # sparse and other tensors without a storage
+            continue
+    return sorted(found, key=lambda t: -t['bytes'])[:n]
+
+
+class _Loader():
+    def __init__(self, loader, telemetry):
+        self.loader = loader
+        self.telemetry = telemetry
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        while True:
+            t0 = self.telemetry._now()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self.telemetry._fetched(t0, len(batch[-1]), None)
+            yield batch
+
+
+class Telemetry():
+    def __init__(self, out_dir, model, every=100, sync=False, trace_malloc=False, tensors=False):
+        os.makedirs(out_dir, exist_ok=True)
+        self.path = os.path.join(out_dir, time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}.jsonl')
+        self.file = open(self.path, 'a')
+        self.every = every
+        self.cuda = torch.cuda.is_available()
+        self.sync = sync and self.cuda
+        try:
+            self.statm = os.open('/proc/self/statm', os.O_RDONLY)
+        except OSError:
+            self.statm = None
+        self.memory = self._memory()
+        self.tensors = tensors
+        self.trace_malloc = trace_malloc
+        self.traced = []
+        self.allocs = defaultdict(lambda: {'calls': 0, 'peak': 0, 'net': 0})
+        if trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.epoch = None
+        self.phase = 'train'
+        self.stack = []
+        self.step_start = None
+        self.backward_start = None
+        self.window = self._counters()
+        self.totals = self._counters()
+        self.eval = self._counters()
+        self.handles = []
+        self._hook(model)
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @staticmethod
+    def _counters():
+        return {'steps': 0, 'time': 0.0, 'sessions': 0, 'items': 0, 'stages': defaultdict(float)}
+
+    @staticmethod
+    def _memory():
+        return {'rss': {}, 'cuda_allocated': {}, 'cuda_reserved': {}, 'peak': 0, 'peak_stage': None,
+                'largest_tensors': []}
+
+    def _add(self, stage, dt):
+        if self.phase == 'eval':
+            self.eval['stages'][stage] += dt
+        else:
+            self.window['stages'][stage] += dt
+            self.totals['stages'][stage] += dt
+        self._sample(stage if self.phase == 'train' else 'eval_' + stage)
+
+    def _sample(self, stage):
+        # memory peaks at the end of a stage, with tensors the largest ones are listed whenever the epoch peak grows by 5%
+        mem = self.memory
+        rss = _rss(self.statm)
+        mem['rss'][stage] = max(mem['rss'].get(stage, 0), rss)
+        peak = rss
+        if self.cuda:
+            peak = torch.cuda.max_memory_allocated()
+            mem['cuda_allocated'][stage] = max(mem['cuda_allocated'].get(stage, 0), peak)
+            mem['cuda_reserved'][stage] = max(mem['cuda_reserved'].get(stage, 0), torch.cuda.max_memory_reserved())
+            torch.cuda.reset_peak_memory_stats()
+        if peak > mem['peak'] * 1.05:
+            if self.tensors:
+                mem['largest_tensors'] = _largest_tensors()
+            mem['peak'], mem['peak_stage'] = peak, stage
+
+    def _enter(self, stage):
+        t = self._now()
+        self._end_backward(t)
+        if self.stack:
+            self._add(self.stack[-1][0], t - self.stack[-1][1])
+        self.stack.append([stage, t])
+
+    def _exit(self):
+        t = self._now()
+        stage, t0 = self.stack.pop()
+        self._add(stage, t - t0)
+        if self.stack:
+            self.stack[-1][1] = t
+
+    def _end_backward(self, t):
+        if self.backward_start is not None:
+            self._add('backward', t - self.backward_start)
+            self.backward_start = None
+
+    def _open_loss(self):
+        # scores or a loss computed outside the other stages open the loss stage, the backward closes it
+        if self.phase == 'train' and self.step_start is not None and not self.stack and torch.is_grad_enabled():
+            self._enter('loss')
+
+    def _close_loss(self, t):
+        if len(self.stack) == 1 and self.stack[0][0] == 'loss':
+            self._add('loss', t - self.stack.pop()[1])
+
+    def _grad(self, grad):
+        if self.backward_start is None:
+            self.backward_start = self._now()
+            self._close_loss(self.backward_start)
+
+    def _watch_grad(self, output):
+        # the first gradient reaching a stage output starts the backward stage
+        if self.phase == 'train' and torch.is_grad_enabled():
+            for out in output if isinstance(output, (tuple, list)) else [output]:
+                if torch.is_tensor(out) and out.requires_grad:
+                    out.register_hook(self._grad)
+
+    def _wrap(self, fn, stage, grad=False, loss=False):
+        def wrapped(*args, **kwargs):
+            self._enter(stage)
+            try:
+                out = fn(*args, **kwargs)
+            finally:
+                self._exit()
+            if grad:
+                self._watch_grad(out)
+            if loss:
+                self._open_loss()
+            return out
+        return wrapped
+
+    def _hook(self, model):
+        scoring = hasattr(model, 'compute_scores')
+
+        def pre_forward(module, inputs):
+            self._enter('forward')
+
+        def post_forward(module, inputs, output):
+            self._exit()
+            self._watch_grad(output)
+            if not scoring:
+                self._open_loss()
+
+        self.handles += [model.register_forward_pre_hook(pre_forward), model.register_forward_hook(post_forward)]
+        if isinstance(getattr(model, 'loss_function', None), torch.nn.Module):
+            self.handles.append(model.loss_function.register_forward_pre_hook(lambda *_: self._open_loss()))
+        if scoring:
+            model.compute_scores = self._wrap(model.compute_scores, 'scoring', grad=True, loss=True)
+        if hasattr(_optimizer, 'register_optimizer_step_pre_hook'):
+            self.handles += [
+                _optimizer.register_optimizer_step_pre_hook(lambda *_: self._enter('optimizer')),
+                _optimizer.register_optimizer_step_post_hook(lambda *_: self._exit()),
+            ]
+        elif hasattr(model, 'optimizer'):  # torch < 2.0
+            model.optimizer.step = self._wrap(model.optimizer.step, 'optimizer')
+        module = sys.modules[type(model).__module__]
+        if self.trace_malloc:
+            for name in (type(model).__module__, 'utils'):
+                for fn in TRACED:
+                    if callable(getattr(sys.modules.get(name), fn, None)):
+                        setattr(sys.modules[name], fn, self._trace(getattr(sys.modules[name], fn), fn))
+        for fn in LOSSES:
+            if callable(getattr(module, fn, None)):
+                setattr(module, fn, self._loss(getattr(module, fn)))
+        if hasattr(module, 'trans_to_cuda'):
+            module.trans_to_cuda = self._wrap(module.trans_to_cuda, 'h2d')
+
+    def _loss(self, fn):
+        def wrapped(*args, **kwargs):
+            self._open_loss()
+            return fn(*args, **kwargs)
+        return wrapped
+        if hasattr(module, 'evaluate'):
+            module.evaluate = self._evaluate(module.evaluate)
+
+    def _trace(self, fn, name):
+        # python allocations of fn: the peak above the memory traced at the call and the net change
+        def wrapped(*args, **kwargs):
+            current, peak = tracemalloc.get_traced_memory()
+            if self.traced:
+                self.traced[-1][1] = max(self.traced[-1][1], peak)
+            tracemalloc.reset_peak()
+            self.traced.append([current, current])
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                start, inner = self.traced.pop()
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, inner)
+                stats = self.allocs[name]
+                stats['calls'] += 1
+                stats['peak'] = max(stats['peak'], peak - start)
+                stats['net'] += current - start
+                if self.traced:
+                    self.traced[-1][1] = max(self.traced[-1][1], peak)
+        return wrapped
+
+    def _evaluate(self, evaluate):
+        def wrapped(*args, **kwargs):
+            t0 = self._now()
+            self._close_step(t0)
+            self.phase = 'eval'
+            try:
+                return evaluate(*args, **kwargs)
+            finally:
+                self.phase = 'train'
+                self.eval['time'] += self._now() - t0
+        return wrapped
+
+    def watch(self, train_data, test_data=None):
+        # times get_slice, the training calls mark the steps
+        def get_slice(data, train):
+            fn = self._trace(data.get_slice, 'get_slice') if self.trace_malloc else data.get_slice
+
+            def wrapped(i, *args, **kwargs):
+                if not train or self.phase == 'eval':
+                    self._enter('data')
+                    try:
+                        return fn(i, *args, **kwargs)
+                    finally:
+                        self._exit()
+                t0 = self._now()
+                out = fn(i, *args, **kwargs)
+                # read at every call, shuffling the training data rebinds its mask
+                mask = getattr(data, 'mask', None)
+                items = int(mask[i].sum()) if mask is not None else int(data.lens[i].sum())
+                self._fetched(t0, len(i), items)
+                return out
+            data.get_slice = wrapped
+        get_slice(train_data, True)
+        if test_data is not None:
+            get_slice(test_data, False)
+
+    def watch_loader(self, loader):
+        return _Loader(loader, self)
+
+    def _fetched(self, t0, sessions, items):
+        # a training batch was fetched in [t0, now), closing the previous step
+        t = self._now()
+        self._close_step(t0)
+        self.step_start = t0
+        self.stack = []
+        self._add('data', t - t0)
+        for c in (self.window, self.totals):
+            c['sessions'] += sessions
+            c['items'] += items or 0
+
+    def _close_step(self, t):
+        self._close_loss(t)
+        self._end_backward(t)
+        if self.step_start is None:
+            return
+        for c in (self.window, self.totals):
+            c['steps'] += 1
+            c['time'] += t - self.step_start
+        self.step_start = None
+        if self.every and self.window['steps'] >= self.every:
+            self._emit('steps', self.window)
+            self.window = self._counters()
+
+    def _record(self, c):
+        stages = dict(c['stages'])
+        stages['other'] = max(c['time'] - sum(stages.values()), 0.0)
+        rec = {'steps': c['steps'], 'time': c['time'], 'sessions': c['sessions']}
+        if c['time'] > 0:
+            rec['sessions_per_sec'] = c['sessions'] / c['time']
+            if c['items']:
+                rec['items'] = c['items']
+                rec['items_per_sec'] = c['items'] / c['time']
+            rec['stall'] = stages.get('data', 0.0) / c['time']
+        rec['stages'] = stages
+        return rec
+
+    def _emit(self, event, c, **extra):
+        rec = {'event': event, 'epoch': self.epoch, 'step': self.totals['steps']}
+        rec.update(self._record(c))
+        rec.update(extra)
+        self.file.write(json.dumps(rec) + '\n')
+        self.file.flush()
+        return rec
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.window, self.totals, self.eval = self._counters(), self._counters(), self._counters()
+        self.memory = self._memory()
+        self.allocs.clear()
+
+    def end_epoch(self):
+        self._close_step(self._now())
+        if self.window['steps']:
+            self._emit('steps', self.window)
+        extra = {}
+        if self.eval['time'] > 0:
+            extra['eval'] = {'time': self.eval['time'], 'stages': dict(self.eval['stages'])}
+        extra['memory'] = dict(self.memory, maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        if self.trace_malloc:
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                                  tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+            top = snapshot.statistics('lineno')[:10]
+            extra['tracemalloc'] = {'functions': dict(self.allocs),
+                                    'top': [{'line': str(s.traceback), 'bytes': s.size, 'count': s.count} for s in top]}
+        rec = self._emit('epoch', self.totals, **extra)
+        if 'sessions_per_sec' in rec:
+            print('Throughput: %.1f sessions/s\tdata stall: %.1f%%\tpeak memory: %.0f MB (%s)'
+                  % (rec['sessions_per_sec'], rec['stall'] * 100, self.memory['peak'] / 2 ** 20, self.memory['peak_stage']))
+
+    def close(self):
+        for handle in self.handles:
+            handle.remove()
+        if self.statm is not None:
+            os.close(self.statm)
+        self.file.close()
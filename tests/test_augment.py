@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from shared import augment
+
+
+class RecordingRng():
+    # a numpy Generator that keeps what it drew, so the original loops can replay the same choices
+    def __init__(self, seed):
+        self.rng = np.random.default_rng(seed)
+        self.draws = []
+
+    def choice(self, *args, **kwargs):
+        self.draws.append(self.rng.choice(*args, **kwargs))
+        return self.draws[-1]
+
+    def integers(self, *args, **kwargs):
+        self.draws.append(self.rng.integers(*args, **kwargs))
+        return self.draws[-1]
+
+
+def deletion_loop(sessions, sidx, positions):
+    # random_deletion of the random variants before vectorization, with its random choices given
+    aug_sess = []
+    for i, position in zip(sidx, positions):
+        cur_sess = sessions[i].copy()
+        del cur_sess[position]
+        aug_sess.append(cur_sess)
+    return aug_sess
+
+
+def insertion_loop(sessions, sidx, positions, items):
+    # random_insertion of the random variants before vectorization, with its random choices given
+    aug_sess = []
+    for i, position, item in zip(sidx, positions, items):
+        cur_sess = sessions[i].copy()
+        cur_sess.insert(position, item)
+        aug_sess.append(cur_sess)
+    return aug_sess
+
+
+def _sessions(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(1, 30, rng.integers(1, 8)).tolist() for _ in range(n)]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_deletion_matches_loop(seed):
+    sessions = _sessions(40, seed)
+    items, lens = augment.from_lists(sessions)
+    rng = RecordingRng(seed)
+    out, out_lens, sidx = augment.random_deletion(items, lens, rng)
+    chosen, positions = rng.draws
+    assert np.array_equal(sidx, chosen)
+    # sessions of one item are never chosen, 80% of the others are
+    assert all(lens[sidx] > 1) and len(sidx) == int((lens > 1).sum() * 0.8)
+    assert augment.to_lists(out, out_lens) == deletion_loop(sessions, sidx, positions)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_insertion_matches_loop(seed):
+    sessions = _sessions(40, seed)
+    items, lens = augment.from_lists(sessions)
+    rng = RecordingRng(seed)
+    out, out_lens, sidx = augment.random_insertion(items, lens, rng, sample_num=len(sessions) // 2)
+    chosen, positions, picks = rng.draws
+    candidate_item = sorted(set(items.tolist()))
+    assert np.array_equal(sidx, chosen) and len(sidx) == len(sessions) // 2
+    expected = insertion_loop(sessions, sidx, positions, [candidate_item[k] for k in picks])
+    assert augment.to_lists(out, out_lens) == expected
+
+
+def test_keep_rest_passes_the_other_sessions_through():
+    sessions = _sessions(20)
+    items, lens = augment.from_lists(sessions)
+    out, out_lens, sidx = augment.random_deletion(items, lens, np.random.default_rng(0), keep_rest=True)
+    assert np.array_equal(sidx, np.arange(len(sessions)))
+    changed = [a != s for a, s in zip(augment.to_lists(out, out_lens), sessions)]
+    assert np.array_equal(out_lens, lens - np.array(changed))
+
+
+def test_insertion_leaves_full_sessions_alone():
+    sessions = _sessions(30)
+    items, lens = augment.from_lists(sessions)
+    _, _, sidx = augment.random_insertion(items, lens, np.random.default_rng(0), ratio=1.0, len_max=5)
+    assert set(sidx.tolist()) == set(np.nonzero(lens < 5)[0].tolist())
@@ -0,0 +1,67 @@
+import random
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from benchmark.common import load, sessions
+from shared.checkpoint import CheckpointManager
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(4, 3)
+        self.optimizer = torch.optim.Adam(self.parameters(), lr=0.1)
+        self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=1, gamma=0.5)
+
+
+def _epoch(model, data):
+    # one shuffled pass with a step per batch, returns the order the data was drawn in
+    slices = data.generate_batch(8)
+    for _ in slices:
+        model.optimizer.zero_grad()
+        model.linear(torch.randn(2, 4)).sum().backward()
+        model.optimizer.step()
+    model.scheduler.step()
+    return data.targets.copy()
+
+
+def _draws():
+    return torch.rand(3).tolist(), np.random.rand(3).tolist(), random.random()
+
+
+def test_resume_restores_state_and_replays_rng(tmp_path):
+    utils = load('Baselines/SR-GNN', 'utils')
+    seqs, targets = sessions(30, 50, np.random.default_rng(0))
+    torch.manual_seed(0)
+    np.random.seed(0)
+    random.seed(0)
+
+    model, data = Model(), utils.Data((seqs, targets), batch_aug=False, mixup=False, shuffle=True)
+    ckpt = CheckpointManager(str(tmp_path), keep=1)
+    ckpt.track(data)
+    for epoch in range(2):
+        _epoch(model, data)
+        ckpt.save(epoch, [[0.0, 0.0, 0.0], [float(epoch), 0.0, 0.0]], model, 0, [[0] * 3] * 2, [[0] * 3] * 2)
+    ckpt.close()
+    # the run without interruption goes on with a third epoch
+    order, weights, draws = _epoch(model, data), model.state_dict(), _draws()
+
+    resumed, data = Model(), utils.Data((seqs, targets), batch_aug=False, mixup=False, shuffle=True)
+    ckpt = CheckpointManager(str(tmp_path), keep=1)
+    ckpt.track(data)
+    state = ckpt.resume(str(tmp_path / 'last.pt'), resumed)
+    ckpt.close()
+    assert state['epoch'] == 1 and ckpt.kept == [(1.0, 1)]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['1.pt', 'last.pt']
+    assert resumed.optimizer.param_groups[0]['lr'] == pytest.approx(0.1 * 0.5 ** 2)
+    assert np.array_equal(_epoch(resumed, data), order)
+    for name, value in resumed.state_dict().items():
+        assert torch.equal(value, weights[name]), name
+    assert _draws() == draws
+
+
+def test_keep_below_one_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        CheckpointManager(str(tmp_path), keep=0)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+
+from benchmark.common import load, sessions
+
+# the EOPA utils that model.py imports read the datasets with pandas
+pytest.importorskip('pandas')
+
+
+def _graph(n=24, n_items=15):
+    seqs, _ = sessions(n, n_items, np.random.default_rng(0))
+    return load('Baselines/EOPA', 'collate').seqs_to_eop_multigraph(seqs)
+
+
+def reference_reducer(layer, mg, ft):
+    # DGL's mailbox reduce, one node at a time: the last GRU state over the messages of its in-edges in edge order
+    out = torch.zeros_like(ft)
+    for node in range(mg.number_of_nodes()):
+        edges = torch.nonzero(mg.dst == node).view(-1)
+        if len(edges):
+            out[node] = layer.gru(ft[mg.src[edges]].unsqueeze(0))[1].view(-1)
+    return out
+
+
+@pytest.mark.parametrize('mailbox', ['bucket', 'packed'])
+def test_mailboxes_match_the_per_node_reduce(mailbox):
+    mg = _graph()
+    model = load('Baselines/EOPA', 'model')
+    torch.manual_seed(0)
+    layer = model.EOPA(8, 8, batch_norm=False, mailbox=mailbox).eval()
+    ft = torch.randn(mg.number_of_nodes(), 8)
+    with torch.no_grad():
+        assert torch.allclose(layer.reducer(mg, ft), reference_reducer(layer, mg, ft), atol=1e-6)
+
+
+def test_bucket_and_packed_layers_agree():
+    mg = _graph()
+    model = load('Baselines/EOPA', 'model')
+    torch.manual_seed(0)
+    bucket = model.EOPA(8, 8, mailbox='bucket').eval()
+    packed = model.EOPA(8, 8, mailbox='packed').eval()
+    packed.load_state_dict(bucket.state_dict())
+    feat = torch.randn(mg.number_of_nodes(), 8)
+    with torch.no_grad():
+        assert torch.allclose(bucket(mg, feat), packed(mg, feat), atol=1e-6)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+from benchmark.common import load, sessions
+from shared import evaluation
+
+
+class Model():
+    batch_size = 16
+
+    def eval(self):
+        pass
+
+
+def _setup(n=50, n_items=40):
+    utils = load('Baselines/SR-GNN', 'utils')
+    seqs, targets = sessions(n, n_items, np.random.default_rng(0))
+    data = utils.Data((seqs, targets), batch_aug=False, mixup=False, shuffle=False)
+    scores = torch.randn(n, n_items - 1, generator=torch.Generator().manual_seed(0))
+
+    def score(i):
+        data.get_slice(i, False)
+        return data.targets[i], scores[i]
+    return utils, data, score
+
+
+@pytest.mark.parametrize('cache', evaluation.CACHES)
+def test_run_matches_get_metric_scores(cache):
+    utils, data, score = _setup()
+    evaluation.configure(0, cache)
+    expected = []
+    for k in (10, 20):
+        evals = [[], [], []]
+        for i in data.generate_batch(Model.batch_size):
+            targets, scores = score(i)
+            evals = utils.get_metric_scores(scores, targets, k, evals)
+        expected.append(evals)
+    # the second evaluation replays the batches the cache recorded
+    for _ in range(2):
+        results, _ = evaluation.run(Model(), data, score, Ks=(10, 20))
+        for (hits, mrrs, covered), (hit, mrr, cov) in zip(expected, results):
+            assert hit[0] == pytest.approx(np.mean(hits))
+            assert mrr[0] == pytest.approx(np.mean(mrrs))
+            assert cov == np.unique(covered).tolist()
+    evaluation.configure()
+
+
+def test_run_rejects_an_empty_test_set():
+    _, data, score = _setup()
+    data.length = 0
+    with pytest.raises(ValueError, match='empty'):
+        evaluation.run(Model(), data, score)
@@ -0,0 +1,49 @@
+import sys
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from benchmark.common import load, main_defaults, sessions
+
+
+def reference_forward(model, seqs):
+    """c_t of NARM as the original batches and forward computed it: the sessions sorted by decreasing
+    length, padded into a (max_len, batch) tensor and packed from it. Returned in the sorted order."""
+    lens = np.array([len(seq) for seq in seqs])
+    order = np.argsort(lens, kind='stable')[::-1]
+    seq = torch.zeros(len(seqs), lens.max()).long()
+    for k, j in enumerate(order):
+        seq[k, :lens[j]] = torch.LongTensor(seqs[j])
+    seq = seq.transpose(0, 1)
+
+    hidden = model.init_hidden(seq.size(1))
+    embs = pack_padded_sequence(model.emb_dropout(model.emb(seq)), lens[order].tolist())
+    gru_out, hidden = model.gru(embs, hidden)
+    gru_out, _ = pad_packed_sequence(gru_out)
+    ht = hidden[-1]
+    gru_out = gru_out.permute(1, 0, 2)
+    q1 = model.a_1(gru_out.contiguous().view(-1, model.hidden_size)).view(gru_out.size())
+    q2 = model.a_2(ht)
+    mask = (seq.permute(1, 0) > 0).float()
+    q2_masked = mask.unsqueeze(2).expand_as(q1) * q2.unsqueeze(1).expand_as(q1)
+    alpha = model.v_t(torch.sigmoid(q1 + q2_masked).view(-1, model.hidden_size)).view(mask.size())
+    c_local = torch.sum(alpha.unsqueeze(2).expand_as(gru_out) * gru_out, 1)
+    return torch.cat([c_local, ht], 1), order
+
+
+def test_packed_batches_match_the_sorted_padded_forward():
+    narm = load('Baselines/NARM', 'narm')
+    # the utils narm.py was imported with
+    utils = sys.modules['utils']
+    torch.manual_seed(0)
+    model = narm.NARM(50, main_defaults('Baselines/NARM')).eval()
+    seqs, targets = sessions(40, 50, np.random.default_rng(0))
+    data = utils.Data((seqs, targets))
+    i = np.random.default_rng(1).permutation(data.length)[:32]
+    with torch.no_grad():
+        inputs, batch_targets = data.get_slice(i)
+        c_t = model(inputs)
+        expected, order = reference_forward(model, [seqs[j] for j in i])
+    assert batch_targets.tolist() == [targets[j] for j in i]
+    # get_slice keeps the order of the batch, the original sorted it
+    assert torch.allclose(c_t[torch.from_numpy(order.copy())], expected, atol=1e-6)
@@ -0,0 +1,51 @@
+from collections import Counter
+import sys
+import numpy as np
+import pytest
+import torch
+
+from benchmark.common import load, main_defaults, sessions
+from shared.sessions import prefix_sessions
+
+
+def _examples(n=60, n_items=30):
+    # every prefix of generated sessions as an example, as in the datasets, duplicates included
+    seqs, targets = sessions(n, n_items, np.random.default_rng(0))
+    examples = [(s[:k], s[k]) for s in (seq + [t] for seq, t in zip(seqs, targets)) for k in range(1, len(s))]
+    return [e[0] for e in examples] + seqs[:5], [e[1] for e in examples] + targets[:5]
+
+
+def test_prefix_sessions_cover_every_example_once():
+    seqs, targets = _examples()
+    whole, positions = prefix_sessions(seqs, targets)
+    covered = Counter((tuple(s[:t + 1]), s[t + 1]) for s, p in zip(whole, positions) for t in p)
+    assert covered == Counter((tuple(seq), target) for seq, target in zip(seqs, targets))
+    assert len(whole) < len(seqs)
+
+
+@pytest.mark.parametrize('chunk', [1, 2 ** 24])
+def test_forward_prefixes_matches_every_prefix_on_its_own(chunk):
+    narm = load('Baselines/NARM', 'narm')
+    # the utils narm.py was imported with
+    utils = sys.modules['utils']
+    torch.manual_seed(0)
+    model = narm.NARM(30, main_defaults('Baselines/NARM')).eval()
+    model.PREFIX_CHUNK = chunk
+    seqs, targets = _examples()
+    data = utils.Sessions((seqs, targets))
+    i = np.arange(data.length)
+    with torch.no_grad():
+        inputs, session_targets, positions = data.get_slice(i)
+        feats = model(inputs, prefixes=True)
+        shared = model.compute_scores(feats.reshape(-1, feats.size(2))[positions])
+
+        # the same examples one prefix at a time, in the order of the flat positions
+        max_len = feats.size(1)
+        whole = [list(data.items[o:o + n]) for o, n in zip(data.offsets, data.lens)]
+        prefixes = [whole[p // max_len][:p % max_len + 1] for p in positions.tolist()]
+        expected = [whole[p // max_len][p % max_len + 1] for p in positions.tolist()]
+        single = utils.Data((prefixes, expected))
+        prefix_inputs, prefix_targets = single.get_slice(np.arange(single.length))
+        scores = model.compute_scores(model(prefix_inputs))
+    assert session_targets.tolist() == expected == prefix_targets.tolist()
+    assert torch.allclose(shared, scores, atol=1e-5)
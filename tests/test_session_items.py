@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from benchmark.common import load
+
+
+def _padded(seed, n=32, len_max=9):
+    rng = np.random.default_rng(seed)
+    lens = rng.integers(1, len_max + 1, n)
+    # few items, so that sessions repeat them
+    inputs = rng.integers(1, 12, (n, len_max))
+    inputs[np.arange(len_max) >= lens[:, None]] = 0
+    return inputs
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_session_items_matches_session_graphs(seed):
+    inputs = _padded(seed)
+    alias_graphs, _, items_graphs = load('Baselines/SR-GNN', 'utils').session_graphs(inputs)
+    alias_inputs, items, key_padding_mask = load('Baselines/SR_SAN', 'utils').session_items(inputs)
+    assert np.array_equal(alias_inputs, np.asarray(alias_graphs))
+    assert np.array_equal(items, np.asarray(items_graphs))
+    n_node = np.array([len(np.unique(row)) for row in inputs])
+    assert np.array_equal(key_padding_mask, np.arange(items.shape[1]) >= n_node[:, None])